@@ -0,0 +1,264 @@
+import argparse
+import json
+import os
+import random
+import sys
+import time
+from datetime import datetime, timedelta
+from typing import List, Dict, Tuple, Any, Callable, Optional
+
+import numpy as np
+
+# Times the REST routes against the fake ShopCore in fake_shop_pybind, in process through the fastapi TestClient, so
+# the numbers are the overhead of restshop, pyshop and the serializers without any network or SHOP time. Requests are
+# sent one at a time, throughput is the inverse of the mean latency.
+#
+#   python benchmarks/bench.py --cascades 20 --hours 168 --save-baseline baseline.json
+#   python benchmarks/bench.py --cascades 20 --hours 168 --baseline baseline.json
+#
+# With --baseline the p50 of every route is compared to the saved run, and the exit code is 1 if any route got slower
+# than the tolerance allows.
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+START_TIME = datetime(2021, 5, 2)
+
+
+def create_client(cache: bool):
+    sys.path.insert(0, ROOT)
+    try:
+        import pyshop
+    except ImportError:
+        sys.path.insert(0, os.path.join(ROOT, 'SDK'))
+    import fake_shop_pybind
+    fake_shop_pybind.install()
+    if not cache:
+        # otherwise repeated reads only measure the payload cache
+        os.environ['RESTSHOP_SESSION_CACHE_MB'] = '0'
+
+    from fastapi.testclient import TestClient
+    from main import app
+    return TestClient(app)
+
+
+# ------ synthetic topology
+
+def _curve(x: List[float], y: List[float]) -> Dict[str, Any]:
+    return {'x_values': x, 'y_values': y}
+
+
+def _series(rng: random.Random, hours: int, low: float, high: float) -> Dict[str, Any]:
+    return {
+        'timestamps': [(START_TIME + timedelta(hours=h)).isoformat() for h in range(hours)],
+        'values': [[round(rng.uniform(low, high), 3) for _ in range(hours)]],
+    }
+
+
+def topology(cascades: int, depth: int, generators: int, hours: int, seed: int = 0) -> Dict[str, Any]:
+    # cascades of depth reservoirs, each draining through a plant with its generators into the next reservoir, and a
+    # single market. PUT /model body.
+    rng = random.Random(seed)
+    objects = [{
+        'object_type': 'market', 'object_name': 'market',
+        'attributes': {'sale_price': _series(rng, hours, 20, 60), 'buy_price': _series(rng, hours, 21, 61)},
+    }]
+    connections = []
+
+    def connect(from_type, from_name, to_type, to_name):
+        connections.append({
+            'from_object': {'object_type': from_type, 'object_name': from_name},
+            'to_object': {'object_type': to_type, 'object_name': to_name},
+        })
+
+    for c in range(cascades):
+        for d in range(depth):
+            reservoir, plant = f'res_{c}_{d}', f'plant_{c}_{d}'
+            objects += [{
+                'object_type': 'reservoir', 'object_name': reservoir,
+                'attributes': {
+                    'max_vol': rng.uniform(10, 100), 'lrl': 90.0, 'hrl': 100.0,
+                    'vol_head': _curve([0.0, 50.0, 100.0], [90.0, 95.0, 100.0]),
+                    'water_value_input': {'0.0': _curve([0.0, 50.0, 100.0], [40.0, 30.0, 20.0])},
+                    'inflow': _series(rng, hours, 0, 50),
+                },
+            }, {
+                'object_type': 'plant', 'object_name': plant,
+                'attributes': {'outlet_line': 40.0, 'main_loss': [0.0002], 'penstock_loss': [0.0001]},
+            }]
+            connect('reservoir', reservoir, 'plant', plant)
+            if d + 1 < depth:
+                connect('plant', plant, 'reservoir', f'res_{c}_{d + 1}')
+
+            for g in range(generators):
+                generator = f'gen_{c}_{d}_{g}'
+                objects += [{
+                    'object_type': 'generator', 'object_name': generator,
+                    'attributes': {
+                        'penstock': 1, 'p_min': 5.0, 'p_max': 50.0, 'p_nom': 50.0, 'startcost': 100.0,
+                        'gen_eff_curve': _curve([0.0, 50.0], [95.0, 98.0]),
+                        'turb_eff_curves': {'90.0': _curve([10.0, 20.0, 30.0], [85.0, 92.0, 88.0])},
+                    },
+                }]
+                connect('plant', plant, 'generator', generator)
+
+    return {'objects': objects, 'connections': connections}
+
+
+# ------ measurements
+
+def percentile(latencies: List[float], q: float) -> float:
+    return float(np.percentile(np.asarray(latencies), q))
+
+
+def measure(client, method: str, request: Callable[[int], Tuple[str, Dict[str, Any]]], n: int, warmup: int) -> Dict[str, float]:
+    # request(i) gives the url and the keyword arguments of the i-th request
+    latencies = []
+    for i in range(warmup + n):
+        url, kwargs = request(i)
+        start = time.perf_counter()
+        response = client.request(method, url, **kwargs)
+        elapsed = time.perf_counter() - start
+        if response.status_code >= 400:
+            raise RuntimeError(f'{method} {url} returned {response.status_code}: {response.text[:200]}')
+        if i >= warmup:
+            latencies.append(elapsed)
+
+    return {
+        'n': n,
+        'throughput': n / sum(latencies),
+        'p50_ms': percentile(latencies, 50) * 1000,
+        'p99_ms': percentile(latencies, 99) * 1000,
+    }
+
+
+def new_session(client, hours: int) -> Dict[str, str]:
+    session_id = client.post('/session?session_name=bench').json()['session_id']
+    headers = {'session-id': str(session_id)}
+    time_resolution = {
+        'start_time': START_TIME.isoformat(), 'end_time': (START_TIME + timedelta(hours=hours)).isoformat(), 'time_unit': 'hour'
+    }
+    client.put('/time_resolution', json=time_resolution, headers=headers)
+    return headers
+
+
+def run(client, args) -> Dict[str, Dict[str, float]]:
+    from restshop import columnar
+
+    model = topology(args.cascades, args.depth, args.generators, args.hours, args.seed)
+    reservoirs = [o['object_name'] for o in model['objects'] if o['object_type'] == 'reservoir']
+    generators = [o['object_name'] for o in model['objects'] if o['object_type'] == 'generator']
+    rng = random.Random(args.seed)
+    n, warmup = args.requests, args.warmup
+    results = {}
+
+    def timed(name: str, method: str, request: Callable[[int], Tuple[str, Dict[str, Any]]], count: int = n,
+              warmup_count: int = warmup):
+        results[name] = measure(client, method, request, count, warmup_count)
+        r = results[name]
+        print(f'{name:<48} {r["throughput"]:>10.1f} {r["p50_ms"]:>10.2f} {r["p99_ms"]:>10.2f}', file=sys.stderr)
+
+    print(f'{"route":<48} {"req/s":>10} {"p50 ms":>10} {"p99 ms":>10}', file=sys.stderr)
+
+    timed('POST /session', 'POST', lambda i: ('/session?session_name=bench', {}), count=args.model_repeats, warmup_count=0)
+
+    # every upsert goes to a fresh session
+    sessions = [new_session(client, args.hours) for _ in range(args.model_repeats + 1)]
+    timed('PUT /model', 'PUT', lambda i: ('/model', {'json': model, 'headers': sessions[i]}),
+          count=args.model_repeats, warmup_count=1)
+    headers = sessions[-1]
+
+    timed('GET /model/{object_type}', 'GET',
+          lambda i: (f'/model/reservoir?object_name={rng.choice(reservoirs)}', {'headers': headers}))
+    timed('GET /model/{object_type} (generator)', 'GET',
+          lambda i: (f'/model/generator?object_name={rng.choice(generators)}', {'headers': headers}))
+    timed('GET /model/{object_type}/attributes/{attr} json', 'GET',
+          lambda i: (f'/model/reservoir/attributes/inflow?object_name={rng.choice(reservoirs)}', {'headers': headers}))
+    timed('GET /model/{object_type}/attributes/{attr} npy', 'GET',
+          lambda i: (f'/model/reservoir/attributes/inflow?object_name={rng.choice(reservoirs)}',
+                     {'headers': dict(headers, Accept=columnar.NPY)}))
+    timed('PUT /model/{object_type}', 'PUT',
+          lambda i: (f'/model/reservoir?object_name={rng.choice(reservoirs)}',
+                     {'json': {'attributes': {'max_vol': 10.0 + i}}, 'headers': headers}))
+
+    inflow = {
+        'time': np.datetime64(START_TIME, 's') + np.arange(args.hours) * np.timedelta64(3600, 's'),
+        'y_0': np.linspace(0, 50, args.hours),
+    }
+    inflow_npy = columnar.encode_table(inflow, columnar.NPY)
+    timed('PUT /model/{object_type}/attributes/{attr} npy', 'PUT',
+          lambda i: (f'/model/reservoir/attributes/inflow?object_name={rng.choice(reservoirs)}',
+                     {'data': inflow_npy, 'headers': dict(headers, **{'Content-Type': columnar.NPY})}))
+    timed('GET /model/{object_type}/information', 'GET',
+          lambda i: ('/model/generator/information?verbose=true', {'headers': headers}))
+    for format in ['connections', 'edge_list', 'csr']:
+        timed(f'GET /connections ({format})', 'GET', lambda i: (f'/connections?format={format}', {'headers': headers}))
+
+    timed('POST /simulation/{command}', 'POST',
+          lambda i: ('/simulation/start_sim', {'json': {'options': [], 'values': []}, 'headers': headers}),
+          count=args.model_repeats, warmup_count=1)
+    timed('GET /model/{object_type} (outputs)', 'GET',
+          lambda i: (f'/model/generator?object_name={rng.choice(generators)}&outputs_only=true', {'headers': headers}))
+    timed('GET /metrics', 'GET', lambda i: ('/metrics', {}))
+
+    for s in client.get('/sessions').json():
+        if s['session_name'] == 'bench':
+            client.delete(f'/session?session_id={s["session_id"]}')
+    return results
+
+
+def compare(results: Dict[str, Dict[str, float]], baseline: Dict[str, Dict[str, float]], tolerance: float) -> List[str]:
+    # routes whose p50 got slower than the baseline by more than tolerance
+    regressions = []
+    print(f'\n{"route":<48} {"p50 ms":>10} {"baseline":>10} {"change":>8}', file=sys.stderr)
+    for name, r in results.items():
+        if name not in baseline:
+            continue
+        change = r['p50_ms'] / baseline[name]['p50_ms'] - 1
+        flag = ' REGRESSION' if change > tolerance else ''
+        print(f'{name:<48} {r["p50_ms"]:>10.2f} {baseline[name]["p50_ms"]:>10.2f} {change:>+8.1%}{flag}', file=sys.stderr)
+        if flag:
+            regressions.append(name)
+    return regressions
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description='time the restshop routes against a fake ShopCore')
+    parser.add_argument('--cascades', type=int, default=10, help='number of river systems')
+    parser.add_argument('--depth', type=int, default=3, help='reservoir and plant pairs per cascade')
+    parser.add_argument('--generators', type=int, default=2, help='generators per plant')
+    parser.add_argument('--hours', type=int, default=168, help='optimization horizon, hourly resolution')
+    parser.add_argument('--requests', type=int, default=200, help='timed requests per route')
+    parser.add_argument('--warmup', type=int, default=10, help='untimed requests per route')
+    parser.add_argument('--model-repeats', type=int, default=5, help='timed PUT /model and simulation runs')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--cache', action='store_true', help='keep the payload cache enabled')
+    parser.add_argument('--output', help='write the results as json')
+    parser.add_argument('--save-baseline', help='write the results and settings as a baseline')
+    parser.add_argument('--baseline', help='compare against a saved baseline')
+    parser.add_argument('--tolerance', type=float, default=0.2, help='allowed p50 slowdown against the baseline')
+    args = parser.parse_args(argv)
+
+    settings = {k: getattr(args, k) for k in ['cascades', 'depth', 'generators', 'hours', 'requests', 'cache']}
+    client = create_client(args.cache)
+    results = run(client, args)
+    report = {'settings': settings, 'results': results}
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+    if args.save_baseline:
+        with open(args.save_baseline, 'w') as f:
+            json.dump(report, f, indent=2)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        if baseline['settings'] != settings:
+            print(f'warning: baseline was run with {baseline["settings"]}', file=sys.stderr)
+        if compare(results, baseline['results'], args.tolerance):
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
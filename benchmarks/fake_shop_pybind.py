@@ -0,0 +1,383 @@
+import json
+import os
+import sys
+import time
+from datetime import datetime
+
+import numpy as np
+
+# Pure python stand-in for pyshop.shop_pybind.ShopCore, for measuring the server without a licensed SHOP binary. It
+# implements the methods pyshop and restshop call: the object and attribute registry, relations, scalar, array, xy
+# and txy storage, time resolution, yaml dumps and commands. Commands do no optimization, they sleep for
+# FAKE_SHOP_COMMAND_SLEEP seconds (or ShopCore.command_sleep) and "start sim" fills every output series.
+#
+# install() makes `import pyshop.shop_pybind` return this module, call it before restshop is imported. To use it in
+# worker processes as well, put this directory on PYTHONPATH so that the sitecustomize next to it installs it. pyshop
+# itself must be installed for that, e.g. pip install SDK/.
+
+_INFO_KEYS = ['isInput', 'isOutput', 'datatype', 'xUnit', 'yUnit', 'licenseName', 'fullName', 'dataFuncName',
+              'description', 'documentationUrl', 'exampleUrlPrefix', 'example']
+
+# object_type -> [(attribute_name, datatype, is_input, is_output, x_unit, y_unit)]
+_TYPES = {
+    'reservoir': [
+        ('max_vol', 'double', True, False, 'NO_UNIT', 'MM3'),
+        ('lrl', 'double', True, False, 'NO_UNIT', 'METER'),
+        ('hrl', 'double', True, False, 'NO_UNIT', 'METER'),
+        ('start_head', 'double', True, False, 'NO_UNIT', 'METER'),
+        ('vol_head', 'xy', True, False, 'MM3', 'METER'),
+        ('flow_descr', 'xy', True, False, 'METER', 'M3/S'),
+        ('water_value_input', 'xy_array', True, False, 'MM3', 'NOK/MM3'),
+        ('energy_value_input', 'double', True, False, 'NO_UNIT', 'NOK/MWH'),
+        ('inflow', 'txy', True, False, 'NO_UNIT', 'M3/S'),
+        ('storage', 'txy', False, True, 'NO_UNIT', 'MM3'),
+    ],
+    'plant': [
+        ('outlet_line', 'double', True, False, 'NO_UNIT', 'METER'),
+        ('main_loss', 'double_array', True, False, 'NO_UNIT', 'S2/M5'),
+        ('penstock_loss', 'double_array', True, False, 'NO_UNIT', 'S2/M5'),
+        ('production', 'txy', False, True, 'NO_UNIT', 'MW'),
+        ('discharge', 'txy', False, True, 'NO_UNIT', 'M3/S'),
+    ],
+    'generator': [
+        ('penstock', 'int', True, False, 'NO_UNIT', 'NO_UNIT'),
+        ('p_min', 'double', True, False, 'NO_UNIT', 'MW'),
+        ('p_max', 'double', True, False, 'NO_UNIT', 'MW'),
+        ('p_nom', 'double', True, False, 'NO_UNIT', 'MW'),
+        ('startcost', 'double', True, False, 'NO_UNIT', 'NOK'),
+        ('gen_eff_curve', 'xy', True, False, 'MW', '%'),
+        ('turb_eff_curves', 'xy_array', True, False, 'M3/S', '%'),
+        ('production', 'txy', False, True, 'NO_UNIT', 'MW'),
+        ('discharge', 'txy', False, True, 'NO_UNIT', 'M3/S'),
+    ],
+    'market': [
+        ('sale_price', 'txy', True, False, 'NO_UNIT', 'NOK/MWH'),
+        ('buy_price', 'txy', True, False, 'NO_UNIT', 'NOK/MWH'),
+        ('max_buy', 'txy', True, False, 'NO_UNIT', 'MW'),
+        ('max_sale', 'txy', True, False, 'NO_UNIT', 'MW'),
+    ],
+    'gate': [
+        ('max_discharge', 'double', True, False, 'NO_UNIT', 'M3/S'),
+    ],
+}
+
+_RELATIONS = {
+    'reservoir': ['connection_standard', 'connection_spill', 'connection_bypass'],
+    'plant': ['connection_standard', 'generator_of_plant'],
+    'generator': [],
+    'market': [],
+    'gate': ['connection_standard'],
+}
+
+# relations between these types carry water and are directed, the others are logical and seen from both ends
+_PHYSICAL_TYPES = {'reservoir', 'plant', 'gate'}
+
+_COMMANDS = ['start sim', 'set code', 'set method', 'penalty flag', 'set time_delay_unit', 'return simres']
+
+
+def install():
+    import pyshop
+    sys.modules['pyshop.shop_pybind'] = sys.modules[__name__]
+    pyshop.shop_pybind = sys.modules[__name__]
+
+
+class ShopCore(object):
+
+    command_sleep = float(os.environ.get('FAKE_SHOP_COMMAND_SLEEP', '0'))
+
+    def __init__(self, silent_console=True, silent_log=True, log_file='', log_gets=True):
+        self._names = []
+        self._types = []
+        # (object_type, name) -> index into _names and _types
+        self._indices = {}
+        self._values = {}
+        self._relations = []
+        self._time = None
+        self._messages = []
+        self._executed = []
+        self._update_needed = False
+
+    # --- system
+    def GetVersionString(self):
+        return '14.0.0.0 fake'
+
+    def OverrideDllPath(self, path):
+        pass
+
+    def UpdateNeeded(self):
+        needed, self._update_needed = self._update_needed, False
+        return needed
+
+    def GetObjectTypeNames(self):
+        return list(_TYPES)
+
+    def GetValidObjectInfoKeys(self):
+        return ['isInput']
+
+    def GetObjectInfo(self, object_type, key):
+        return True
+
+    def GetValidAttributeInfoKeys(self):
+        return list(_INFO_KEYS)
+
+    def _attr(self, object_type, attr_name):
+        for a in _TYPES[object_type]:
+            if a[0] == attr_name:
+                return a
+        raise ValueError(attr_name)
+
+    def GetAttributeInfo(self, object_type, attr_name, key):
+        name, datatype, is_input, is_output, x_unit, y_unit = self._attr(object_type, attr_name)
+        return {
+            'isInput': is_input, 'isOutput': is_output, 'datatype': datatype, 'xUnit': x_unit, 'yUnit': y_unit,
+            'licenseName': 'SHOP_OPEN', 'fullName': f'{object_type}_{name}', 'dataFuncName': '',
+            'description': '', 'documentationUrl': '', 'exampleUrlPrefix': '', 'example': '',
+        }[key]
+
+    def GetObjectTypeAttributeNames(self, object_type):
+        return [a[0] for a in _TYPES[object_type]]
+
+    def GetObjectTypeAttributeDatatypes(self, object_type):
+        return [a[1] for a in _TYPES[object_type]]
+
+    def GetObjectNamesInSystem(self):
+        return list(self._names)
+
+    def GetObjectTypesInSystem(self):
+        return list(self._types)
+
+    def AddObject(self, object_type, name):
+        if (object_type, name) in self._indices:
+            raise ValueError(f'{object_type} {name} already exists')
+        self._indices[(object_type, name)] = len(self._names)
+        self._names.append(name)
+        self._types.append(object_type)
+
+    def _index(self, object_type, name):
+        if (object_type, name) not in self._indices:
+            raise ValueError(f'{object_type} {name} does not exist')
+        return self._indices[(object_type, name)]
+
+    # --- relations
+    def GetValidRelationTypes(self, object_type):
+        return list(_RELATIONS.get(object_type, []))
+
+    def GetDefaultRelationType(self, from_type, to_type):
+        if from_type == 'plant' and to_type == 'generator':
+            return 'generator_of_plant'
+        return 'connection_standard'
+
+    def GetRelationInfo(self, from_type, to_type, key):
+        return 'physical' if from_type in _PHYSICAL_TYPES and to_type in _PHYSICAL_TYPES else 'logical'
+
+    def AddRelation(self, from_type, from_name, relation_type, to_type, to_name):
+        edge = (self._index(from_type, from_name), relation_type, self._index(to_type, to_name))
+        if edge not in self._relations:
+            self._relations.append(edge)
+
+    def _logical(self, f, t):
+        return self.GetRelationInfo(self._types[f], self._types[t], 'relationCategory') == 'logical'
+
+    def GetRelations(self, object_type, name, relation_type):
+        i = self._index(object_type, name)
+        return [t for f, r, t in self._relations if f == i and r == relation_type] + \
+               [f for f, r, t in self._relations if t == i and r == relation_type and self._logical(f, t)]
+
+    def GetInputRelations(self, object_type, name, relation_type):
+        i = self._index(object_type, name)
+        return [f for f, r, t in self._relations if t == i and r == relation_type] + \
+               [t for f, r, t in self._relations if f == i and r == relation_type and self._logical(f, t)]
+
+    # --- scalar values
+    def _get(self, object_type, name, attr, default):
+        return self._values.get((self._index(object_type, name), attr), default)
+
+    def _set(self, object_type, name, attr, value):
+        self._values[(self._index(object_type, name), attr)] = value
+
+    def GetIntValue(self, t, n, a):
+        return self._get(t, n, a, 0)
+
+    def SetIntValue(self, t, n, a, v):
+        self._set(t, n, a, int(v))
+
+    def GetDoubleValue(self, t, n, a):
+        return self._get(t, n, a, 0.0)
+
+    def SetDoubleValue(self, t, n, a, v):
+        self._set(t, n, a, float(v))
+
+    def GetStringValue(self, t, n, a):
+        return self._get(t, n, a, '')
+
+    def SetStringValue(self, t, n, a, v):
+        self._set(t, n, a, str(v))
+
+    def GetIntArray(self, t, n, a):
+        return list(self._get(t, n, a, []))
+
+    def SetIntArray(self, t, n, a, v):
+        self._set(t, n, a, [int(x) for x in v])
+
+    def GetDoubleArray(self, t, n, a):
+        return list(self._get(t, n, a, []))
+
+    def SetDoubleArray(self, t, n, a, v):
+        self._set(t, n, a, [float(x) for x in v])
+
+    # --- curves
+    def SetXyCurve(self, t, n, a, ref, x, y):
+        self._set(t, n, a, (float(ref), np.asarray(x, dtype=float), np.asarray(y, dtype=float)))
+
+    def GetXyCurveReference(self, t, n, a):
+        return self._get(t, n, a, (0.0, None, None))[0]
+
+    def GetXyCurveX(self, t, n, a):
+        return self._get(t, n, a, (0.0, np.empty(0), None))[1]
+
+    def GetXyCurveY(self, t, n, a):
+        return self._get(t, n, a, (0.0, None, np.empty(0)))[2]
+
+    def SetXyCurveArray(self, t, n, a, ref, npoints, x, y):
+        self._set(t, n, a, (np.asarray(ref, dtype=float), np.asarray(npoints, dtype=int),
+                            np.asarray(x, dtype=float), np.asarray(y, dtype=float)))
+
+    def _xy_array(self, t, n, a):
+        return self._get(t, n, a, (np.empty(0), np.empty(0, dtype=int), np.empty(0), np.empty(0)))
+
+    def GetXyCurveArrayReferences(self, t, n, a):
+        return self._xy_array(t, n, a)[0]
+
+    def GetXyCurveArrayNPoints(self, t, n, a):
+        return self._xy_array(t, n, a)[1]
+
+    def GetXyCurveArrayX(self, t, n, a):
+        return self._xy_array(t, n, a)[2]
+
+    def GetXyCurveArrayY(self, t, n, a):
+        return self._xy_array(t, n, a)[3]
+
+    def GetXyTCurveTimes(self, t, n, a):
+        return []
+
+    def GetXyTCurveX(self, t, n, a, start, end):
+        return []
+
+    def GetXyTCurveY(self, t, n, a, start, end):
+        return []
+
+    def GetXyTCurveN(self, t, n, a, start, end):
+        return []
+
+    # --- time series
+    def _steps(self, start_string=None):
+        # number of time steps in the horizon, and the offset of start_string from its start
+        start = datetime.strptime(self._time[0][:14], '%Y%m%d%H%M%S')
+        end = datetime.strptime(self._time[1][:14], '%Y%m%d%H%M%S')
+        div = 3600 if self._time[2] == 'hour' else 60
+        offset = 0
+        if start_string:
+            offset = int((datetime.strptime(start_string[:14], '%Y%m%d%H%M%S') - start).total_seconds() // div)
+        return max(int((end - start).total_seconds() // div), 1), offset
+
+    def SetTxySeries(self, t, n, a, start, tt, y):
+        # like SHOP, store the series expanded to every time step of the horizon
+        y = np.asarray(y, dtype=float)
+        if y.ndim == 1:
+            y = y.reshape(-1, 1)
+        tt = np.asarray(tt, dtype=int)
+        if tt.size == 0:
+            self._set(t, n, a, ('', np.empty(0, dtype=int), np.empty((0, 1))))
+            return
+        steps, offset = self._steps(start)
+        full_t = np.arange(steps)
+        idx = np.searchsorted(tt + offset, full_t, side='right') - 1
+        full_y = y[np.clip(idx, 0, None)]
+        self._set(t, n, a, (self._time[0], full_t, full_y))
+
+    def GetTxySeriesStartTime(self, t, n, a):
+        return self._get(t, n, a, ('', None, None))[0]
+
+    def GetTxySeriesT(self, t, n, a):
+        return self._get(t, n, a, ('', np.empty(0, dtype=int), None))[1]
+
+    def GetTxySeriesY(self, t, n, a):
+        y = self._get(t, n, a, ('', None, np.empty((0, 1))))[2]
+        return y[:, 0] if y.shape[1] == 1 else y
+
+    def SetTimeResolution(self, start, end, unit, t=None, y=None):
+        self._time = (start, end, unit, list(t) if t is not None else [0], list(y) if y is not None else [1])
+
+    def GetStartTime(self):
+        return self._time[0]
+
+    def GetEndTime(self):
+        return self._time[1]
+
+    def GetTimeUnit(self):
+        return self._time[2]
+
+    def GetTimeResolutionT(self):
+        return np.asarray(self._time[3], dtype=int)
+
+    def GetTimeResolutionY(self):
+        return np.asarray(self._time[4], dtype=float)
+
+    # --- commands
+    def GetCommandTypesInSystem(self):
+        return list(_COMMANDS)
+
+    def ExecuteCommand(self, command, options, values):
+        if ShopCore.command_sleep:
+            time.sleep(ShopCore.command_sleep)
+        self._executed.append(' '.join([command] + ['/' + o for o in options] + list(values)))
+        self._messages.append({'message': f'executed {command}', 'severity': 'INFO'})
+        if command == 'start sim' and self._time:
+            steps, _ = self._steps()
+            for i, (name, object_type) in enumerate(zip(self._names, self._types)):
+                for attr in _TYPES[object_type]:
+                    if attr[3]:
+                        self._values[(i, attr[0])] = (self._time[0], np.arange(steps), np.full((steps, 1), float(i)))
+        return True
+
+    def ExecuteCommandList(self, commands, options, values):
+        return [self.ExecuteCommand(c, o, v) for c, o, v in zip(commands, options, values)]
+
+    def GetExecutedCommands(self):
+        return list(self._executed)
+
+    def GetMessages(self):
+        messages, self._messages = self._messages, []
+        return json.dumps(messages)
+
+    # --- yaml
+    def DumpYamlString(self, input_only=False, compress_txy=False, compress_connection=False):
+        def encode(v):
+            if isinstance(v, tuple):
+                return [encode(e) for e in v]
+            if isinstance(v, np.ndarray):
+                return {'array': v.tolist(), 'dtype': str(v.dtype)}
+            return v
+        return json.dumps({
+            'names': self._names, 'types': self._types, 'relations': self._relations, 'time': self._time,
+            'values': [[i, a, encode(v)] for (i, a), v in self._values.items()],
+        })
+
+    def ReadYamlString(self, s):
+        def decode(v):
+            if isinstance(v, dict) and 'array' in v:
+                return np.asarray(v['array'], dtype=v['dtype'])
+            if isinstance(v, list):
+                return tuple(decode(e) for e in v)
+            return v
+        d = json.loads(s)
+        self._names, self._types = d['names'], d['types']
+        self._indices = {(t, n): i for i, (n, t) in enumerate(zip(self._names, self._types))}
+        self._relations = [tuple(r) for r in d['relations']]
+        self._time = tuple(d['time']) if d['time'] else None
+        self._values = {(i, a): decode(v) for i, a, v in d['values']}
+        self._update_needed = True
+
+    def DumpYamlCase(self, path, input_only=False, compress_txy=False, compress_connection=False):
+        with open(path, 'w') as f:
+            f.write(self.DumpYamlString(input_only, compress_txy, compress_connection))
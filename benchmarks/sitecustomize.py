@@ -0,0 +1,10 @@
+import sys
+
+# Installs the fake ShopCore in every python process started with this directory on PYTHONPATH, including the worker
+# processes of restshop.workers, see fake_shop_pybind
+
+try:
+    import fake_shop_pybind
+    fake_shop_pybind.install()
+except ImportError as e:
+    print(f'fake ShopCore not installed: {e}', file=sys.stderr)
@@ -1,26 +1,48 @@
+import hashlib
 from datetime import datetime, timedelta
 from typing import Optional, List, Union, Any, Dict
 
-from fastapi import Depends, FastAPI, HTTPException, status, Body, Query
+from fastapi import Depends, FastAPI, HTTPException, status, Body, Query, Response, Request
 from fastapi.security import OAuth2PasswordBearer, OAuth2PasswordRequestForm
+from fastapi.responses import JSONResponse, ORJSONResponse, StreamingResponse
 
 from jose import JWTError, jwt
 from passlib.context import CryptContext
-from pydantic import BaseModel, Field
+from pydantic import BaseModel, Field, ValidationError, parse_raw_as
 
 from fastapi.openapi.models import SchemaBase
 
 import restshop
+from restshop import config
+from restshop import operations
+from restshop.operations import http_raise_internal
 from restshop.sessions import SessionManager
+from restshop.cache import PayloadKey
+from restshop.jobs import JobManager
+from restshop import columnar
+from restshop.compression import CompressionMiddleware
+from restshop.profiling import ProfilingMiddleware
+from restshop.locking import SessionLockMiddleware
+from restshop import metrics
+from restshop import messages
+from restshop import sweeps
+from restshop.evictor import session_evictor
+from restshop.workers import FORK_AVAILABLE
 from restshop.schemas import *
 
 from enum import Enum
 
 from fastapi import Path, Header
+from fastapi.concurrency import run_in_threadpool
 
 import pandas as pd
 import numpy as np
 
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
 def shop_session(user_name: str, session_id: str):
     return SessionManager.get_shop_session(user_name, session_id)
 
@@ -38,6 +60,7 @@ if __name__ == 'main':
         title="REST SHOP",
         description=api_description,
         version=restshop.__version__,
+        default_response_class=ORJSONResponse if orjson is not None else JSONResponse,
         openapi_tags=[
             {
                 'name': 'Authentication',
@@ -62,10 +85,32 @@ if __name__ == 'main':
             {
                 'name': 'Simulation',
                 'description': 'Interact with the simulation using SHOP commands',
+            },
+            {
+                'name': 'Jobs',
+                'description': 'Follow simulation commands that were started with run_as_job',
+            },
+            {
+                'name': 'Metrics',
+                'description': 'Server metrics in the Prometheus text format',
             }
         ]
     )
 
+    app.add_middleware(SessionLockMiddleware, queue_limit=config.SESSION_QUEUE_LIMIT)
+    app.add_middleware(ProfilingMiddleware)
+    app.add_middleware(CompressionMiddleware, minimum_size=config.COMPRESSION_MIN_SIZE)
+    app.add_middleware(metrics.MetricsMiddleware)
+
+    @app.on_event('startup')
+    async def start_background_tasks():
+        # pre-warm shop sessions while the server is idle, see RESTSHOP_SESSION_POOL_SIZE
+        if SessionManager.session_pool:
+            SessionManager.session_pool.start()
+        # dump idle sessions to disk, see RESTSHOP_SESSION_IDLE_TTL and RESTSHOP_SESSION_MEMORY_BUDGET_MB
+        if session_evictor:
+            session_evictor.start()
+
     fake_users_db = {
         "johndoe": {
             "username": "johndoe",
@@ -76,9 +121,6 @@ if __name__ == 'main':
         }
     }
 
-    def http_raise_internal(msg: str, e: Exception):
-        raise HTTPException(500, f'{msg} -- Internal Exception: {e}')
-
     def get_session_id(session_id: int = Header(1)) -> int:
         return session_id
 
@@ -86,6 +128,29 @@ if __name__ == 'main':
         is_set = SessionManager.get_user_session(test_user).shop_sessions_time_resolution_is_set[session_id]
         if is_set == False:
             raise HTTPException(400, 'First you must set the time_resolution of the session')
+
+    def is_not_modified(if_none_match: Optional[str], etag: str) -> bool:
+        # If-None-Match holds a list of etags, possibly weak, or *
+        if not if_none_match:
+            return False
+        tags = [t.strip() for t in if_none_match.split(',')]
+        return '*' in tags or etag in [t[2:] if t.startswith('W/') else t for t in tags]
+
+    async def check_model_object(session_id: int, key: PayloadKey, *args):
+        # a matching If-None-Match, * included, is only answered with 304 for an object that exists. Its cached payload
+        # tells, otherwise the session looks it up and fails like the GET would.
+        if not SessionManager.is_cached(test_user, session_id, key):
+            await SessionManager.call(test_user, session_id, operations.check_model_object, *args)
+
+    def json_response(content: bytes, response_model: Any, headers: Optional[Dict[str, str]] = None) -> Response:
+        # for payloads serialized in restshop.operations, the response_model of such routes only documents the shape.
+        # Checked against it when RESTSHOP_VALIDATE_RESPONSES is set.
+        if config.VALIDATE_RESPONSES:
+            try:
+                parse_raw_as(response_model, content)
+            except ValidationError as e:
+                http_raise_internal('response does not match its schema', e)
+        return Response(content=content, media_type='application/json', headers=headers)
         
 
     test_user = 'test_user'
@@ -179,7 +244,7 @@ if __name__ == 'main':
 
     @app.post("/session", tags=['Session'])
     async def create_session(s: Session = Body(Session(session_name='unnamed'), example={'name': 'unnamed'})):
-        s = SessionManager.add_shop_session(test_user, session_name=s.session_name)
+        s = await run_in_threadpool(SessionManager.add_shop_session, test_user, session_name=s.session_name)
         return Session(session_id = s._id, session_name=s._name)
 
 
@@ -202,6 +267,35 @@ if __name__ == 'main':
             raise HTTPException(404, f'Session with id {{{session_id}}} not found')
 
 
+    @app.post("/session/{session_id}/clone", response_model=Session, tags=['Session'])
+    async def clone_session(
+        session_id: int,
+        session_name: Optional[str] = Query(None, description='name of the clone, defaults to the name of the cloned session'),
+        method: CloneMethodEnum = Query(CloneMethodEnum.auto, description='fork the worker process hosting the session, or copy the model through yaml. auto forks when possible'),
+        ):
+        if session_id not in SessionManager.get_shop_sessions(test_user):
+            raise HTTPException(404, f'Session with id {{{session_id}}} not found')
+        can_fork = SessionManager.worker_pool is not None and FORK_AVAILABLE
+        if method == CloneMethodEnum.fork and not can_fork:
+            raise HTTPException(400, f'clone method {{{method.value}}} requires worker processes and os.fork')
+        fork = method == CloneMethodEnum.fork or (method == CloneMethodEnum.auto and can_fork)
+
+        name = session_name or shop_session(test_user, session_id)._name
+        s = await run_in_threadpool(SessionManager.clone_shop_session, test_user, session_id, name, fork)
+        return Session(session_id = s._id, session_name = s._name)
+
+
+    @app.delete("/session", response_model=Session, tags=['Session'])
+    async def remove_session(session_id: int = Query(...)):
+        if session_id not in SessionManager.get_shop_sessions(test_user):
+            raise HTTPException(404, f'Session with id {{{session_id}}} not found')
+        s = shop_session(test_user, session_id)
+        removed = Session(session_id = s._id, session_name = s._name)
+        await run_in_threadpool(SessionManager.remove_shop_session, test_user, session_id)
+        JobManager.jobs.pop((test_user, session_id), None)
+        return removed
+
+
     # --------- time_resolution
 
     class TimeResolution(BaseModel):
@@ -230,10 +324,11 @@ if __name__ == 'main':
         if (end <= start):
             raise HTTPException(400, 'end_time must be strictly greater than start_time')
 
-        shop_session(test_user, session_id).set_time_resolution(
-            starttime=time_resolution.start_time,
-            endtime=time_resolution.end_time,
-            timeunit=time_resolution.time_unit # TODO: also use time_resolution series
+        await SessionManager.call(
+            test_user, session_id, operations.set_time_resolution,
+            time_resolution.start_time,
+            time_resolution.end_time,
+            time_resolution.time_unit # TODO: also use time_resolution series
         )
 
 
@@ -244,10 +339,19 @@ if __name__ == 'main':
 
 
     @app.get("/time_resolution", response_model=TimeResolution, dependencies=[Depends(check_that_time_resolution_is_set)], tags=["Time Resolution"])
-    async def get_time_resolution(session_id = Depends(get_session_id)):
+    async def get_time_resolution(
+        response: Response,
+        if_none_match: Optional[str] = Header(None),
+        session_id = Depends(get_session_id)
+        ):
+
+        etag = SessionManager.get_etag(test_user, session_id)
+        if is_not_modified(if_none_match, etag):
+            return Response(status_code=304, headers={'ETag': etag})
+        response.headers['ETag'] = etag
 
         try:
-            tr = shop_session(test_user, session_id).get_time_resolution()
+            tr = await SessionManager.call(test_user, session_id, operations.get_time_resolution)
         except HTTPException as e:
             raise e
         except Exception as e:
@@ -264,68 +368,59 @@ if __name__ == 'main':
 
     @app.get("/model", response_model=Model, response_model_exclude_unset=True, tags=['Model'])
     async def get_model_object_types(session_id = Depends(get_session_id)):
-        types = list(shop_session(test_user, session_id).model._all_types)
+        types = await SessionManager.call(test_user, session_id, operations.get_model_object_types)
         return Model(object_types = types)
 
+    @app.put("/model", response_model=ModelUpsertStatus, response_model_exclude_none=True, dependencies=[Depends(check_that_time_resolution_is_set)], tags=['Model'])
+    async def create_or_modify_model(
+        model: ModelUpsert = Body(
+            ...,
+            example={
+                'objects': [
+                    {'object_type': 'reservoir', 'object_name': 'Reservoir1', 'attributes': {'max_vol': 12, 'lrl': 90, 'hrl': 100}},
+                    {'object_type': 'plant', 'object_name': 'Plant1', 'attributes': {'outlet_line': 40}}
+                ],
+                'connections': [
+                    {
+                        'from_object': {'object_type': 'reservoir', 'object_name': 'Reservoir1'},
+                        'to_object': {'object_type': 'plant', 'object_name': 'Plant1'}
+                    }
+                ]
+            }
+        ),
+        return_objects: bool = Query(False, description='also return the full object instances, this is expensive for large models'),
+        session_id = Depends(get_session_id)
+        ):
+
+        touched = [(o.object_type, o.object_name) for o in model.objects]
+        touched += [(c.from_object.object_type, c.from_object.object_name) for c in model.connections]
+        touched += [(c.to_object.object_type, c.to_object.object_name) for c in model.connections]
+        return await SessionManager.call(
+            test_user, session_id, operations.upsert_model, model, return_objects, invalidates=touched
+        )
+
     # ------ object_type
 
     @app.get("/model/{object_type}/information", response_model=ObjectType, response_model_exclude_unset=True, tags=['Model'])
     async def get_model_object_type_information(
         object_type: ObjectTypeEnum,
         attribute_filter: str = Query('*', description='filter attributes by regex'),
+        attributes: Optional[List[str]] = Query(None, description='only include these attributes'),
+        inputs_only: bool = Query(False, description='only include input attributes'),
+        outputs_only: bool = Query(False, description='only include output attributes'),
         verbose: bool = Query(False, description='toggles additional attribute information, e.g is_input, is_output, etc ...'),
+        if_none_match: Optional[str] = Header(None),
         session_id = Depends(get_session_id)
     ):
 
-        if attribute_filter != '*':
-            raise HTTPException(500, 'setting attribute_filter != * is not support yet')
-
-        ot = SessionManager.get_model_object_generator(test_user, session_id, object_type)
-        instances = list(ot.get_object_names())
-        sess = shop_session(test_user, session_id)
-        attribute_names: List[str] = list(sess.shop_api.GetObjectTypeAttributeNames(object_type))
-        attribute_types: List[str] = list(sess.shop_api.GetObjectTypeAttributeDatatypes(object_type))
-
-        if not verbose:
-            attributes = {
-                n: new_attribute_type_name_from_old(t)
-                for n, t in zip(attribute_names, attribute_types)
-            }
-        else:
-
-            # TODO: Create this kind of dictionary once at startup, since this might be expensive?
-            attr_info = {
-                attr_name: {
-                    info_key: sess.shop_api.GetAttributeInfo(object_type, attr_name, info_key)
-                    for info_key in sess.shop_api.GetValidAttributeInfoKeys()
-                } for attr_name in attribute_names
-            }
-
-            attributes = {
-                n: ObjectAttribute(
-                    attribute_name = n,
-                    attribute_type = new_attribute_type_name_from_old(t),
-                    is_input = attr_info[n]['isInput'],
-                    is_output = attr_info[n]['isOutput'],
-                    legacy_datatype = attr_info[n]['datatype'],
-                    x_unit = attr_info[n]['xUnit'],
-                    y_unit = attr_info[n]['yUnit'],
-                    license_name = attr_info[n]['licenseName'],
-                    full_name = attr_info[n]['fullName'],
-                    data_func_name = attr_info[n]['dataFuncName'],
-                    description = attr_info[n]['description'],
-                    documentation_url = attr_info[n]['documentationUrl'],
-                    example_url_prefix = attr_info[n]['exampleUrlPrefix'],
-                    example = attr_info[n]['example']
-                )
-                for n, t in zip(attribute_names, attribute_types)
-            }
-
-        return ObjectType(
-            object_type = object_type,
-            instances = instances, 
-            attributes = attributes,
+        # served as pre-serialized bytes, the response_model only documents the shape
+        content, etag = await SessionManager.call(
+            test_user, session_id, operations.get_model_object_type_information, object_type, verbose,
+            attribute_filter, attributes, inputs_only, outputs_only
         )
+        if is_not_modified(if_none_match, etag):
+            return Response(status_code=304, headers={'ETag': etag})
+        return json_response(content, ObjectType, headers={'ETag': etag})
 
     # ------ object_name
 
@@ -361,145 +456,155 @@ if __name__ == 'main':
         session_id = Depends(get_session_id)
         ):
         
-        session = shop_session(test_user, session_id)
-        try:
-            object_generator = session.model[object_type]
-        except Exception as e:
-            raise HTTPException(500, f'model does not implement object_type {{{object_type}}}') 
-
-        if object_name not in object_generator.get_object_names():
-            try:
-                object_generator.add_object(object_name)
-            except Exception as e:
-                raise HTTPException(500, f'object_name {{{object_name}}} is in conflict with existing instance')
-
-        model_object = session.model[object_type][object_name]
-
-        if object_instance and object_instance.attributes:
-            for (k,v) in object_instance.attributes.items():
-
-                try:
-                    datatype = model_object[k].info()['datatype']
-                except Exception as e:
-                    http_raise_internal(f'unknown object_attribute {k} for object_type {object_type}', e)
-
-                if datatype == 'txy':
-
-                    # convert scalar values to TimeSeries
-                    if type(v) == float or type(v) == int:
-                        start_time = shop_session(test_user, session_id).get_time_resolution()['starttime']
-                        v = TimeSeries(
-                            timestamps=[start_time],
-                            values=[[v]]
-                        )
-                    try:
-                        time_series: TimeSeries = v
-                        # index, values = zip(*time_series.values.items())
-                        index, values = time_series.timestamps, np.transpose(time_series.values)
-                        df = pd.DataFrame(index=index, data=values)
-                        model_object[k].set(df)
-                    except Exception as e:
-                        http_raise_internal(f'trouble setting {{{datatype}}} ', e)
-
-                elif datatype == 'xy':
-                    try:
-                        curve: Curve = v
-                        ser = pd.Series(index=curve.x_values, data=curve.y_values)
-                        model_object[k].set(ser)
-                    except Exception as e:
-                        http_raise_internal(f'trouble setting {{{datatype}}} ', e)
-
-                elif datatype in ['xy_array', 'xyn']:
-                    try:
-                        curves: OrderedDict[float, Curve] = v
-                        ser_list = []
-                        for ref, curve in curves.items():
-                            ser_list += [pd.Series(index=curve.x_values, data=curve.y_values, name=ref)]
-                        model_object[k].set(ser_list)
-                    except Exception as e:
-                        http_raise_internal(f'trouble setting {{{datatype}}} ', e)
-
-                elif datatype == 'xyt':
-                    try:
-                        curves: OrderedDict[datetime, Curve] = v
-                        ser_list = []
-                        for ref, curve in curves.items():
-                            ser_list += [pd.Series(index=curve.x_values, data=curve.y_values, name=ref)]
-                        model_object[k].set(ser_list)
-                    except Exception as e:
-                        http_raise_internal(f'trouble setting {{{datatype}}} ', e)
-                    
-                elif datatype == 'double':
-                    model_object[k].set(float(v))
-
-                elif datatype == 'int':
-                    model_object[k].set(int(v))
-
-                else:
-                    try:
-                        model_object[k].set(v)
-                    except Exception as e:
-                        http_raise_internal(f'trouble setting {{{datatype}}} ', e)
-
-        o = SessionManager.get_model_object_instance(test_user, session_id, object_type, object_name)
-        return serialize_model_object_instance(o)
+        content = await SessionManager.call(
+            test_user, session_id, operations.create_or_modify_model_object_instance,
+            object_type, object_name, object_instance.attributes if object_instance else None,
+            invalidates=[(object_type, object_name)]
+        )
+        return json_response(content, ObjectInstance)
 
     @app.get("/model/{object_type}", response_model=ObjectInstance, dependencies=[Depends(check_that_time_resolution_is_set)], tags=['Model'])
     async def get_model_object_instance(
         object_type: ObjectTypeEnum,
         object_name: str = Query('example_reservoir'),
         attribute_filter: str = Query('*', description='filter attributes by regex'),
+        attributes: Optional[List[str]] = Query(None, description='only include these attributes'),
+        inputs_only: bool = Query(False, description='only include input attributes'),
+        outputs_only: bool = Query(False, description='only include output attributes'),
+        if_none_match: Optional[str] = Header(None),
+        session_id = Depends(get_session_id)
+        ):
+
+        # answered from the session version when the client already has the current object
+        etag = SessionManager.get_etag(test_user, session_id)
+        selection = ('instance', attribute_filter, tuple(attributes or ()), inputs_only, outputs_only)
+        key = (object_type, object_name, selection, columnar.JSON)
+        if is_not_modified(if_none_match, etag):
+            await check_model_object(
+                session_id, key, object_type, object_name, attribute_filter, attributes, inputs_only, outputs_only
+            )
+            return Response(status_code=304, headers={'ETag': etag})
+
+        content = await SessionManager.call_cached(
+            test_user, session_id, key,
+            operations.get_model_object_instance_serialized, object_type, object_name,
+            attribute_filter, attributes, inputs_only, outputs_only
+        )
+        return json_response(content, ObjectInstance, headers={'ETag': etag})
+
+    @app.get("/model/{object_type}/attributes/{attribute_name}", response_model=AttributeValue,
+        dependencies=[Depends(check_that_time_resolution_is_set)], tags=['Model'],
+        responses={200: {'content': {columnar.ARROW_STREAM: {}, columnar.NPY: {}}}})
+    async def get_model_object_attribute(
+        object_type: ObjectTypeEnum,
+        attribute_name: str,
+        object_name: str = Query('example_reservoir'),
+        accept: Optional[str] = Header(None),
+        if_none_match: Optional[str] = Header(None),
         session_id = Depends(get_session_id)
         ):
 
-        if attribute_filter != '*':
-            raise HTTPException(500, 'setting attribute_filter != * is not support yet')
+        # txy, xy, xy_array and xyt attributes are also available as Arrow IPC streams or .npy structured arrays
+        media_type = columnar.negotiate_media_type(accept)
+        headers = {'ETag': SessionManager.get_etag(test_user, session_id, media_type.split('/')[-1]), 'Vary': 'Accept'}
+        key = (object_type, object_name, ('attribute', attribute_name), media_type)
+        if is_not_modified(if_none_match, headers['ETag']):
+            await check_model_object(session_id, key, object_type, object_name, '*', [attribute_name])
+            return Response(status_code=304, headers=headers)
+
+        value = await SessionManager.call_cached(
+            test_user, session_id, key,
+            operations.get_model_object_attribute, object_type, object_name, attribute_name, media_type
+        )
+        if media_type == columnar.JSON:
+            return json_response(value, AttributeValue, headers=headers)
+        return Response(content=value, media_type=media_type, headers=headers)
 
-        o = SessionManager.get_model_object_instance(test_user, session_id, object_type, object_name)
-        return serialize_model_object_instance(o)
+    @app.put("/model/{object_type}/attributes/{attribute_name}", dependencies=[Depends(check_that_time_resolution_is_set)], tags=['Model'])
+    async def set_model_object_attribute(
+        request: Request,
+        object_type: ObjectTypeEnum,
+        attribute_name: str,
+        object_name: str = Query('example_reservoir'),
+        content_type: Optional[str] = Header(None),
+        session_id = Depends(get_session_id)
+        ):
 
+        # the body is an Arrow IPC stream or a .npy structured array, json values are set through PUT /model/{object_type}
+        media_type = (content_type or '').split(';')[0].strip()
+        content = await request.body()
+        await SessionManager.call(
+            test_user, session_id, operations.set_model_object_attribute, object_type, object_name, attribute_name,
+            content, media_type, invalidates=[(object_type, object_name)]
+        )
 
-    # ------ connection
+    @app.patch("/model/{object_type}/attributes/{attribute_name}", dependencies=[Depends(check_that_time_resolution_is_set)], tags=['Model'])
+    async def patch_model_object_attribute(
+        request: Request,
+        object_type: ObjectTypeEnum,
+        attribute_name: str,
+        object_name: str = Query('example_reservoir'),
+        end_time: Optional[datetime] = Query(None, description='end of the replaced window, defaults to one time step after the last timestamp of the patch'),
+        content_type: Optional[str] = Header(None),
+        session_id = Depends(get_session_id)
+        ):
 
+        # replaces a window of a txy attribute, the body is a TimeSeries or an Arrow IPC stream or .npy structured array
+        # with columns time, y_0, ..., y_n
+        media_type = (content_type or columnar.JSON).split(';')[0].strip()
+        content = await request.body()
+        await SessionManager.call(
+            test_user, session_id, operations.patch_model_object_attribute, object_type, object_name, attribute_name,
+            content, media_type, end_time, invalidates=[(object_type, object_name)]
+        )
 
-    @app.get("/connections", response_model=List[Connection], dependencies=[Depends(check_that_time_resolution_is_set)], tags=['Connections'])
-    async def get_connections(session_id = Depends(get_session_id)):
+    @app.post("/model/query", response_model=Dict[str, List[Any]],
+        dependencies=[Depends(check_that_time_resolution_is_set)], tags=['Model'],
+        responses={200: {'content': {columnar.ARROW_STREAM: {}, columnar.NPY: {}}}})
+    async def query_model_attributes(
+        query: AttributeQuery,
+        accept: Optional[str] = Header(None),
+        if_none_match: Optional[str] = Header(None),
+        session_id = Depends(get_session_id)
+        ):
 
-        connections = []
+        # a column time and one column per object_type.object_name.attribute, as json, an Arrow IPC stream or a .npy
+        # structured array
+        media_type = columnar.negotiate_media_type(accept)
+        variant = hashlib.sha1(f'{query.json()}{media_type}'.encode()).hexdigest()[:16]
+        headers = {'ETag': SessionManager.get_etag(test_user, session_id, variant), 'Vary': 'Accept'}
+        if is_not_modified(if_none_match, headers['ETag']):
+            return Response(status_code=304, headers=headers)
 
-        for object_type in shop_session(test_user, session_id).model._all_types:
-            generator = SessionManager.get_model_object_generator(test_user, session_id, object_type)
-            for object_name in generator.get_object_names():
-                from_object = generator[object_name]
-                for relation_direction in RelationDirectionEnum:
-                    for relation_type in RelationTypeEnum:
-                        for r in from_object.get_relations(
-                            direction=relation_direction,
-                            relation_type=relation_type
-                        ):
-                            to_object = serialize_model_object_instance(r)
-                            connections += [Connection(
-                                from_object=serialize_model_object_instance(from_object),
-                                to_object=to_object,
-                                relation_type=relation_type,
-                                relation_direction=relation_direction,
-                            )]
+        content = await SessionManager.call(test_user, session_id, operations.query_model_attributes, query, media_type)
+        if media_type == columnar.JSON:
+            return json_response(content, Dict[str, List[Any]], headers=headers)
+        return Response(content=content, media_type=media_type, headers=headers)
 
-        return connections
+    # ------ connection
 
-    @app.put("/connections", dependencies=[Depends(check_that_time_resolution_is_set)], tags=['Connections'])
-    async def add_connections(connections: List[Connection], session_id = Depends(get_session_id)):
 
-        for connection in connections:
+    @app.get("/connections", response_model=Union[List[Connection], ConnectionGraph], response_model_exclude_none=True, dependencies=[Depends(check_that_time_resolution_is_set)], tags=['Connections'])
+    async def get_connections(
+        format: ConnectionFormatEnum = Query(ConnectionFormatEnum.connections, description='list of connections, edge_list or csr adjacency'),
+        if_none_match: Optional[str] = Header(None),
+        session_id = Depends(get_session_id)):
+
+        etag = SessionManager.get_etag(test_user, session_id)
+        if is_not_modified(if_none_match, etag):
+            return Response(status_code=304, headers={'ETag': etag})
 
-            fo_type, fo_name = connection.from_object.object_type, connection.from_object.object_name
-            to_type, to_name = connection.to_object.object_type, connection.to_object.object_name
-            relation_type = connection.relation_type if connection.relation_type != 'default' else ''
+        # the relation index is only built again when the session version changed
+        content = await SessionManager.call(test_user, session_id, operations.get_connections, format, etag)
+        response_model = List[Connection] if format == ConnectionFormatEnum.connections else ConnectionGraph
+        return json_response(content, response_model, headers={'ETag': etag})
 
-            fo = SessionManager.get_model_object_instance(test_user, session_id, fo_type, fo_name)
-            to = SessionManager.get_model_object_instance(test_user, session_id, to_type, to_name)
+    @app.put("/connections", dependencies=[Depends(check_that_time_resolution_is_set)], tags=['Connections'])
+    async def add_connections(connections: List[Connection], session_id = Depends(get_session_id)):
 
-            fo.connect(connection_type=relation_type)[to_type][to_name].add()
+        touched = [(c.from_object.object_type, c.from_object.object_name) for c in connections]
+        touched += [(c.to_object.object_type, c.to_object.object_name) for c in connections]
+        await SessionManager.call(test_user, session_id, operations.add_connections, connections, invalidates=touched)
 
     @app.put("/connect/{from_type}/{from_name}/{to_type}/{to_name}", dependencies=[Depends(check_that_time_resolution_is_set)], tags=['Connections'])
     async def add_connection(
@@ -510,19 +615,68 @@ if __name__ == 'main':
 
         connection_type = connection_type if connection_type != 'default' else ''
 
-        fo = SessionManager.get_model_object_instance(test_user, session_id, from_type, from_name)
-        to = SessionManager.get_model_object_instance(test_user, session_id, to_type, to_name)
-        fo.connect(connection_type=connection_type)[to_type][to_name].add()
+        await SessionManager.call(
+            test_user, session_id, operations.add_connection, from_type, from_name, to_type, to_name, connection_type,
+            invalidates=[(from_type, from_name), (to_type, to_name)]
+        )
 
     # ------ shop commands
 
-    @app.post("/simulation/{command}", response_model=CommandStatus, dependencies=[Depends(check_that_time_resolution_is_set)], tags=['Simulation'])
-    async def post_simulation_command(command: ShopCommandEnum, args: CommandArguments = None, session_id = Depends(get_session_id)):
+    @app.post("/simulation", response_model=CommandListStatus, dependencies=[Depends(check_that_time_resolution_is_set)], tags=['Simulation'])
+    async def post_simulation_command_list(
+        request: Request,
+        stop_on_error: bool = Query(True, description='skip the remaining commands after a command fails'),
+        content_type: Optional[str] = Header(None),
+        session_id = Depends(get_session_id)):
+
+        # the body is a CommandList, or the text of a SHOP run file with content type text/plain. The commands run one
+        # after the other in a single call to the session.
+        media_type = (content_type or '').split(';')[0].strip()
+        content = await request.body()
+        if media_type == 'text/plain':
+            commands = operations.parse_command_file(content.decode('iso-8859-1'))
+        else:
+            try:
+                commands = [dict(c.dict(), command=c.command.value) for c in CommandList.parse_raw(content).commands]
+            except ValidationError as e:
+                raise HTTPException(422, f'{e}')
+            except ValueError as e:
+                raise HTTPException(400, f'could not parse command list -- {e}')
+
+        results = await SessionManager.call(
+            test_user, session_id, operations.execute_command_list, commands, stop_on_error
+        )
+        status = all(r['status'] for r in results)
+        return CommandListStatus(
+            message=('ok' if status else 'something went wrong ...'),
+            status=status,
+            wall_seconds=sum(r['wall_seconds'] for r in results),
+            results=results
+        )
+
+    @app.post("/simulation/{command}", response_model=Union[Job, CommandStatus], dependencies=[Depends(check_that_time_resolution_is_set)], tags=['Simulation'])
+    async def post_simulation_command(
+        command: ShopCommandEnum,
+        response: Response,
+        args: CommandArguments = None,
+        run_as_job: bool = Query(False, description='return 202 with a job right away instead of waiting for the command to finish'),
+        session_id = Depends(get_session_id)):
+
+        # the body is optional, a command without options or values is run as is
+        if args is None:
+            args = CommandArguments()
+
+        if run_as_job:
+            job = JobManager.submit_command(test_user, session_id, command, args.options, args.values)
+            response.status_code = 202
+            return job.to_schema()
 
-        sess = shop_session(test_user, session_id)
-        sess._command = command
         try:
-            status: bool = sess._execute_command(args.options, args.values) # does this return anything
+            status: bool = await SessionManager.call(
+                test_user, session_id, operations.execute_command, command, args.options, args.values
+            ) # does this return anything
+        except HTTPException as e:
+            raise e
         except Exception as e:
             http_raise_internal('failed to execute simulation command', e)
         return CommandStatus(
@@ -530,19 +684,83 @@ if __name__ == 'main':
             status=status
         )
 
+    @app.get("/messages", response_class=StreamingResponse, tags=['Simulation'])
+    async def stream_messages(
+        follow: bool = Query(True, description='keep the stream open and send the messages of every command when it finishes'),
+        after: int = Query(0, description='only send messages with a larger id, overridden by Last-Event-ID'),
+        last_event_id: Optional[str] = Header(None),
+        session_id = Depends(get_session_id)):
+
+        # server sent events, one per SHOP message tagged with its command, with the message number as event id. A
+        # command's messages are sent when it finishes, never while it runs
+        log = SessionManager.get_message_log(test_user, session_id)
+        if last_event_id:
+            try:
+                after = int(last_event_id)
+            except ValueError:
+                raise HTTPException(400, f'Last-Event-ID {{{last_event_id}}} is not a message id')
+
+        async def events():
+            if not follow:
+                yield messages.format_events(log.since(after))
+                return
+            async for entries in log.follow(after):
+                yield messages.format_events(entries)
+
+        return StreamingResponse(events(), media_type='text/event-stream', headers={'Cache-Control': 'no-cache'})
+
+    # ------ sweeps
+
+    @app.post("/sweep", response_class=StreamingResponse, dependencies=[Depends(check_that_time_resolution_is_set)], tags=['Simulation'],
+        responses={200: {'content': {'application/x-ndjson': {}}, 'description': 'one SweepResult per line, as variants finish'}})
+    async def post_sweep(
+        sweep: Sweep,
+        parallelism: Optional[int] = Query(None, ge=1, description='variants run at the same time, defaults to one per worker process or cpu'),
+        session_id = Depends(get_session_id)):
+
+        # the outputs are read from the base session first, so that a typo fails the request before any clone is made
+        await SessionManager.call(test_user, session_id, operations.summarize_outputs, sweep.outputs)
+        fork = SessionManager.worker_pool is not None and FORK_AVAILABLE
+        results = sweeps.run_sweep(test_user, session_id, sweep, parallelism or sweeps.default_parallelism(), fork)
+
+        async def lines():
+            async for result in results:
+                yield result.json() + '\n'
+
+        return StreamingResponse(lines(), media_type='application/x-ndjson')
+
+    # ------ jobs
+
+    @app.get("/jobs", response_model=List[Job], tags=['Jobs'])
+    async def get_jobs(session_id = Depends(get_session_id)):
+        return [job.to_schema() for job in JobManager.get_jobs(test_user, session_id).values()]
+
+    @app.get("/jobs/{job_id}", response_model=Job, tags=['Jobs'])
+    async def get_job(job_id: int, session_id = Depends(get_session_id)):
+        return JobManager.get_job(test_user, session_id, job_id).to_schema()
+
+    @app.delete("/jobs/{job_id}", response_model=Job, tags=['Jobs'])
+    async def delete_job(job_id: int, session_id = Depends(get_session_id)):
+        return JobManager.remove_job(test_user, session_id, job_id).to_schema()
+
+    # ------ metrics
+
+    @app.get("/metrics", response_class=Response, tags=['Metrics'])
+    async def get_metrics():
+        return Response(content=metrics.render(), media_type='text/plain; version=0.0.4')
+
     # ------ internal methods
 
 
     @app.get("/internal", response_model=ApiCommands, dependencies=[Depends(check_that_time_resolution_is_set)], tags=['__internals'])
     async def get_available_internal_methods(session_id = Depends(get_session_id)):
-        command_types = shop_session(test_user, session_id).shop_api.__dir__()
-        command_types = list(filter(lambda x: x[0] != '_', command_types))
+        command_types = await SessionManager.call(test_user, session_id, operations.get_available_internal_methods)
         return ApiCommands(command_types = command_types)
 
     @app.get("/internal/{command}", dependencies=[Depends(check_that_time_resolution_is_set)], response_model=ApiCommandDescription, tags=['__internals'])
     async def get_internal_method_description(command: ApiCommandEnum, session_id = Depends(get_session_id)):
-        doc = getattr(shop_session(test_user, session_id).shop_api, command).__doc__
-        return ApiCommandDescription(description = str(doc))
+        doc = await SessionManager.call(test_user, session_id, operations.get_internal_method_description, command)
+        return ApiCommandDescription(description = doc)
 
     @app.post("/internal/{command}", dependencies=[Depends(check_that_time_resolution_is_set)], response_model=CommandStatus, tags=['__internals'])
     async def call_internal_method(command: ApiCommandEnum, session_id = Depends(get_session_id)):
@@ -1,3 +1,3 @@
 __version__ = '14.0.0'
 # keep the above line formatting otherwise setup.py will fail to extract this version information correctly
-from . import sessions, schemas
\ No newline at end of file
+from . import sessions, schemas, operations
\ No newline at end of file
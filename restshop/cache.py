@@ -0,0 +1,63 @@
+import collections
+import threading
+from typing import Dict, Set, Tuple, Hashable, Iterable, Optional
+
+from .metrics import Counter
+
+PAYLOAD_CACHE_REQUESTS = Counter('restshop_payload_cache_requests_total', 'Serialized object payload lookups')
+
+# (object_type, object_name, attribute selection, format)
+PayloadKey = Tuple[str, str, Hashable, str]
+
+
+class PayloadCache:
+    # Serialized object payloads of one shop session, least recently used first, bounded by the total payload size.
+    # Entries are dropped per object when it is written to, or all at once after anything that may touch every object.
+
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self._entries: 'collections.OrderedDict[PayloadKey, bytes]' = collections.OrderedDict()
+        self._keys_by_object: Dict[Tuple[str, str], Set[PayloadKey]] = {}
+        self._lock = threading.Lock()
+
+    def get(self, key: PayloadKey) -> Optional[bytes]:
+        with self._lock:
+            payload = self._entries.get(key)
+            if payload is not None:
+                self._entries.move_to_end(key)
+        PAYLOAD_CACHE_REQUESTS.inc(result='hit' if payload is not None else 'miss')
+        return payload
+
+    def put(self, key: PayloadKey, payload: bytes):
+        if len(payload) > self.max_bytes:
+            return
+        with self._lock:
+            self._remove(key)
+            self._entries[key] = payload
+            self._keys_by_object.setdefault(key[:2], set()).add(key)
+            self.size += len(payload)
+            while self.size > self.max_bytes:
+                self._remove(next(iter(self._entries)))
+
+    def invalidate(self, objects: Iterable[Tuple[str, str]]):
+        with self._lock:
+            for o in objects:
+                for key in list(self._keys_by_object.get(tuple(o), ())):
+                    self._remove(key)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._keys_by_object.clear()
+            self.size = 0
+
+    def _remove(self, key: PayloadKey):
+        payload = self._entries.pop(key, None)
+        if payload is None:
+            return
+        self.size -= len(payload)
+        keys = self._keys_by_object[key[:2]]
+        keys.discard(key)
+        if not keys:
+            del self._keys_by_object[key[:2]]
@@ -0,0 +1,49 @@
+from typing import List, Dict, Tuple, Any, Optional
+
+
+class AttributeCatalog:
+    # Attribute metadata of every object type, i.e. datatype and all attribute info keys, read once per SHOP version
+    # instead of calling GetAttributeInfo on every request. A process only ever loads one shop_pybind, so the catalog
+    # built from the first core is valid for every core in the process.
+
+    catalogs: Dict[str, 'AttributeCatalog'] = {}
+    current: Optional['AttributeCatalog'] = None
+
+    def __init__(self, shop_version: str, datatypes: Dict[str, Dict[str, str]], info: Dict[str, Dict[str, Dict[str, Any]]]):
+        self.shop_version = shop_version
+        # object_type -> attribute_name -> datatype, in model order
+        self.datatypes = datatypes
+        # object_type -> attribute_name -> info_key -> value
+        self.info = info
+        # pre-serialized payloads and their digest, filled lazily by the serializers in restshop.schemas
+        self.serialized: Dict[Any, Tuple[bytes, str]] = {}
+
+    @staticmethod
+    def build(shop_api) -> 'AttributeCatalog':
+        shop_version = shop_api.GetVersionString().split()[0]
+        info_keys = list(shop_api.GetValidAttributeInfoKeys())
+        datatypes = {}
+        info = {}
+        for object_type in shop_api.GetObjectTypeNames():
+            names = list(shop_api.GetObjectTypeAttributeNames(object_type))
+            datatypes[object_type] = dict(zip(names, shop_api.GetObjectTypeAttributeDatatypes(object_type)))
+            info[object_type] = {
+                name: {key: shop_api.GetAttributeInfo(object_type, name, key) for key in info_keys} for name in names
+            }
+        return AttributeCatalog(shop_version, datatypes, info)
+
+    @staticmethod
+    def register(catalog: 'AttributeCatalog') -> 'AttributeCatalog':
+        # makes catalog the one of this process, e.g. a catalog loaded from restshop.metadata
+        AttributeCatalog.catalogs[catalog.shop_version] = catalog
+        AttributeCatalog.current = catalog
+        return catalog
+
+    @staticmethod
+    def get(shop_api) -> 'AttributeCatalog':
+        if AttributeCatalog.current is None:
+            AttributeCatalog.register(AttributeCatalog.build(shop_api))
+        return AttributeCatalog.current
+
+    def attribute_names(self, object_type: str) -> List[str]:
+        return list(self.datatypes[object_type])
@@ -0,0 +1,248 @@
+import io
+from typing import List, Dict, Optional
+
+import numpy as np
+
+from fastapi import HTTPException
+
+try:
+    import pyarrow as pa
+except ImportError:
+    pa = None
+
+# Binary encodings of txy, xy, xy_array and xyt attributes. Values travel as a table of equally long numpy columns
+# between the wire and the SHOP core, without going through pydantic or pandas:
+#
+# - txy            <-> time, y_0, ..., y_{n-1}   (one y column per scenario)
+# - xy, xy_array   <-> ref, x, y                 (one row per point, consecutive rows with equal ref form a curve)
+# - xyt            <-> time, x, y                (one row per point, consecutive rows with equal time form a curve)
+#
+# A table is sent either as an Arrow IPC stream (requires pyarrow) or as a single .npy structured array.
+
+ARROW_STREAM = 'application/vnd.apache.arrow.stream'
+NPY = 'application/x-npy'
+JSON = 'application/json'
+
+COLUMNAR_DATATYPES = ['txy', 'xy', 'xy_array', 'xyt']
+
+Table = Dict[str, np.ndarray]
+
+_TIME_UNIT_SECONDS = {'hour': 3600, 'minute': 60, 'second': 1}
+
+# txy values at or above this are missing in SHOP, they are NaN in tables
+_NO_VALUE = 1.0e40
+
+
+def negotiate_media_type(accept: Optional[str]) -> str:
+    # first supported media type in the accept header, json unless a binary format is asked for
+    for media_type in (accept or '').split(','):
+        media_type = media_type.split(';')[0].strip()
+        if media_type in (ARROW_STREAM, NPY, JSON):
+            return media_type
+    return JSON
+
+
+def _check_media_type(media_type: str, status_code: int):
+    if media_type == ARROW_STREAM and pa is None:
+        raise HTTPException(status_code, f'media type {{{ARROW_STREAM}}} requires pyarrow, which is not installed')
+    if media_type not in (ARROW_STREAM, NPY):
+        raise HTTPException(status_code, f'media type {{{media_type}}} is not supported, use {{{ARROW_STREAM}}} or {{{NPY}}}')
+
+
+def encode_table(table: Table, media_type: str) -> bytes:
+    _check_media_type(media_type, 406)
+
+    if media_type == ARROW_STREAM:
+        batch = pa.RecordBatch.from_arrays([pa.array(c) for c in table.values()], names=list(table))
+        sink = pa.BufferOutputStream()
+        with pa.ipc.new_stream(sink, batch.schema) as writer:
+            writer.write_batch(batch)
+        return sink.getvalue().to_pybytes()
+
+    size = len(next(iter(table.values()))) if table else 0
+    records = np.empty(size, dtype=[(name, column.dtype) for name, column in table.items()])
+    for name, column in table.items():
+        records[name] = column
+    buffer = io.BytesIO()
+    np.save(buffer, records, allow_pickle=False)
+    return buffer.getvalue()
+
+
+def decode_table(content: bytes, media_type: str) -> Table:
+    _check_media_type(media_type, 415)
+
+    try:
+        if media_type == ARROW_STREAM:
+            table = pa.ipc.open_stream(content).read_all()
+            return {name: table.column(name).to_numpy() for name in table.column_names}
+
+        records = np.load(io.BytesIO(content), allow_pickle=False)
+        if records.dtype.names is None:
+            raise ValueError('expected a structured array')
+        return {name: records[name] for name in records.dtype.names}
+
+    except Exception as e:
+        raise HTTPException(400, f'could not decode {{{media_type}}} body: {e}')
+
+
+def _require_columns(table: Table, datatype: str, names: List[str]):
+    missing = [n for n in names if n not in table]
+    if missing:
+        raise HTTPException(400, f'columns {{{", ".join(missing)}}} are required for datatype {{{datatype}}}')
+
+
+def _shop_datetime64(time_string: str) -> np.datetime64:
+    # SHOP time strings are %Y%m%d%H%M%S, possibly truncated
+    s = (time_string[:14] + '0000000000')[:14]
+    return np.datetime64(f'{s[0:4]}-{s[4:6]}-{s[6:8]}T{s[8:10]}:{s[10:12]}:{s[12:14]}', 's')
+
+
+def _shop_timestring(time: np.datetime64) -> str:
+    return str(np.datetime64(time, 's')).replace('-', '').replace('T', '').replace(':', '')
+
+
+def _groups(keys: np.ndarray):
+    # start of every run of equal consecutive keys, and the run lengths
+    if keys.size == 0:
+        return np.empty(0, dtype=int), np.empty(0, dtype=int)
+    starts = np.flatnonzero(np.r_[True, keys[1:] != keys[:-1]])
+    return starts, np.diff(np.r_[starts, keys.size])
+
+
+def get_attribute_table(shop_api, object_type: str, object_name: str, attribute_name: str, datatype: str) -> Table:
+    args = (object_type, object_name, attribute_name)
+
+    if datatype == 'txy':
+        start_time = shop_api.GetTxySeriesStartTime(*args)
+        if not start_time:
+            return {'time': np.empty(0, dtype='datetime64[s]'), 'y_0': np.empty(0)}
+        t = np.asarray(shop_api.GetTxySeriesT(*args), dtype=np.int64)
+        y = np.asarray(shop_api.GetTxySeriesY(*args), dtype=float).reshape(t.size, -1)
+        y = np.where(y >= _NO_VALUE, np.nan, y)
+        time = _shop_datetime64(start_time) + t * np.timedelta64(_TIME_UNIT_SECONDS[shop_api.GetTimeUnit()], 's')
+        table = {'time': time}
+        table.update({f'y_{i}': np.ascontiguousarray(y[:, i]) for i in range(y.shape[1])})
+        return table
+
+    if datatype == 'xy':
+        x = np.asarray(shop_api.GetXyCurveX(*args), dtype=float)
+        y = np.asarray(shop_api.GetXyCurveY(*args), dtype=float)
+        ref = np.full(x.size, float(shop_api.GetXyCurveReference(*args)))
+        return {'ref': ref, 'x': x, 'y': y}
+
+    if datatype == 'xy_array':
+        refs = np.asarray(shop_api.GetXyCurveArrayReferences(*args), dtype=float)
+        n = np.asarray(shop_api.GetXyCurveArrayNPoints(*args), dtype=int)
+        x = np.asarray(shop_api.GetXyCurveArrayX(*args), dtype=float)
+        y = np.asarray(shop_api.GetXyCurveArrayY(*args), dtype=float)
+        return {'ref': np.repeat(refs, n), 'x': x, 'y': y}
+
+    if datatype == 'xyt':
+        # the times of an xyt curve are time step indices into the optimization horizon
+        start, end = shop_api.GetStartTime(), shop_api.GetEndTime()
+        step = np.timedelta64(_TIME_UNIT_SECONDS[shop_api.GetTimeUnit()] * int(shop_api.GetTimeResolutionY()[0]), 's')
+        times = _shop_datetime64(start) + np.asarray(shop_api.GetXyTCurveTimes(*args), dtype=np.int64) * step
+        x = np.asarray(shop_api.GetXyTCurveX(*args, start, end), dtype=float)
+        y = np.asarray(shop_api.GetXyTCurveY(*args, start, end), dtype=float)
+        n = np.asarray(shop_api.GetXyTCurveN(*args, start, end), dtype=int)
+        return {'time': np.repeat(times[:n.size], n), 'x': x, 'y': y}
+
+    raise HTTPException(400, f'datatype {{{datatype}}} has no columnar encoding, only {{{", ".join(COLUMNAR_DATATYPES)}}}')
+
+
+def txy_frame(tables: Dict[str, Table], start: np.datetime64, end: np.datetime64) -> Table:
+    # txy tables as columns on one time axis: start and every point of any table inside [start, end). A txy value
+    # holds until the next point, so each column is forward filled, NaN before its first point. Tables with several
+    # scenarios give a column name.y_i per scenario.
+    start, end = np.datetime64(start, 's'), np.datetime64(end, 's')
+    times = [t['time'].astype('datetime64[s]') for t in tables.values()]
+    axis = np.unique(np.concatenate([np.array([start])] + [t[(t >= start) & (t < end)] for t in times]))
+
+    frame = {'time': axis}
+    for (name, table), time in zip(tables.items(), times):
+        y_names = sorted((n for n in table if n.startswith('y_')), key=lambda n: int(n[2:]))
+        index = np.searchsorted(time, axis, side='right') - 1
+        for y_name in y_names:
+            column = np.full(axis.size, np.nan)
+            if time.size:
+                column[index >= 0] = table[y_name][index[index >= 0]]
+            frame[name if len(y_names) == 1 else f'{name}.{y_name}'] = column
+    return frame
+
+
+def _y_names(table: Table) -> List[str]:
+    return sorted((n for n in table if n.startswith('y_') and n[2:].isdigit()), key=lambda n: int(n[2:]))
+
+
+def merge_txy_tables(current: Table, patch: Table, end: Optional[np.datetime64], time_unit: str) -> Table:
+    # the points of patch replace those of current inside [first time of patch, end). end defaults to the last time of
+    # patch plus its last time step, or one time unit for a single point. The value current had at end is put back
+    # there, so the series after the window is unchanged. Untouched points are copied as they are, NaN goes back to
+    # SHOP as missing.
+    _require_columns(patch, 'txy', ['time'])
+    y_names, current_y_names = _y_names(patch), _y_names(current)
+    time, patch_time = current['time'].astype('datetime64[s]'), patch['time'].astype('datetime64[s]')
+    if not y_names or patch_time.size == 0:
+        raise HTTPException(400, 'the patch needs a time column, at least one column y_0, ..., y_n and at least one row')
+    if time.size and y_names != current_y_names:
+        raise HTTPException(400, f'the patch has {len(y_names)} scenarios, the series has {len(current_y_names)}')
+    if np.any(np.diff(patch_time) <= np.timedelta64(0, 's')):
+        raise HTTPException(400, 'the timestamps of the patch must be increasing')
+    if end is None:
+        step = np.diff(patch_time)[-1] if patch_time.size > 1 else np.timedelta64(_TIME_UNIT_SECONDS[time_unit], 's')
+        end = patch_time[-1] + step
+    end = np.datetime64(end, 's')
+    if end <= patch_time[-1]:
+        raise HTTPException(400, f'end_time {{{end}}} must be after the last timestamp of the patch')
+
+    before = time < patch_time[0]
+    after = time >= end
+    # last point of current at or before end, its value holds at end unless current has a point there
+    index = np.searchsorted(time, end, side='right') - 1
+    restore = index >= 0 and time[index] != end
+
+    restored_time = np.array([end] if restore else [], dtype='datetime64[s]')
+    merged = {'time': np.concatenate([time[before], patch_time, restored_time, time[after]])}
+    for name in y_names:
+        y = current[name].astype(float) if time.size else np.empty(0)
+        merged[name] = np.concatenate([y[before], patch[name].astype(float), [y[index]] if restore else [], y[after]])
+        merged[name] = np.where(np.isnan(merged[name]), _NO_VALUE, merged[name])
+    return merged
+
+
+def set_attribute_table(shop_api, object_type: str, object_name: str, attribute_name: str, datatype: str, table: Table):
+    args = (object_type, object_name, attribute_name)
+
+    if datatype == 'txy':
+        _require_columns(table, datatype, ['time'])
+        y_names = _y_names(table)
+        if not y_names:
+            raise HTTPException(400, f'at least one column y_0, ..., y_n is required for datatype {{{datatype}}}')
+        time = table['time'].astype('datetime64[s]')
+        y = np.column_stack([table[n].astype(float) for n in y_names])
+        if time.size == 0:
+            shop_api.SetTxySeries(*args, shop_api.GetStartTime(), np.empty(0, dtype=int), np.empty(0))
+            return
+        unit = np.timedelta64(_TIME_UNIT_SECONDS[shop_api.GetTimeUnit()], 's')
+        offsets = time - time[0]
+        if np.any(offsets % unit != np.timedelta64(0, 's')):
+            raise HTTPException(400, f'timestamps of {{{attribute_name}}} must be whole multiples of the time unit')
+        shop_api.SetTxySeries(*args, _shop_timestring(time[0]), (offsets // unit).astype(int), y if len(y_names) > 1 else y[:, 0])
+        return
+
+    if datatype in ('xy', 'xy_array'):
+        _require_columns(table, datatype, ['ref', 'x', 'y'])
+        ref, x, y = table['ref'].astype(float), table['x'].astype(float), table['y'].astype(float)
+        starts, n = _groups(ref)
+        if datatype == 'xy':
+            if n.size > 1:
+                raise HTTPException(400, f'datatype {{{datatype}}} holds a single curve, got {n.size} refs')
+            shop_api.SetXyCurve(*args, float(ref[0]) if ref.size else 0.0, x, y)
+        else:
+            shop_api.SetXyCurveArray(*args, ref[starts], n, x, y)
+        return
+
+    if datatype == 'xyt':
+        raise HTTPException(400, f'datatype {{{datatype}}} is an output and cannot be set')
+
+    raise HTTPException(400, f'datatype {{{datatype}}} has no columnar encoding, only {{{", ".join(COLUMNAR_DATATYPES)}}}')
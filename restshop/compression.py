@@ -0,0 +1,153 @@
+import zlib
+from typing import List, Dict, Optional
+
+from starlette.concurrency import run_in_threadpool
+from starlette.datastructures import Headers, MutableHeaders
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+from . import columnar
+
+# Negotiated gzip and zstd compression of responses. Bodies are compressed on a worker thread, never on the event loop
+# serving the other sessions. Only the content types below are compressed, each with its own level: json and text of
+# numeric series is very repetitive and already shrinks a lot at cheap levels, binary columns of floats hardly shrink
+# at all, so little time is spent on them. Server sent events are never touched.
+
+GZIP = 'gzip'
+ZSTD = 'zstd'
+
+# content type -> encoding -> level
+LEVELS: Dict[str, Dict[str, int]] = {
+    'application/json': {GZIP: 6, ZSTD: 3},
+    'application/x-ndjson': {GZIP: 6, ZSTD: 3},
+    'text/plain': {GZIP: 6, ZSTD: 3},
+    'text/html': {GZIP: 6, ZSTD: 3},
+    columnar.ARROW_STREAM: {GZIP: 1, ZSTD: 1},
+    columnar.NPY: {GZIP: 1, ZSTD: 1},
+}
+
+
+def available_encodings() -> List[str]:
+    # in order of preference when the client accepts several with the same weight
+    return ([ZSTD] if zstandard is not None else []) + [GZIP]
+
+
+def negotiate_encoding(accept_encoding: Optional[str]) -> Optional[str]:
+    # the supported encoding with the highest q value in the accept-encoding header, None for identity
+    weights: Dict[str, float] = {}
+    for item in (accept_encoding or '').split(','):
+        name, *params = [p.strip() for p in item.split(';')]
+        q = 1.0
+        for param in params:
+            if param.startswith('q='):
+                try:
+                    q = float(param[2:])
+                except ValueError:
+                    q = 0.0
+        if name:
+            weights[name.lower()] = q
+
+    best, best_q = None, 0.0
+    for encoding in available_encodings():
+        q = weights.get(encoding, weights.get('*', 0.0))
+        if q > best_q:
+            best, best_q = encoding, q
+    return best
+
+
+class _Compressor:
+    # incremental compressor, flushed after every chunk so streamed responses reach the client as they are produced
+
+    def __init__(self, encoding: str, level: int):
+        if encoding == ZSTD:
+            self._zstd = zstandard.ZstdCompressor(level=level).compressobj()
+        else:
+            self._zlib = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+        self.encoding = encoding
+
+    def compress(self, data: bytes, final: bool) -> bytes:
+        if self.encoding == ZSTD:
+            flush_mode = zstandard.COMPRESSOBJ_FLUSH_FINISH if final else zstandard.COMPRESSOBJ_FLUSH_BLOCK
+            return self._zstd.compress(data) + self._zstd.flush(flush_mode)
+        return self._zlib.compress(data) + self._zlib.flush(zlib.Z_FINISH if final else zlib.Z_SYNC_FLUSH)
+
+
+class CompressionMiddleware:
+
+    def __init__(self, app, minimum_size: int = 1024, levels: Dict[str, Dict[str, int]] = LEVELS):
+        self.app = app
+        self.minimum_size = minimum_size
+        self.levels = levels
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'http':
+            await self.app(scope, receive, send)
+            return
+
+        encoding = negotiate_encoding(Headers(scope=scope).get('accept-encoding'))
+        if encoding is None:
+            await self.app(scope, receive, send)
+            return
+
+        await _CompressionResponder(self, encoding, send).run(scope, receive)
+
+
+class _CompressionResponder:
+
+    def __init__(self, middleware: CompressionMiddleware, encoding: str, send):
+        self.middleware = middleware
+        self.encoding = encoding
+        self.send = send
+        self.start_message = None
+        self.compressor: Optional[_Compressor] = None
+        self.passthrough = False
+
+    async def run(self, scope, receive):
+        await self.middleware.app(scope, receive, self.send_compressed)
+
+    def _level(self, headers: MutableHeaders) -> Optional[int]:
+        if 'content-encoding' in headers:
+            return None
+        content_type = headers.get('content-type', '').split(';')[0].strip().lower()
+        return self.middleware.levels.get(content_type, {}).get(self.encoding)
+
+    async def send_compressed(self, message):
+        if message['type'] == 'http.response.start':
+            # held back until the first body chunk tells whether the body is worth compressing
+            self.start_message = message
+            return
+
+        if message['type'] != 'http.response.body' or self.passthrough:
+            await self.send(message)
+            return
+
+        body = message.get('body', b'')
+        more_body = message.get('more_body', False)
+
+        if self.compressor is None:
+            headers = MutableHeaders(raw=self.start_message['headers'])
+            level = self._level(headers)
+            if level is None or (not more_body and len(body) < self.middleware.minimum_size):
+                self.passthrough = True
+                await self.send(self.start_message)
+                await self.send(message)
+                return
+
+            self.compressor = _Compressor(self.encoding, level)
+            headers['Content-Encoding'] = self.encoding
+            headers.add_vary_header('Accept-Encoding')
+            if more_body:
+                del headers['Content-Length']
+            else:
+                body = await run_in_threadpool(self.compressor.compress, body, True)
+                headers['Content-Length'] = str(len(body))
+                await self.send(self.start_message)
+                await self.send({'type': 'http.response.body', 'body': body})
+                return
+            await self.send(self.start_message)
+
+        body = await run_in_threadpool(self.compressor.compress, body, not more_body)
+        await self.send({'type': 'http.response.body', 'body': body, 'more_body': more_body})
@@ -0,0 +1,56 @@
+import os
+import tempfile
+
+# Server settings, read once from the environment at import time
+
+# Number of worker processes hosting shop sessions, each worker owns the ShopCore instances of the sessions assigned
+# to it and runs every one of them on a thread of its own. Up to this many sessions get a worker each. 0 keeps every
+# shop session inside the API process.
+WORKER_POOL_SIZE: int = int(os.environ.get('RESTSHOP_WORKER_POOL_SIZE', '0'))
+
+# Number of idle, initialized shop sessions kept ready for POST /session and refilled in the background. 0 creates
+# every session on demand.
+SESSION_POOL_SIZE: int = int(os.environ.get('RESTSHOP_SESSION_POOL_SIZE', '0'))
+
+# Evictor settings. Shop sessions idle for longer than SESSION_IDLE_TTL seconds, or the least recently used ones while
+# the server and its workers use more than SESSION_MEMORY_BUDGET_MB, are dumped to SESSION_SPILL_DIR and loaded back
+# when they are used again. 0 disables the respective rule.
+SESSION_IDLE_TTL: float = float(os.environ.get('RESTSHOP_SESSION_IDLE_TTL', '0'))
+SESSION_MEMORY_BUDGET_MB: float = float(os.environ.get('RESTSHOP_SESSION_MEMORY_BUDGET_MB', '0'))
+SESSION_SPILL_DIR: str = os.environ.get('RESTSHOP_SESSION_SPILL_DIR', os.path.join(tempfile.gettempdir(), 'restshop_sessions'))
+EVICTOR_INTERVAL: float = float(os.environ.get('RESTSHOP_EVICTOR_INTERVAL', '30'))
+
+# Size in MB of the cache of serialized object payloads kept per shop session. 0 disables the cache.
+SESSION_CACHE_MB: float = float(os.environ.get('RESTSHOP_SESSION_CACHE_MB', '16'))
+
+# Check json payloads that are serialized without pydantic against the response_model of their route. Meant for
+# development, costs a full parse of every such response.
+VALIDATE_RESPONSES: bool = os.environ.get('RESTSHOP_VALIDATE_RESPONSES', '').lower() in ('1', 'true', 'yes')
+
+# Responses of at least COMPRESSION_MIN_SIZE bytes are compressed with gzip or zstd when the client accepts it, see
+# restshop.compression. Streamed responses are always compressed.
+COMPRESSION_MIN_SIZE: int = int(os.environ.get('RESTSHOP_COMPRESSION_MIN_SIZE', '1024'))
+
+# The last MESSAGE_LOG_SIZE SHOP messages of every shop session are kept for GET /messages, see restshop.messages.
+MESSAGE_LOG_SIZE: int = int(os.environ.get('RESTSHOP_MESSAGE_LOG_SIZE', '10000'))
+
+# Number of variants of POST /sweep run at the same time, 0 uses one per worker process, or 2 without workers.
+SWEEP_PARALLELISM: int = int(os.environ.get('RESTSHOP_SWEEP_PARALLELISM', '0'))
+
+# Requests on one shop session are served one at a time, at most SESSION_QUEUE_LIMIT may wait for it and later ones
+# get 429, see restshop.locking. 0 disables the limit.
+SESSION_QUEUE_LIMIT: int = int(os.environ.get('RESTSHOP_SESSION_QUEUE_LIMIT', '64'))
+
+# Jobs that are done (finished, failed or cancelled) are forgotten JOB_RETENTION_SECONDS after they ended, and beyond
+# the JOB_RETENTION_COUNT most recent ones of their shop session. 0 disables the respective rule.
+JOB_RETENTION_SECONDS: float = float(os.environ.get('RESTSHOP_JOB_RETENTION_SECONDS', '3600'))
+JOB_RETENTION_COUNT: int = int(os.environ.get('RESTSHOP_JOB_RETENTION_COUNT', '100'))
+
+# Token expected in the X-Admin-Token header of admin only requests, e.g. ?profile=true, see restshop.profiling. Empty
+# disables them.
+ADMIN_TOKEN: str = os.environ.get('RESTSHOP_ADMIN_TOKEN', '')
+
+# Directory of the SHOP metadata cache read by restshop.schemas at import, see restshop.metadata. Empty disables it.
+METADATA_CACHE_DIR: str = os.environ.get(
+    'RESTSHOP_METADATA_CACHE_DIR', os.path.join(os.environ.get('XDG_CACHE_HOME', os.path.expanduser('~/.cache')), 'restshop')
+)
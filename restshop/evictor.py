@@ -0,0 +1,101 @@
+import logging
+import os
+import threading
+import time
+from typing import Optional
+
+from . import config
+from .sessions import SessionManager
+
+logger = logging.getLogger(__name__)
+
+
+def _memory_bytes(pid: int) -> Optional[int]:
+    # proportional set size where available, forked workers share most of their pages with their parent and would be
+    # counted many times over by their resident size. None where memory cannot be read.
+    try:
+        with open(f'/proc/{pid}/smaps_rollup') as f:
+            for line in f:
+                if line.startswith('Pss:'):
+                    return int(line.split()[1]) * 1024
+    except (OSError, ValueError):
+        pass
+    try:
+        import psutil
+        return psutil.Process(pid).memory_info().rss
+    except Exception:
+        return None
+
+
+def memory_usage() -> Optional[int]:
+    # memory of the server process and its shop workers
+    pids = [os.getpid()]
+    if SessionManager.worker_pool:
+        pids += [w.pid for w in SessionManager.worker_pool.all_workers()]
+    sizes = [_memory_bytes(pid) for pid in pids]
+    if any(size is None for size in sizes):
+        return None
+    return sum(sizes)
+
+
+class SessionEvictor:
+    # Background thread that removes expired users and dumps shop sessions to disk when they have been idle for
+    # longer than idle_ttl seconds, or while the server uses more than memory_budget bytes
+
+    def __init__(self, idle_ttl: float, memory_budget: float, interval: float):
+        self.idle_ttl = idle_ttl
+        self.memory_budget = memory_budget
+        self.interval = interval
+        self._thread: Optional[threading.Thread] = None
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name='shop_session_evictor', daemon=True)
+            self._thread.start()
+
+    def _run(self):
+        while True:
+            time.sleep(self.interval)
+            try:
+                self.run_once()
+            except Exception:
+                logger.exception('shop session evictor round failed')
+
+    def run_once(self) -> int:
+        SessionManager.cleanup_user_sessions()
+
+        idle = SessionManager.get_idle_shop_sessions()
+        now = time.monotonic()
+        evicted = 0
+
+        if self.idle_ttl > 0:
+            expired = [(username, session_id) for last_used, username, session_id in idle if now - last_used > self.idle_ttl]
+            for username, session_id in expired:
+                evicted += self._evict(username, session_id, 'idle')
+            idle = [e for e in idle if (e[1], e[2]) not in expired]
+
+        # memory is slow to show up as freed, so only the least recently used session is dumped per round
+        if self.memory_budget > 0 and idle:
+            usage = memory_usage()
+            if usage is not None and usage > self.memory_budget:
+                for _, username, session_id in idle:
+                    if self._evict(username, session_id, 'memory'):
+                        evicted += 1
+                        break
+
+        return evicted
+
+    @staticmethod
+    def _evict(username: str, session_id: int, reason: str) -> bool:
+        # a failed dump leaves the session in memory, it is tried again on the next round and does not hold up the
+        # other sessions
+        try:
+            return SessionManager.evict_shop_session(username, session_id, reason).result()
+        except Exception:
+            logger.exception(f'could not evict shop session {session_id} of {username}')
+            return False
+
+
+session_evictor: Optional[SessionEvictor] = SessionEvictor(
+    config.SESSION_IDLE_TTL, config.SESSION_MEMORY_BUDGET_MB * 1024 * 1024, config.EVICTOR_INTERVAL
+) if config.SESSION_IDLE_TTL > 0 or config.SESSION_MEMORY_BUDGET_MB > 0 else None
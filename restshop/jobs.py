@@ -0,0 +1,114 @@
+import datetime as dt
+import itertools
+from concurrent.futures import Future
+from typing import Dict, List, Tuple, Optional
+
+from fastapi import HTTPException
+
+from . import config
+from . import operations
+from .schemas import Job, JobStatusEnum, CommandStatus
+from .sessions import SessionManager
+
+
+class ShopJob:
+    # A shop command queued on the executor of a shop session, clients poll it instead of holding a connection open
+
+    def __init__(self, job_id: int, command: str):
+        self.job_id: int = job_id
+        self.command: str = command
+        self.status: JobStatusEnum = JobStatusEnum.queued
+        self.created_at: dt.datetime = dt.datetime.utcnow()
+        self.started_at: Optional[dt.datetime] = None
+        self.finished_at: Optional[dt.datetime] = None
+        self.result: Optional[CommandStatus] = None
+        self.future: Optional[Future] = None
+
+    def _on_start(self):
+        self.started_at = dt.datetime.utcnow()
+        self.status = JobStatusEnum.running
+
+    def _on_done(self, future: Future):
+        self.finished_at = dt.datetime.utcnow()
+        if future.cancelled():
+            self.status = JobStatusEnum.cancelled
+            return
+        try:
+            status: bool = future.result()
+        except HTTPException as e:
+            self.status = JobStatusEnum.failed
+            self.result = CommandStatus(message='failed to execute simulation command', status=False, error=str(e.detail))
+        except Exception as e:
+            self.status = JobStatusEnum.failed
+            self.result = CommandStatus(message='failed to execute simulation command', status=False, error=str(e))
+        else:
+            self.status = JobStatusEnum.finished
+            self.result = CommandStatus(message=('ok' if status else 'something went wrong ...'), status=status)
+
+    def cancel(self) -> bool:
+        # only queued jobs can be cancelled, a command already running inside SHOP cannot be interrupted
+        return self.future.cancel()
+
+    def to_schema(self) -> Job:
+        return Job(
+            job_id=self.job_id,
+            command=self.command,
+            status=self.status,
+            created_at=self.created_at,
+            started_at=self.started_at,
+            finished_at=self.finished_at,
+            result=self.result,
+        )
+
+
+class JobManager:
+
+    jobs: Dict[Tuple[str, int], Dict[int, ShopJob]] = {}
+    job_counter = itertools.count(1)
+
+    @staticmethod
+    def get_jobs(username: str, session_id: int) -> Dict[int, ShopJob]:
+        SessionManager.get_shop_session(username, session_id)
+        jobs = JobManager.jobs.setdefault((username, session_id), {})
+        JobManager.prune(jobs)
+        return jobs
+
+    @staticmethod
+    def prune(jobs: Dict[int, ShopJob], now: Optional[dt.datetime] = None):
+        # forgets jobs that are done once they are older than the retention time, or not among the most recent ones,
+        # see config.JOB_RETENTION_SECONDS and config.JOB_RETENTION_COUNT. Queued and running jobs are kept.
+        now = now or dt.datetime.utcnow()
+        done = sorted(
+            (job for job in list(jobs.values()) if job.finished_at is not None), key=lambda job: job.finished_at, reverse=True
+        )
+        for i, job in enumerate(done):
+            expired = config.JOB_RETENTION_SECONDS > 0 and (now - job.finished_at).total_seconds() > config.JOB_RETENTION_SECONDS
+            if expired or 0 < config.JOB_RETENTION_COUNT <= i:
+                jobs.pop(job.job_id, None)
+
+    @staticmethod
+    def get_job(username: str, session_id: int, job_id: int) -> ShopJob:
+        jobs = JobManager.get_jobs(username, session_id)
+        if job_id not in jobs:
+            raise HTTPException(404, f'Job with id {{{job_id}}} not found')
+        return jobs[job_id]
+
+    @staticmethod
+    def submit_command(username: str, session_id: int, command: str, options: List[str], values: List[str]) -> ShopJob:
+        jobs = JobManager.get_jobs(username, session_id)
+        job = ShopJob(next(JobManager.job_counter), command)
+        job.future = SessionManager.submit(
+            username, session_id, operations.execute_command, command, options, values, on_start=job._on_start
+        )
+        job.future.add_done_callback(job._on_done)
+        jobs[job.job_id] = job
+        return job
+
+    @staticmethod
+    def remove_job(username: str, session_id: int, job_id: int) -> ShopJob:
+        # cancels a queued job, or forgets a job that is done. Running jobs are left alone.
+        job = JobManager.get_job(username, session_id, job_id)
+        if job.status == JobStatusEnum.running or (job.status == JobStatusEnum.queued and not job.cancel()):
+            raise HTTPException(409, f'Job with id {{{job_id}}} is running and cannot be cancelled')
+        JobManager.jobs[(username, session_id)].pop(job_id)
+        return job
@@ -0,0 +1,84 @@
+import asyncio
+import json
+import time
+from typing import Dict, Tuple
+
+from starlette.datastructures import Headers, MutableHeaders
+
+from . import config
+from .metrics import Counter, Histogram
+
+SESSION_LOCK_WAIT_SECONDS = Histogram('restshop_session_lock_wait_seconds', 'Time requests waited for their shop session')
+SESSION_LOCK_REJECTED = Counter('restshop_session_lock_rejected_total', 'Requests turned away because too many were queued on their shop session')
+
+# One request at a time per shop session. Calls into SHOP are already serialized by the executor of the session, the
+# lock makes whole requests consistent, e.g. reading an etag and the payload it belongs to, or several calls of one
+# handler. Waiting requests are served first in first out, asyncio.Lock does not let newcomers barge in, and at most
+# queue_limit may wait, later ones get 429. Requests on different sessions never wait for each other.
+#
+# The time spent waiting is reported in the X-Session-Wait-Ms header. Routes that only watch a session, or run on
+# clones of it, are exempt so that they neither wait behind nor block a long running command.
+
+WAIT_HEADER = 'X-Session-Wait-Ms'
+
+EXEMPT_PATHS: Tuple[str, ...] = ('/messages', '/jobs', '/sweep', '/metrics', '/session', '/token', '/docs', '/redoc', '/openapi.json')
+
+
+class _SessionLock:
+
+    def __init__(self):
+        self.lock = asyncio.Lock()
+        self.waiting = 0
+
+
+class SessionLockMiddleware:
+
+    def __init__(self, app, queue_limit: int = config.SESSION_QUEUE_LIMIT, exempt_paths: Tuple[str, ...] = EXEMPT_PATHS):
+        self.app = app
+        self.queue_limit = queue_limit
+        self.exempt_paths = exempt_paths
+        self._locks: Dict[int, _SessionLock] = {}
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'http' or scope['path'].startswith(self.exempt_paths):
+            await self.app(scope, receive, send)
+            return
+
+        # same default as the session-id header of the routes, an invalid one is left to the route to reject
+        try:
+            session_id = int(Headers(scope=scope).get('session-id', '1'))
+        except ValueError:
+            await self.app(scope, receive, send)
+            return
+
+        lock = self._locks.setdefault(session_id, _SessionLock())
+        if self.queue_limit and lock.waiting >= self.queue_limit:
+            SESSION_LOCK_REJECTED.inc()
+            body = json.dumps({'detail': f'Session {{{session_id}}} has {lock.waiting} requests queued, try again later'}).encode()
+            await send({'type': 'http.response.start', 'status': 429, 'headers': [
+                (b'content-type', b'application/json'), (b'content-length', str(len(body)).encode()), (b'retry-after', b'1')
+            ]})
+            await send({'type': 'http.response.body', 'body': body})
+            return
+
+        start = time.perf_counter()
+        lock.waiting += 1
+        try:
+            await lock.lock.acquire()
+        finally:
+            lock.waiting -= 1
+        wait_seconds = time.perf_counter() - start
+        SESSION_LOCK_WAIT_SECONDS.observe(wait_seconds)
+
+        async def send_with_wait(message):
+            if message['type'] == 'http.response.start':
+                message['headers'] = list(message.get('headers', []))
+                MutableHeaders(raw=message['headers']).append(WAIT_HEADER, f'{wait_seconds * 1000:.1f}')
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_wait)
+        finally:
+            lock.lock.release()
+            if not lock.lock.locked() and not lock.waiting:
+                self._locks.pop(session_id, None)
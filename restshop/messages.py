@@ -0,0 +1,131 @@
+import asyncio
+import collections
+import json
+import threading
+from typing import List, Tuple, Any, Callable, AsyncIterator, Optional
+
+from . import config
+
+# The SHOP log messages of every command, kept per shop session. The buffer behind shop_api.GetMessages is read by a
+# MessageDrain on the thread that runs the operation, in whichever process holds the shop session, when each command
+# finishes, and every message is tagged with the command it came from. The drained messages are kept in the MessageLog
+# of the session, which GET /messages sends as server sent events.
+#
+# This is a log of finished commands, not a live feed. The SHOP core is not thread safe and its pybind calls may hold
+# the GIL for a whole command, so the buffer is never read while a command runs: the messages of a command show up when
+# it finishes, those of a command list one command at a time.
+
+# seconds between two keepalive comments on an idle stream, so that proxies do not close it
+KEEPALIVE_INTERVAL = 15.0
+
+# the drain of the operation running on the current thread, see drain_messages
+_active = threading.local()
+
+
+class MessageDrain:
+    # Passes the SHOP messages to sink as lists of dicts, when drain_messages is called inside the with block and once
+    # more when it exits, tagged with the command given to drain_messages. A failing read is ignored, it must not fail
+    # the command.
+
+    def __init__(self, shop_api, sink: Callable[[List[Any]], None]):
+        self.shop_api = shop_api
+        self.sink = sink
+        self._previous: Optional['MessageDrain'] = None
+
+    def drain(self, command: Optional[str] = None):
+        try:
+            messages = json.loads(self.shop_api.GetMessages() or '[]')
+            if command is not None:
+                messages = [dict(m, command=command) if isinstance(m, dict) else m for m in messages]
+            if messages:
+                self.sink(messages)
+        except Exception:
+            pass
+
+    def __enter__(self) -> 'MessageDrain':
+        self._previous = getattr(_active, 'drain', None)
+        _active.drain = self
+        return self
+
+    def __exit__(self, *exc):
+        _active.drain = self._previous
+        self.drain()
+
+
+def drain_messages(command: Optional[str] = None):
+    # called by operations after every SHOP command they run, passes on the messages of that command
+    drain = getattr(_active, 'drain', None)
+    if drain is not None:
+        drain.drain(command)
+
+
+class MessageLog:
+    # The messages of one shop session, numbered from 1 in the order they were drained. Only the last max_size are
+    # kept for clients that connect late or reconnect with Last-Event-ID.
+
+    def __init__(self, max_size: int = config.MESSAGE_LOG_SIZE):
+        self._entries: 'collections.deque[Tuple[int, Any]]' = collections.deque(maxlen=max_size)
+        self._next_id = 1
+        self._lock = threading.Lock()
+        # (event loop, event) of every follower, set from the thread that drained the messages
+        self._waiters: List[Tuple[asyncio.AbstractEventLoop, asyncio.Event]] = []
+        self.closed = False
+
+    def extend(self, messages: List[Any]):
+        with self._lock:
+            for message in messages:
+                self._entries.append((self._next_id, message))
+                self._next_id += 1
+        self._wake()
+
+    def close(self):
+        # the session is gone, followers end their stream
+        self.closed = True
+        self._wake()
+
+    def _wake(self):
+        with self._lock:
+            waiters = list(self._waiters)
+        for loop, event in waiters:
+            try:
+                loop.call_soon_threadsafe(event.set)
+            except RuntimeError:
+                # the loop of the follower is closed
+                pass
+
+    def since(self, after: int) -> List[Tuple[int, Any]]:
+        with self._lock:
+            if not self._entries:
+                return []
+            start = max(after + 1 - self._entries[0][0], 0)
+            return list(self._entries)[start:]
+
+    async def follow(self, after: int, keepalive: float = KEEPALIVE_INTERVAL) -> AsyncIterator[List[Tuple[int, Any]]]:
+        # yields the messages after the given id as they arrive, and an empty list after keepalive idle seconds
+        waiter = (asyncio.get_event_loop(), asyncio.Event())
+        with self._lock:
+            self._waiters.append(waiter)
+        try:
+            while True:
+                waiter[1].clear()
+                entries = self.since(after)
+                if entries:
+                    after = entries[-1][0]
+                    yield entries
+                    continue
+                if self.closed:
+                    return
+                try:
+                    await asyncio.wait_for(waiter[1].wait(), keepalive)
+                except asyncio.TimeoutError:
+                    yield []
+        finally:
+            with self._lock:
+                self._waiters.remove(waiter)
+
+
+def format_events(entries: List[Tuple[int, Any]]) -> bytes:
+    # server sent events, an empty list gives a keepalive comment
+    if not entries:
+        return b': keepalive\n\n'
+    return ''.join(f'id: {i}\nevent: message\ndata: {json.dumps(m)}\n\n' for i, m in entries).encode('utf-8')
@@ -0,0 +1,120 @@
+import hashlib
+import importlib.util
+import json
+import os
+import tempfile
+from typing import List, Dict, Any, Optional
+
+from pyshop import ShopSession
+
+from . import config
+from .catalog import AttributeCatalog
+
+# Everything restshop.schemas needs from SHOP to build its enums and the attribute catalog. Reading it takes a live
+# ShopCore and thousands of GetAttributeInfo calls, so it is kept in a json file in METADATA_CACHE_DIR, together with
+# the SHOP version and the sha256 of the shop_pybind binary it was read from. A core is only started when the file is
+# missing, has an older format or belongs to a different binary.
+
+CACHE_FORMAT = 1
+
+
+class ShopMetadata:
+
+    def __init__(self, shop_version: str, object_types: List[str], relation_types: Dict[str, List[str]],
+                 commands: Dict[str, str], api_methods: List[str], attribute_datatypes: Dict[str, Dict[str, str]],
+                 attribute_info: Dict[str, Dict[str, Dict[str, Any]]]):
+        self.shop_version = shop_version
+        self.object_types = object_types
+        # object_type -> valid relation types
+        self.relation_types = relation_types
+        # command enum name -> SHOP command, see ShopSession._commands
+        self.commands = commands
+        self.api_methods = api_methods
+        self.attribute_datatypes = attribute_datatypes
+        self.attribute_info = attribute_info
+
+    @staticmethod
+    def from_shop_session(sess: ShopSession) -> 'ShopMetadata':
+        catalog = AttributeCatalog.build(sess.shop_api)
+        return ShopMetadata(
+            shop_version=catalog.shop_version,
+            object_types=list(sess.model._all_types),
+            relation_types={t: list(sess.shop_api.GetValidRelationTypes(t)) for t in sess.model._all_types},
+            commands=dict(sess._commands),
+            api_methods=[name for name in sess.shop_api.__dir__() if name[0] != '_'],
+            attribute_datatypes=catalog.datatypes,
+            attribute_info=catalog.info,
+        )
+
+    def attribute_catalog(self) -> AttributeCatalog:
+        return AttributeCatalog(self.shop_version, self.attribute_datatypes, self.attribute_info)
+
+
+def _binary_path() -> Optional[str]:
+    spec = importlib.util.find_spec('pyshop.shop_pybind')
+    return spec.origin if spec and spec.origin and os.path.isfile(spec.origin) else None
+
+
+def _sha256(path: str) -> str:
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def _read_cache(path: str, binary: Dict[str, Any]) -> Optional[ShopMetadata]:
+    try:
+        with open(path) as f:
+            cached = json.load(f)
+        if cached['format'] != CACHE_FORMAT:
+            return None
+        # the hash is only recomputed when the binary looks different from when the file was written
+        if [cached['binary'][k] for k in ('path', 'size', 'mtime_ns')] != [binary[k] for k in ('path', 'size', 'mtime_ns')]:
+            binary['sha256'] = binary.get('sha256') or _sha256(binary['path'])
+            if cached['binary']['sha256'] != binary['sha256']:
+                return None
+            # same binary, touched or moved, written back so that the next start does not hash it again
+            metadata = ShopMetadata(**cached['metadata'])
+            _write_cache(path, binary, metadata)
+            return metadata
+        return ShopMetadata(**cached['metadata'])
+    except (OSError, ValueError, KeyError, TypeError):
+        return None
+
+
+def _write_cache(path: str, binary: Dict[str, Any], metadata: ShopMetadata):
+    # written to a temporary file first, several processes may start at once
+    # a failed write only costs the next process a live core
+    binary['sha256'] = binary.get('sha256') or _sha256(binary['path'])
+    tmp_path = None
+    try:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix='.tmp')
+        with os.fdopen(fd, 'w') as f:
+            json.dump({'format': CACHE_FORMAT, 'binary': binary, 'metadata': vars(metadata)}, f)
+        os.replace(tmp_path, path)
+    except (OSError, TypeError, ValueError):
+        if tmp_path and os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+
+def load_shop_metadata(cache_dir: str = config.METADATA_CACHE_DIR) -> ShopMetadata:
+    binary_path = _binary_path()
+    binary = None
+    if cache_dir and binary_path:
+        stat = os.stat(binary_path)
+        binary = {'path': binary_path, 'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns}
+        # one file per binary location, so that installs side by side do not overwrite each other
+        name = hashlib.sha1(binary_path.encode('utf-8')).hexdigest()[:16]
+        cache_path = os.path.join(cache_dir, f'shop_metadata_{name}.json')
+        metadata = _read_cache(cache_path, binary)
+        if metadata is not None:
+            return metadata
+
+    sess = ShopSession(license_path='', silent=False, log_file='', name='metadata', id=0)
+    metadata = ShopMetadata.from_shop_session(sess)
+    del sess
+    if binary is not None:
+        _write_cache(cache_path, binary, metadata)
+    return metadata
@@ -0,0 +1,175 @@
+import threading
+import time
+from typing import List, Dict, Tuple, Sequence, Callable
+
+# Process wide metrics in the Prometheus text exposition format, served on GET /metrics. Every metric registers itself
+# on creation, label values are given as keyword arguments when the metric is updated.
+
+_registry: List['_Metric'] = []
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 300.0)
+
+
+def _format_labels(labels: Tuple[Tuple[str, str], ...]) -> str:
+    if not labels:
+        return ''
+    escaped = (k + '="' + str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') + '"' for k, v in labels)
+    return '{' + ','.join(escaped) + '}'
+
+
+def _format_value(value: float) -> str:
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value))
+
+
+class _Metric:
+    type_name = ''
+
+    def __init__(self, name: str, description: str):
+        self.name = name
+        self.description = description
+        self._lock = threading.Lock()
+        _registry.append(self)
+
+    def _samples(self) -> List[str]:
+        raise NotImplementedError
+
+    def remove(self, **labels):
+        # drops the series of one label set, e.g. of a session that was removed
+        with self._lock:
+            self._values.pop(tuple(sorted(labels.items())), None)
+
+    def render(self) -> str:
+        lines = [f'# HELP {self.name} {self.description}', f'# TYPE {self.name} {self.type_name}']
+        with self._lock:
+            lines += self._samples()
+        return '\n'.join(lines)
+
+
+class Counter(_Metric):
+    type_name = 'counter'
+
+    def __init__(self, name: str, description: str):
+        super().__init__(name, description)
+        self._values: Dict[Tuple[Tuple[str, str], ...], float] = {}
+
+    def inc(self, amount: float = 1.0, **labels):
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            self._values[key] = self._values.get(key, 0.0) + amount
+
+    def _samples(self) -> List[str]:
+        return [f'{self.name}{_format_labels(k)} {_format_value(v)}' for k, v in self._values.items()]
+
+
+class Gauge(_Metric):
+    type_name = 'gauge'
+
+    def __init__(self, name: str, description: str):
+        super().__init__(name, description)
+        self._values: Dict[Tuple[Tuple[str, str], ...], float] = {}
+        self._functions: Dict[Tuple[Tuple[str, str], ...], Callable[[], float]] = {}
+
+    def set(self, value: float, **labels):
+        with self._lock:
+            self._values[tuple(sorted(labels.items()))] = value
+
+    def inc(self, amount: float = 1.0, **labels):
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            self._values[key] = self._values.get(key, 0.0) + amount
+
+    def dec(self, amount: float = 1.0, **labels):
+        self.inc(-amount, **labels)
+
+    def set_function(self, function: Callable[[], float], **labels):
+        # evaluated on every scrape instead of being kept up to date
+        with self._lock:
+            self._functions[tuple(sorted(labels.items()))] = function
+
+    def _samples(self) -> List[str]:
+        values = dict(self._values)
+        values.update({k: f() for k, f in self._functions.items()})
+        return [f'{self.name}{_format_labels(k)} {_format_value(v)}' for k, v in values.items()]
+
+
+class Histogram(_Metric):
+    type_name = 'histogram'
+
+    def __init__(self, name: str, description: str, buckets: Sequence[float] = DEFAULT_BUCKETS):
+        super().__init__(name, description)
+        self.buckets = tuple(sorted(buckets)) + (float('inf'),)
+        # label key -> (bucket counts, sum, count)
+        self._values: Dict[Tuple[Tuple[str, str], ...], Tuple[List[int], float, int]] = {}
+
+    def observe(self, value: float, **labels):
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            counts, total, count = self._values.get(key, ([0] * len(self.buckets), 0.0, 0))
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[i] += 1
+            self._values[key] = (counts, total + value, count + 1)
+
+    def _samples(self) -> List[str]:
+        samples = []
+        for key, (counts, total, count) in self._values.items():
+            for bound, bucket_count in zip(self.buckets, counts):
+                samples += [f'{self.name}_bucket{_format_labels(key + (("le", _format_value(bound)),))} {bucket_count}']
+            samples += [f'{self.name}_sum{_format_labels(key)} {_format_value(total)}']
+            samples += [f'{self.name}_count{_format_labels(key)} {count}']
+        return samples
+
+
+def render() -> str:
+    return '\n'.join(m.render() for m in _registry) + '\n'
+
+
+HTTP_REQUEST_SECONDS = Histogram('restshop_http_request_seconds', 'Time to answer http requests, by route and status')
+HTTP_REQUESTS_IN_FLIGHT = Gauge('restshop_http_requests_in_flight', 'Http requests being answered')
+
+
+class MetricsMiddleware:
+    # Times every http request. Requests are labelled with the path template of their route rather than the path, so
+    # that object names and ids do not create new series.
+
+    def __init__(self, app):
+        self.app = app
+        self._route_paths: Dict[Callable, str] = {}
+
+    def _route_path(self, scope) -> str:
+        # the router stores the endpoint of the matched route in the scope
+        endpoint = scope.get('endpoint')
+        if endpoint is None:
+            return 'unmatched'
+        if endpoint not in self._route_paths:
+            for route in scope['app'].router.routes:
+                if getattr(route, 'endpoint', None) is endpoint:
+                    self._route_paths[endpoint] = route.path
+                    break
+            else:
+                self._route_paths[endpoint] = 'unmatched'
+        return self._route_paths[endpoint]
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'http':
+            await self.app(scope, receive, send)
+            return
+
+        status = [500]
+
+        async def send_with_status(message):
+            if message['type'] == 'http.response.start':
+                status[0] = message['status']
+            await send(message)
+
+        HTTP_REQUESTS_IN_FLIGHT.inc()
+        start = time.perf_counter()
+        try:
+            await self.app(scope, receive, send_with_status)
+        finally:
+            HTTP_REQUESTS_IN_FLIGHT.dec()
+            HTTP_REQUEST_SECONDS.observe(
+                time.perf_counter() - start, method=scope['method'], route=self._route_path(scope), status=str(status[0])
+            )
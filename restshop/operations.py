@@ -0,0 +1,594 @@
+import re
+import time
+from fnmatch import fnmatchcase
+from datetime import datetime, timezone
+from typing import List, Dict, Tuple, Any, Optional, Union, OrderedDict
+
+from fastapi import HTTPException
+
+import numpy as np
+import pandas as pd
+
+from pyshop import ShopSession
+from pyshop.helpers.commands import get_commands_from_file
+from pyshop.shopcore.command_builder import get_derived_command_key
+
+from .schemas import *
+from .schemas import _isoformat_utc
+from .relations import RelationIndex
+from .catalog import AttributeCatalog
+from . import columnar
+from .messages import drain_messages
+
+# Every function in this module takes the ShopSession it operates on as its first argument and is the only place
+# where handlers touch shop_api. They are run on the executor owned by the session, see SessionManager.call
+
+
+def http_raise_internal(msg: str, e: Exception):
+    raise HTTPException(500, f'{msg} -- Internal Exception: {e}')
+
+
+def modifies_session(func):
+    # marks an operation that changes the state of the shop session, SessionManager.submit counts them
+    func.modifies_session = True
+    return func
+
+
+def runs_shop_command(func):
+    # marks an operation executing the SHOP command given as its first argument, SessionManager times it per command
+    func.runs_shop_command = True
+    return func
+
+
+def runs_shop_command_list(func):
+    # marks an operation executing several SHOP commands, it returns a CommandResult dict per command and
+    # SessionManager times each of them
+    func.runs_shop_command_list = True
+    return func
+
+
+def get_model_object_generator(sess: ShopSession, object_type: str):
+    if object_type not in sess.model._all_types:
+        raise HTTPException(400, f'object_type {{{object_type}}} is not implemented.')
+    return sess.model[object_type]
+
+
+def get_model_object_instance(sess: ShopSession, object_type: str, object_name: str):
+    model_object_generator = get_model_object_generator(sess, object_type)
+    if object_name not in model_object_generator._names:
+        raise HTTPException(400, f'object_name {{{object_name}}} is not an instance of object_type {{{object_type}}}.')
+    return model_object_generator[object_name]
+
+
+def select_attribute_names(
+    sess: ShopSession,
+    object_type: str,
+    attribute_filter: str = '*',
+    attributes: Optional[List[str]] = None,
+    inputs_only: bool = False,
+    outputs_only: bool = False
+    ) -> List[str]:
+    # attribute names of object_type in model order, narrowed down by an explicit list, a regex and input/output flags
+
+    catalog = AttributeCatalog.get(sess.shop_api)
+    names: List[str] = catalog.attribute_names(object_type)
+
+    if attributes:
+        unknown = [a for a in attributes if a not in names]
+        if unknown:
+            raise HTTPException(400, f'attributes {{{", ".join(unknown)}}} are not attributes of object_type {{{object_type}}}.')
+        names = [n for n in names if n in attributes]
+
+    if attribute_filter and attribute_filter != '*':
+        try:
+            pattern = re.compile(attribute_filter)
+        except re.error as e:
+            raise HTTPException(400, f'attribute_filter {{{attribute_filter}}} is not a valid regex: {e}')
+        names = [n for n in names if pattern.search(n)]
+
+    if inputs_only and outputs_only:
+        raise HTTPException(400, 'inputs_only and outputs_only can not both be set')
+    if inputs_only:
+        names = [n for n in names if catalog.info[object_type][n]['isInput']]
+    if outputs_only:
+        names = [n for n in names if catalog.info[object_type][n]['isOutput']]
+
+    return names
+
+# ------- time_resolution
+
+@modifies_session
+def set_time_resolution(sess: ShopSession, start_time: datetime, end_time: datetime, time_unit: str):
+    sess.set_time_resolution(starttime=start_time, endtime=end_time, timeunit=time_unit)
+
+
+def get_time_resolution(sess: ShopSession) -> Dict[str, Any]:
+    return sess.get_time_resolution()
+
+# ------ model
+
+def get_model_object_types(sess: ShopSession) -> List[str]:
+    return list(sess.model._all_types)
+
+
+def get_model_object_type_information(
+    sess: ShopSession,
+    object_type: str,
+    verbose: bool,
+    attribute_filter: str = '*',
+    attributes: Optional[List[str]] = None,
+    inputs_only: bool = False,
+    outputs_only: bool = False
+    ) -> Tuple[bytes, str]:
+    # serialized ObjectType and its ETag, attribute metadata comes from the catalog and is never read from pybind here
+
+    ot = get_model_object_generator(sess, object_type)
+    instances = list(ot.get_object_names())
+    catalog = AttributeCatalog.get(sess.shop_api)
+
+    if attribute_filter in ('', '*') and not attributes and not inputs_only and not outputs_only:
+        attribute_names = None
+    else:
+        attribute_names = select_attribute_names(
+            sess, object_type, attribute_filter, attributes, inputs_only, outputs_only
+        )
+
+    return serialize_object_type_information(catalog, object_type, instances, verbose, attribute_names)
+
+
+def set_model_object_attributes(
+    sess: ShopSession,
+    object_type: str,
+    object_name: str,
+    attributes: Dict[str, AttributeValue]
+    ) -> bool:
+    # creates the object if it does not exist yet and sets the given attributes, returns True if the object was created
+
+    try:
+        object_generator = sess.model[object_type]
+    except Exception as e:
+        raise HTTPException(500, f'model does not implement object_type {{{object_type}}}')
+
+    created = object_name not in object_generator.get_object_names()
+    if created:
+        try:
+            object_generator.add_object(object_name)
+        except Exception as e:
+            raise HTTPException(500, f'object_name {{{object_name}}} is in conflict with existing instance')
+
+    model_object = sess.model[object_type][object_name]
+
+    for (k,v) in (attributes or {}).items():
+
+        try:
+            datatype = AttributeCatalog.get(sess.shop_api).info[object_type][k]['datatype']
+        except Exception as e:
+            http_raise_internal(f'unknown object_attribute {k} for object_type {object_type}', e)
+
+        if datatype == 'txy':
+
+            # convert scalar values to TimeSeries
+            if type(v) == float or type(v) == int:
+                start_time = sess.get_time_resolution()['starttime']
+                v = TimeSeries(
+                    timestamps=[start_time],
+                    values=[[v]]
+                )
+            try:
+                time_series: TimeSeries = v
+                # index, values = zip(*time_series.values.items())
+                index, values = time_series.timestamps, np.transpose(time_series.values)
+                df = pd.DataFrame(index=index, data=values)
+                model_object[k].set(df)
+            except Exception as e:
+                http_raise_internal(f'trouble setting {{{datatype}}} ', e)
+
+        elif datatype == 'xy':
+            try:
+                curve: Curve = v
+                ser = pd.Series(index=curve.x_values, data=curve.y_values)
+                model_object[k].set(ser)
+            except Exception as e:
+                http_raise_internal(f'trouble setting {{{datatype}}} ', e)
+
+        elif datatype in ['xy_array', 'xyn']:
+            try:
+                curves: OrderedDict[float, Curve] = v
+                ser_list = []
+                for ref, curve in curves.items():
+                    ser_list += [pd.Series(index=curve.x_values, data=curve.y_values, name=ref)]
+                model_object[k].set(ser_list)
+            except Exception as e:
+                http_raise_internal(f'trouble setting {{{datatype}}} ', e)
+
+        elif datatype == 'xyt':
+            try:
+                curves: OrderedDict[datetime, Curve] = v
+                ser_list = []
+                for ref, curve in curves.items():
+                    ser_list += [pd.Series(index=curve.x_values, data=curve.y_values, name=ref)]
+                model_object[k].set(ser_list)
+            except Exception as e:
+                http_raise_internal(f'trouble setting {{{datatype}}} ', e)
+
+        elif datatype == 'double':
+            model_object[k].set(float(v))
+
+        elif datatype == 'int':
+            model_object[k].set(int(v))
+
+        else:
+            try:
+                model_object[k].set(v)
+            except Exception as e:
+                http_raise_internal(f'trouble setting {{{datatype}}} ', e)
+
+    return created
+
+
+@modifies_session
+def create_or_modify_model_object_instance(
+    sess: ShopSession,
+    object_type: str,
+    object_name: str,
+    attributes: Dict[str, AttributeValue]
+    ) -> bytes:
+    # the resulting ObjectInstance as json
+
+    set_model_object_attributes(sess, object_type, object_name, attributes)
+    o = get_model_object_instance(sess, object_type, object_name)
+    return encode_model_object_instance(o)
+
+
+@modifies_session
+def upsert_model(sess: ShopSession, model: ModelUpsert, return_objects: bool) -> ModelUpsertStatus:
+    # applies all objects first, then all connections, so connections may refer to objects created in the same call
+
+    objects = []
+    for o in model.objects:
+        try:
+            created = set_model_object_attributes(sess, o.object_type, o.object_name, o.attributes)
+            objects += [ObjectUpsertStatus(
+                object_type=o.object_type, object_name=o.object_name, created=created, attributes_set=len(o.attributes)
+            )]
+        except HTTPException as e:
+            objects += [ObjectUpsertStatus(object_type=o.object_type, object_name=o.object_name, error=e.detail)]
+        except Exception as e:
+            objects += [ObjectUpsertStatus(object_type=o.object_type, object_name=o.object_name, error=str(e))]
+
+    connection_errors = []
+    for connection in model.connections:
+        try:
+            add_connections(sess, [connection])
+        except HTTPException as e:
+            connection_errors += [e.detail]
+        except Exception as e:
+            connection_errors += [str(e)]
+
+    instances = None
+    if return_objects:
+        instances = [
+            serialize_model_object_instance(get_model_object_instance(sess, o.object_type, o.object_name))
+            for o in objects if o.error is None
+        ]
+
+    return ModelUpsertStatus(
+        objects=objects,
+        connections_added=len(model.connections) - len(connection_errors),
+        connection_errors=connection_errors,
+        instances=instances,
+    )
+
+
+def get_model_object_instance_serialized(
+    sess: ShopSession,
+    object_type: str,
+    object_name: str,
+    attribute_filter: str = '*',
+    attributes: Optional[List[str]] = None,
+    inputs_only: bool = False,
+    outputs_only: bool = False
+    ) -> bytes:
+    # ObjectInstance as json, ready to be cached, see SessionManager.call_cached
+    o = get_model_object_instance(sess, object_type, object_name)
+    attribute_names = select_attribute_names(sess, object_type, attribute_filter, attributes, inputs_only, outputs_only)
+    return encode_model_object_instance(o, attribute_names)
+
+
+def check_model_object(
+    sess: ShopSession,
+    object_type: str,
+    object_name: str,
+    attribute_filter: str = '*',
+    attributes: Optional[List[str]] = None,
+    inputs_only: bool = False,
+    outputs_only: bool = False
+    ) -> None:
+    # fails like get_model_object_instance_serialized for a missing object or attribute, without reading any values
+    get_model_object_instance(sess, object_type, object_name)
+    select_attribute_names(sess, object_type, attribute_filter, attributes, inputs_only, outputs_only)
+
+
+def get_model_object_attribute(
+    sess: ShopSession,
+    object_type: str,
+    object_name: str,
+    attribute_name: str,
+    media_type: str = columnar.JSON
+    ) -> bytes:
+    # binary media types are read straight from the core into numpy columns, json goes through the usual serializer
+
+    o = get_model_object_instance(sess, object_type, object_name)
+    select_attribute_names(sess, object_type, attributes=[attribute_name])
+    if media_type == columnar.JSON:
+        return dump_json(encode_model_object_attribute(getattr(o, attribute_name)))
+
+    datatype = AttributeCatalog.get(sess.shop_api).info[object_type][attribute_name]['datatype']
+    table = columnar.get_attribute_table(sess.shop_api, object_type, object_name, attribute_name, datatype)
+    return columnar.encode_table(table, media_type)
+
+
+def _utc_datetime64(time: datetime) -> np.datetime64:
+    if time.tzinfo is not None:
+        time = time.astimezone(timezone.utc).replace(tzinfo=None)
+    return np.datetime64(time, 's')
+
+
+def query_model_attributes(sess: ShopSession, query: AttributeQuery, media_type: str = columnar.JSON) -> bytes:
+    # one frame holding the txy attributes of every object matching the globs, see columnar.txy_frame. Objects are
+    # found and read through shop_api directly, each series is read once.
+
+    shop_api = sess.shop_api
+    info = AttributeCatalog.get(shop_api).info
+    selected = [
+        (object_type, object_name)
+        for object_type, object_name in zip(shop_api.GetObjectTypesInSystem(), shop_api.GetObjectNamesInSystem())
+        if any(fnmatchcase(object_type, p) for p in query.object_types) and any(fnmatchcase(object_name, p) for p in query.object_names)
+    ]
+    if not selected:
+        raise HTTPException(404, f'no objects match types {{{", ".join(query.object_types)}}} and names {{{", ".join(query.object_names)}}}')
+
+    selected_types = {object_type for object_type, _ in selected}
+    for attribute_name in query.attributes:
+        datatypes = {info[t][attribute_name]['datatype'] for t in selected_types if attribute_name in info[t]}
+        if not datatypes:
+            raise HTTPException(400, f'none of the selected object types has the attribute {{{attribute_name}}}')
+        if datatypes != {'txy'}:
+            raise HTTPException(400, f'attribute {{{attribute_name}}} is not a txy attribute, only those can be queried')
+
+    start = _utc_datetime64(query.start_time) if query.start_time else columnar._shop_datetime64(shop_api.GetStartTime())
+    end = _utc_datetime64(query.end_time) if query.end_time else columnar._shop_datetime64(shop_api.GetEndTime())
+    if start >= end:
+        raise HTTPException(400, f'start_time {{{start}}} must be before end_time {{{end}}}')
+
+    tables = {
+        f'{object_type}.{object_name}.{attribute_name}': columnar.get_attribute_table(shop_api, object_type, object_name, attribute_name, 'txy')
+        for object_type, object_name in selected
+        for attribute_name in query.attributes if attribute_name in info[object_type]
+    }
+    frame = columnar.txy_frame(tables, start, end)
+    if media_type != columnar.JSON:
+        return columnar.encode_table(frame, media_type)
+
+    # NaN is not json, missing values are null
+    content = {'time': _isoformat_utc(frame.pop('time'))}
+    for name, column in frame.items():
+        values = column.astype(object)
+        values[np.isnan(column)] = None
+        content[name] = values.tolist()
+    return dump_json(content)
+
+
+def summarize_outputs(sess: ShopSession, outputs: List[SweepOutput]) -> Dict[str, Optional[float]]:
+    # one number per output, the aggregate of the first scenario of a txy attribute or the value of a number
+
+    info = AttributeCatalog.get(sess.shop_api).info
+    summary = {}
+    for output in outputs:
+        object_type, object_name, attribute_name = output.object_type, output.object_name, output.attribute_name
+        o = get_model_object_instance(sess, object_type, object_name)
+        datatype = info[object_type].get(attribute_name, {}).get('datatype')
+
+        if datatype == 'txy':
+            y = columnar.get_attribute_table(sess.shop_api, object_type, object_name, attribute_name, datatype)['y_0']
+            aggregate = getattr(np, f'nan{output.aggregate.value}')
+            value = float(aggregate(y)) if np.any(~np.isnan(y)) else None
+            summary[f'{object_type}.{object_name}.{attribute_name}.{output.aggregate.value}'] = value
+        elif datatype in ('double', 'int'):
+            value = getattr(o, attribute_name).get()
+            summary[f'{object_type}.{object_name}.{attribute_name}'] = None if value is None else float(value)
+        else:
+            raise HTTPException(400, f'attribute {{{attribute_name}}} of {{{object_type}}} is neither txy nor a number and cannot be summarized')
+    return summary
+
+
+@modifies_session
+def set_model_object_attribute(
+    sess: ShopSession,
+    object_type: str,
+    object_name: str,
+    attribute_name: str,
+    content: bytes,
+    media_type: str
+    ):
+
+    get_model_object_instance(sess, object_type, object_name)
+    select_attribute_names(sess, object_type, attributes=[attribute_name])
+    datatype = AttributeCatalog.get(sess.shop_api).info[object_type][attribute_name]['datatype']
+    table = columnar.decode_table(content, media_type)
+    columnar.set_attribute_table(sess.shop_api, object_type, object_name, attribute_name, datatype, table)
+
+
+@modifies_session
+def patch_model_object_attribute(
+    sess: ShopSession,
+    object_type: str,
+    object_name: str,
+    attribute_name: str,
+    content: bytes,
+    media_type: str,
+    end_time: Optional[datetime] = None
+    ):
+    # merges a window into a txy attribute, see columnar.merge_txy_tables. The series is read and written as arrays,
+    # only the points of the patch are parsed.
+
+    get_model_object_instance(sess, object_type, object_name)
+    select_attribute_names(sess, object_type, attributes=[attribute_name])
+    datatype = AttributeCatalog.get(sess.shop_api).info[object_type][attribute_name]['datatype']
+    if datatype != 'txy':
+        raise HTTPException(400, f'attribute {{{attribute_name}}} is of datatype {{{datatype}}}, only txy attributes can be patched')
+
+    if media_type == columnar.JSON:
+        try:
+            series = TimeSeries.parse_raw(content)
+        except ValueError as e:
+            raise HTTPException(400, f'could not parse TimeSeries body: {e}')
+        patch = {'time': np.array([_utc_datetime64(t) for t in series.timestamps], dtype='datetime64[s]')}
+        patch.update({f'y_{i}': np.asarray(values, dtype=float) for i, values in enumerate(series.values)})
+        if any(v.size != patch['time'].size for v in patch.values()):
+            raise HTTPException(400, 'every list of values must have one value per timestamp')
+    else:
+        patch = columnar.decode_table(content, media_type)
+
+    current = columnar.get_attribute_table(sess.shop_api, object_type, object_name, attribute_name, datatype)
+    end = _utc_datetime64(end_time) if end_time else None
+    merged = columnar.merge_txy_tables(current, patch, end, sess.shop_api.GetTimeUnit())
+    columnar.set_attribute_table(sess.shop_api, object_type, object_name, attribute_name, datatype, merged)
+
+# ------ connection
+
+def get_relation_index(sess: ShopSession, version: Optional[str] = None) -> RelationIndex:
+    # the index is kept on the session, in whichever process holds it, and built again once version changes. version
+    # identifies the session and its state, e.g. its etag, see SessionManager.get_etag. Without one it is always built.
+    if version is None:
+        return RelationIndex.build(sess.shop_api)
+    # ShopSession turns unknown attributes into SHOP commands, so the cache is looked up in its __dict__
+    cached = sess.__dict__.get('_relation_index')
+    if cached is None or cached[0] != version:
+        cached = (version, RelationIndex.build(sess.shop_api))
+        sess._relation_index = cached
+    return cached[1]
+
+
+def get_connections(sess: ShopSession, format: ConnectionFormatEnum = ConnectionFormatEnum.connections,
+                    version: Optional[str] = None) -> bytes:
+    # List[Connection] or ConnectionGraph as json, built from plain dicts and arrays, see encode_model_object_instance
+
+    index = get_relation_index(sess, version)
+    nodes = [{'object_type': t, 'object_name': n} for t, n in zip(index.object_types, index.object_names)]
+
+    if format == ConnectionFormatEnum.edge_list:
+        return dump_json({
+            'nodes': nodes,
+            'edges': np.array([[i, j] for i, j, _, _ in index.edges], dtype=np.int64).reshape(-1, 2),
+            'relation_types': [r for _, _, r, _ in index.edges],
+            'relation_directions': [d for _, _, _, d in index.edges],
+        })
+
+    if format == ConnectionFormatEnum.csr:
+        indptr, indices, edges = index.csr()
+        return dump_json({
+            'nodes': nodes,
+            'indptr': indptr.astype(np.int64),
+            'indices': indices.astype(np.int64),
+            'relation_types': [r for _, _, r, _ in edges],
+            'relation_directions': [d for _, _, _, d in edges],
+        })
+
+    return dump_json([
+        {
+            'from_object': nodes[i],
+            'to_object': nodes[j],
+            'relation_type': relation_type,
+            'relation_direction': relation_direction,
+        } for i, j, relation_type, relation_direction in index.edges
+    ])
+
+
+@modifies_session
+def add_connections(sess: ShopSession, connections: List[Connection]):
+
+    for connection in connections:
+
+        fo_type, fo_name = connection.from_object.object_type, connection.from_object.object_name
+        to_type, to_name = connection.to_object.object_type, connection.to_object.object_name
+        relation_type = connection.relation_type if connection.relation_type != 'default' else ''
+
+        fo = get_model_object_instance(sess, fo_type, fo_name)
+        to = get_model_object_instance(sess, to_type, to_name)
+
+        fo.connect(connection_type=relation_type)[to_type][to_name].add()
+
+
+@modifies_session
+def add_connection(sess: ShopSession, from_type: str, from_name: str, to_type: str, to_name: str, connection_type: str):
+
+    fo = get_model_object_instance(sess, from_type, from_name)
+    to = get_model_object_instance(sess, to_type, to_name)
+    fo.connect(connection_type=connection_type)[to_type][to_name].add()
+
+# ------ shop commands
+
+@modifies_session
+@runs_shop_command
+def execute_command(sess: ShopSession, command: str, options: List[str], values: List[str]) -> bool:
+    sess._command = command
+    try:
+        return sess._execute_command(options, values)
+    finally:
+        drain_messages(command)
+
+
+def parse_command_file(command_file: str) -> List[Dict[str, Any]]:
+    # the commands of a SHOP run file, in the form of CommandListEntry
+    return [
+        {'command': c['command'].replace(' ', '_'), 'options': c['options'], 'values': c['values']}
+        for c in get_commands_from_file(command_file)
+    ]
+
+
+@modifies_session
+@runs_shop_command_list
+def execute_command_list(sess: ShopSession, commands: List[Dict[str, Any]], stop_on_error: bool = True) -> List[Dict[str, Any]]:
+
+    # every command is resolved before the first one runs, a typo at the end does not leave the session half way
+    resolved = []
+    for c in commands:
+        try:
+            command = get_derived_command_key(c['command'].lower(), sess._commands)
+        except ValueError as e:
+            raise HTTPException(400, f'{e}')
+        options = [str(o) for o in c.get('options', []) if str(o)]
+        values = [str(v) for v in c.get('values', []) if str(v)]
+        resolved.append((command, options, values))
+
+    results = []
+    failed = False
+    for command, options, values in resolved:
+        result = {
+            'command': command, 'options': options, 'values': values,
+            'message': 'skipped', 'status': False, 'executed': False, 'wall_seconds': 0.0
+        }
+        if not (failed and stop_on_error):
+            start = time.perf_counter()
+            try:
+                status = bool(sess.shop_api.ExecuteCommand(sess._commands[command], options, values))
+                result.update(message=('ok' if status else 'something went wrong ...'), status=status)
+            except Exception as e:
+                result.update(message='failed to execute simulation command', error=f'{e}')
+            result.update(executed=True, wall_seconds=time.perf_counter() - start)
+            failed = failed or not result['status']
+            # between two commands SHOP is idle, its messages can be read on this thread
+            drain_messages(command)
+        results.append(result)
+    return results
+
+# ------ internal methods
+
+def get_available_internal_methods(sess: ShopSession) -> List[str]:
+    command_types = sess.shop_api.__dir__()
+    return list(filter(lambda x: x[0] != '_', command_types))
+
+
+def get_internal_method_description(sess: ShopSession, command: str) -> str:
+    return str(getattr(sess.shop_api, command).__doc__)
@@ -0,0 +1,211 @@
+import asyncio
+import contextvars
+import cProfile
+import hmac
+import io
+import json
+import os
+import pstats
+import threading
+import time
+from typing import List, Dict, Tuple, Any, Optional
+from urllib.parse import parse_qs
+
+from starlette.datastructures import Headers
+
+from . import config
+
+# On demand profiling of single requests, for admins only. A request with ?profile=true or the X-Profile header and
+# the admin token in X-Admin-Token is run under cProfile: on the event loop for the request handling itself, and on the
+# session executor, or inside the worker process hosting the session, for every operation it awaits. The normal
+# response is returned as "response" next to the merged "profile".
+#
+# Only one profiler of a request is active at any time. The one on the event loop is paused while an operation runs
+# under its own, and profiled operations in one process run one at a time. Since python 3.12 cProfile is a
+# sys.monitoring tool, and a second active profiler in the same process fails with "Another profiling tool is already
+# active". pyshop itself supports python 3.7 and 3.8, see the README.
+
+PROFILE_HEADER = 'x-profile'
+ADMIN_TOKEN_HEADER = 'x-admin-token'
+
+# self time is attributed to the first category whose test matches the function
+CATEGORIES = ['restshop.schemas', 'pyshop.shopcore.shop_api', 'shop_api native', 'event loop idle', 'other']
+
+_SCHEMAS_FILE = os.path.join('restshop', 'schemas.py')
+_SHOP_API_FILE = os.path.join('pyshop', 'shopcore', 'shop_api.py')
+
+# profile of the request being handled, read by SessionManager.submit
+active_profile: contextvars.ContextVar = contextvars.ContextVar('restshop_active_profile', default=None)
+
+
+def _category(function: Tuple[str, int, str]) -> str:
+    filename, _, name = function
+    if filename.endswith(_SCHEMAS_FILE):
+        return 'restshop.schemas'
+    if filename.endswith(_SHOP_API_FILE):
+        return 'pyshop.shopcore.shop_api'
+    # pybind methods show up as built-ins of a PyCapsule
+    if 'shop_pybind' in filename or (filename == '~' and ('PyCapsule' in name or 'shop_pybind' in name)):
+        return 'shop_api native'
+    # the event loop waiting for the executor, or the worker waiting for its pipe
+    if filename == '~' and "of 'select." in name:
+        return 'event loop idle'
+    return 'other'
+
+
+class _StatsData:
+    # pstats.Stats only loads from files and objects with create_stats
+    def __init__(self, stats: Dict):
+        self.stats = stats
+
+    def create_stats(self):
+        pass
+
+
+# held by the profiled operation running in this process
+_profiled_call_lock = threading.Lock()
+
+
+def profiled_call(sess: Any, func, *args, **kwargs) -> Tuple[Any, Dict]:
+    # runs func(sess, *args, **kwargs) under cProfile, in whichever process holds sess. Returns the result and the raw
+    # pstats data, which pickles.
+    with _profiled_call_lock:
+        profile = cProfile.Profile()
+        result = profile.runcall(func, sess, *args, **kwargs)
+        profile.create_stats()
+    return result, profile.stats
+
+
+class RequestProfile:
+
+    def __init__(self):
+        self._stats: Optional[pstats.Stats] = None
+        self._lock = threading.Lock()
+        # the profiler of the event loop part, paused while operations of the request run, see suspend
+        self.loop_profile = cProfile.Profile()
+        self._running = False
+        self._suspended = 0
+
+    def start(self):
+        self._running = True
+        if not self._suspended:
+            self.loop_profile.enable()
+
+    def stop(self):
+        if self._running and not self._suspended:
+            self.loop_profile.disable()
+        self._running = False
+
+    def suspend(self):
+        # called on the event loop before an operation of the request is run under a profiler of its own
+        if self._running and not self._suspended:
+            self.loop_profile.disable()
+        self._suspended += 1
+
+    def resume(self):
+        self._suspended -= 1
+        if self._running and not self._suspended:
+            self.loop_profile.enable()
+
+    def add(self, stats: Dict):
+        with self._lock:
+            if self._stats is None:
+                self._stats = pstats.Stats(_StatsData(stats))
+            else:
+                self._stats.add(_StatsData(stats))
+
+    def report(self, wall_seconds: float, limit: int = 40) -> Dict[str, Any]:
+        with self._lock:
+            if self._stats is None:
+                return {'wall_seconds': wall_seconds, 'breakdown': {}, 'stats': ''}
+
+            breakdown = {c: 0.0 for c in CATEGORIES}
+            for function, (_, _, tottime, _, _) in self._stats.stats.items():
+                breakdown[_category(function)] += tottime
+
+            text = io.StringIO()
+            self._stats.stream = text
+            self._stats.sort_stats('cumulative').print_stats(limit)
+            self._stats.print_callees(limit)
+            return {'wall_seconds': wall_seconds, 'breakdown': breakdown, 'stats': text.getvalue()}
+
+
+def _is_admin(headers: Headers) -> bool:
+    token = headers.get(ADMIN_TOKEN_HEADER, '')
+    return bool(config.ADMIN_TOKEN) and hmac.compare_digest(token.encode(), config.ADMIN_TOKEN.encode())
+
+
+def _wants_profile(scope, headers: Headers) -> bool:
+    query = parse_qs(scope.get('query_string', b'').decode('latin-1'))
+    value = headers.get(PROFILE_HEADER) or (query.get('profile') or [''])[-1]
+    return value.lower() in ('1', 'true', 'yes')
+
+
+class ProfilingMiddleware:
+    # cProfile can only profile one request on the event loop at a time, profiled requests are run one by one. Work of
+    # other requests interleaved on the event loop shows up in the loop part of the profile.
+
+    def __init__(self, app):
+        self.app = app
+        self._lock: Optional[asyncio.Lock] = None
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'http':
+            await self.app(scope, receive, send)
+            return
+
+        headers = Headers(scope=scope)
+        if not _wants_profile(scope, headers):
+            await self.app(scope, receive, send)
+            return
+
+        if not _is_admin(headers):
+            body = json.dumps({'detail': 'profiling requires the admin token'}).encode()
+            await send({'type': 'http.response.start', 'status': 403, 'headers': [
+                (b'content-type', b'application/json'), (b'content-length', str(len(body)).encode())
+            ]})
+            await send({'type': 'http.response.body', 'body': body})
+            return
+
+        start_message = {}
+        chunks: List[bytes] = []
+
+        async def buffer(message):
+            if message['type'] == 'http.response.start':
+                start_message.update(message)
+            elif message['type'] == 'http.response.body':
+                chunks.append(message.get('body', b''))
+
+        if self._lock is None:
+            # created on the event loop serving the requests
+            self._lock = asyncio.Lock()
+        request_profile = RequestProfile()
+        async with self._lock:
+            token = active_profile.set(request_profile)
+            start = time.perf_counter()
+            request_profile.start()
+            try:
+                await self.app(scope, receive, buffer)
+            finally:
+                request_profile.stop()
+                active_profile.reset(token)
+            wall_seconds = time.perf_counter() - start
+        request_profile.loop_profile.create_stats()
+        request_profile.add(request_profile.loop_profile.stats)
+
+        content = b''.join(chunks)
+        response_headers = Headers(raw=start_message.get('headers', []))
+        if response_headers.get('content-type', '').startswith('application/json') and content:
+            response = json.loads(content)
+        else:
+            response = content.decode('utf-8', errors='replace')
+
+        body = json.dumps({
+            'status_code': start_message.get('status', 500),
+            'response': response,
+            'profile': request_profile.report(wall_seconds),
+        }).encode()
+        await send({'type': 'http.response.start', 'status': start_message.get('status', 500), 'headers': [
+            (b'content-type', b'application/json'), (b'content-length', str(len(body)).encode())
+        ]})
+        await send({'type': 'http.response.body', 'body': body})
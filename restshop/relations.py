@@ -0,0 +1,58 @@
+from typing import List, Dict, Tuple
+
+import numpy as np
+
+
+class RelationIndex:
+    # Edges (from_index, to_index, relation_type, relation_direction) between the objects in the system, indices refer
+    # to the order of GetObjectNamesInSystem. Built from GetRelations and GetInputRelations only, no attribute values
+    # are read.
+    #
+    # Relations are told apart by their relationCategory like pyshop's get_relations does. Physical relations are
+    # directed, they are listed once from their source with direction output, their input side is the same edge.
+    # Logical relations are bidirectional and show up from both ends, they are listed once with direction both.
+
+    def __init__(self, object_types: List[str], object_names: List[str], edges: List[Tuple[int, int, str, str]]):
+        self.object_types = object_types
+        self.object_names = object_names
+        self.edges = edges
+
+    @staticmethod
+    def build(shop_api) -> 'RelationIndex':
+        object_types = list(shop_api.GetObjectTypesInSystem())
+        object_names = list(shop_api.GetObjectNamesInSystem())
+
+        valid_relation_types: Dict[str, List[str]] = {
+            object_type: list(shop_api.GetValidRelationTypes(object_type)) for object_type in set(object_types)
+        }
+        categories: Dict[Tuple[str, str], str] = {}
+
+        def category(from_type: str, to_type: str) -> str:
+            if (from_type, to_type) not in categories:
+                categories[(from_type, to_type)] = shop_api.GetRelationInfo(from_type, to_type, 'relationCategory')
+            return categories[(from_type, to_type)]
+
+        # keyed by the edge, or by both ends in either order for logical ones, dict keeps the order they were found in
+        edges: Dict[tuple, Tuple[int, int, str, str]] = {}
+        for i, (object_type, object_name) in enumerate(zip(object_types, object_names)):
+            for relation_type in valid_relation_types[object_type]:
+                for j in map(int, shop_api.GetRelations(object_type, object_name, relation_type)):
+                    if category(object_type, object_types[j]) == 'logical':
+                        edges.setdefault((min(i, j), max(i, j), relation_type), (i, j, relation_type, 'both'))
+                    else:
+                        edges.setdefault((i, j, relation_type), (i, j, relation_type, 'output'))
+                for j in map(int, shop_api.GetInputRelations(object_type, object_name, relation_type)):
+                    if category(object_types[j], object_type) == 'logical':
+                        edges.setdefault((min(i, j), max(i, j), relation_type), (j, i, relation_type, 'both'))
+
+        return RelationIndex(object_types, object_names, list(edges.values()))
+
+    def csr(self) -> Tuple[np.ndarray, np.ndarray, List[Tuple[int, int, str, str]]]:
+        # compressed sparse row adjacency, the targets of node i are indices[indptr[i]:indptr[i+1]]. The edges are
+        # returned in the order of indices.
+        edges = sorted(self.edges, key=lambda e: e[0])
+        sources = np.fromiter((e[0] for e in edges), int, len(edges))
+        indptr = np.zeros(len(self.object_names) + 1, dtype=int)
+        np.cumsum(np.bincount(sources, minlength=len(self.object_names)), out=indptr[1:])
+        indices = np.fromiter((e[1] for e in edges), int, len(edges))
+        return indptr, indices, edges
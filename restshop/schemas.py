@@ -1,22 +1,28 @@
 import collections
+import hashlib
+import json
 
-from typing import List, Dict, Optional, Union, Any, OrderedDict
+from typing import List, Dict, Tuple, Optional, Union, Any, OrderedDict
 from enum import Enum
 from pydantic import BaseModel, Field
 from datetime import datetime
 from fastapi import HTTPException
+from fastapi.encoders import jsonable_encoder
 
 import numpy as np
 import pandas as pd
 
-from .sessions import SessionManager
+try:
+    import orjson
+except ImportError:
+    orjson = None
 
-# this dummy user and session is used to dynamically get enums and other metadata from a live ShopSession
-# TODO: make this cleaner, ... wrap in some init construct or something.
-dummy_user = '__dummy_user__'
-SessionManager.add_user_session('__dummy_user__', None)
-SessionManager.add_shop_session(dummy_user, 'default_session')
-_shop_session = SessionManager.get_shop_session(dummy_user, 1)
+from .catalog import AttributeCatalog
+from .metadata import load_shop_metadata
+
+# enums and attribute metadata of the installed SHOP, read from the metadata cache or from a live ShopSession
+_shop_metadata = load_shop_metadata()
+_attribute_catalog = AttributeCatalog.register(_shop_metadata.attribute_catalog())
 
 class StrEnum(str, Enum):
     pass
@@ -49,18 +55,18 @@ class Item(BaseModel):
     price: float
     tax: Optional[float] = None
 
-_SHOP_OBJECT_TYPE_NAMES = _shop_session.model._all_types
+_SHOP_OBJECT_TYPE_NAMES = _shop_metadata.object_types
 _SHOP_RELATION_TYPES = [
-    _shop_session.shop_api.GetValidRelationTypes(object_type)
+    _shop_metadata.relation_types[object_type]
     for object_type in _SHOP_OBJECT_TYPE_NAMES
 ] # flattens
 _SHOP_RELATION_TYPES = [e for sub in _SHOP_RELATION_TYPES for e in sub ]
-_SHOP_COMMANDS = _shop_session._commands
+_SHOP_COMMANDS = _shop_metadata.commands
 
 ApiCommandEnum = StrEnum(
     'ApiCommandEnum',
     names={
-        name: name for name in filter(lambda x : x[0] != '_', _shop_session.shop_api.__dir__())
+        name: name for name in _shop_metadata.api_methods
     }
 )
 
@@ -99,6 +105,11 @@ class Session(BaseModel):
     session_id: Optional[int] = Field(1, description='unique session identifier per user session')
     session_name: Optional[str] = Field('unnamed', description='name of session')
 
+class CloneMethodEnum(str, Enum):
+    auto = 'auto'
+    yaml = 'yaml'
+    fork = 'fork'
+
 # Commands
 
 class Commands(BaseModel):
@@ -109,6 +120,22 @@ class CommandStatus(BaseModel):
     status: bool
     error: Optional[str] = None
 
+class JobStatusEnum(str, Enum):
+    queued = 'queued'
+    running = 'running'
+    finished = 'finished'
+    failed = 'failed'
+    cancelled = 'cancelled'
+
+class Job(BaseModel):
+    job_id: int = Field(description='unique job identifier per user session')
+    command: str = Field(description='shop command executed by the job')
+    status: JobStatusEnum
+    created_at: datetime = Field(description='time the job was queued')
+    started_at: Optional[datetime] = Field(None, description='time the command started executing')
+    finished_at: Optional[datetime] = Field(None, description='time the job finished, failed or was cancelled')
+    result: Optional[CommandStatus] = None
+
 class ApiCommands(BaseModel):
     command_types: List[str] = None
     
@@ -266,6 +293,87 @@ class ObjectType(BaseModel):
     attributes: Optional[Dict[str, Union[ObjectAttributeTypeEnum, ObjectAttribute]]]  \
         = Field(description='attributes that can be set on the given object_type')
 
+def object_attribute_from_info(attribute_name: str, datatype: str, info: Dict[str, Any]) -> ObjectAttribute:
+    return ObjectAttribute(
+        attribute_name = attribute_name,
+        attribute_type = new_attribute_type_name_from_old(datatype),
+        is_input = info['isInput'],
+        is_output = info['isOutput'],
+        legacy_datatype = info['datatype'],
+        x_unit = info['xUnit'],
+        y_unit = info['yUnit'],
+        license_name = info['licenseName'],
+        full_name = info['fullName'],
+        data_func_name = info['dataFuncName'],
+        description = info['description'],
+        documentation_url = info['documentationUrl'],
+        example_url_prefix = info['exampleUrlPrefix'],
+        example = info['example']
+    )
+
+def _json_default(value: Any) -> Any:
+    # numpy arrays orjson cannot take as is (non contiguous, object dtype) and everything else fastapi knows how to encode
+    if isinstance(value, np.ndarray):
+        return value.tolist()
+    if isinstance(value, np.generic):
+        return value.item()
+    return jsonable_encoder(value)
+
+def dump_json(content: Any) -> bytes:
+    # same encoding as a fastapi response without a response_model filter. Content may hold pydantic models and numpy
+    # arrays, with orjson the arrays are written straight from their buffers.
+    if orjson is not None:
+        return orjson.dumps(content, default=_json_default, option=orjson.OPT_SERIALIZE_NUMPY | orjson.OPT_NON_STR_KEYS)
+    return json.dumps(
+        content, default=_json_default, ensure_ascii=False, allow_nan=False, separators=(',', ':')
+    ).encode('utf-8')
+
+def _serialize_object_type_attributes(
+    catalog: AttributeCatalog,
+    object_type: str,
+    verbose: bool,
+    attribute_names: List[str]
+    ) -> bytes:
+
+    datatypes = catalog.datatypes[object_type]
+    if not verbose:
+        attributes = {n: new_attribute_type_name_from_old(datatypes[n]) for n in attribute_names}
+    else:
+        attributes = {
+            n: object_attribute_from_info(n, datatypes[n], catalog.info[object_type][n]).dict(exclude_unset=True)
+            for n in attribute_names
+        }
+    return dump_json(attributes)
+
+def serialize_object_type_information(
+    catalog: AttributeCatalog,
+    object_type: str,
+    instances: List[str],
+    verbose: bool,
+    attribute_names: Optional[List[str]] = None
+    ) -> Tuple[bytes, str]:
+    # ObjectType as json bytes and its ETag. The attributes of the full selection are serialized once per catalog,
+    # only the instances are serialized per request.
+
+    if attribute_names is None:
+        key = ('information', object_type, verbose)
+        if key not in catalog.serialized:
+            attributes = _serialize_object_type_attributes(catalog, object_type, verbose, catalog.attribute_names(object_type))
+            catalog.serialized[key] = (attributes, hashlib.sha1(attributes).hexdigest())
+        attributes, attributes_digest = catalog.serialized[key]
+    else:
+        attributes = _serialize_object_type_attributes(catalog, object_type, verbose, attribute_names)
+        attributes_digest = hashlib.sha1(attributes).hexdigest()
+
+    instances_bytes = dump_json(instances)
+    body = b''.join([
+        b'{"object_type":', dump_json(object_type),
+        b',"instances":', instances_bytes,
+        b',"attributes":', attributes, b'}'
+    ])
+    etag = hashlib.sha1(f'{catalog.shop_version}:{attributes_digest}:'.encode('utf-8') + instances_bytes).hexdigest()
+    return body, f'"{etag}"'
+
 # Connection
 
 class ObjectID(BaseModel):
@@ -278,18 +386,50 @@ class Connection(BaseModel):
     relation_type: RelationTypeEnum = Field(RelationTypeEnum.default, desription="relation type")
     relation_direction: RelationDirectionEnum = RelationDirectionEnum.both
 
+class ConnectionFormatEnum(str, Enum):
+    connections = 'connections'
+    edge_list = 'edge_list'
+    csr = 'csr'
+
+class ConnectionGraph(BaseModel):
+    nodes: List[ObjectID] = Field(description='all objects in the system, edges refer to positions in this list')
+    edges: Optional[List[List[int]]] = Field(None, description='[from, to] node index pairs (edge_list)')
+    indptr: Optional[List[int]] = Field(None, description='targets of node i are indices[indptr[i]:indptr[i+1]] (csr)')
+    indices: Optional[List[int]] = Field(None, description='target node indices (csr)')
+    relation_types: List[str] = Field(description='relation type of each edge, aligned with edges or indices')
+    relation_directions: List[RelationDirectionEnum] = Field(
+        description='output for directed (physical) relations, both for bidirectional (logical) ones, listed once'
+    )
+
 # Model
 
 class Model(BaseModel):
     object_types: List[str] = Field(description='list of implemented model object types and associated information')
 
+class ModelUpsert(BaseModel):
+    objects: List[ObjectInstance] = Field([], description='objects to create or modify, with the attributes to set')
+    connections: List[Connection] = Field([], description='connections to add once all objects exist')
+
+class ObjectUpsertStatus(BaseModel):
+    object_type: str
+    object_name: str
+    created: bool = Field(False, description='true if the object did not exist before')
+    attributes_set: int = Field(0, description='number of attributes set on the object')
+    error: Optional[str] = None
+
+class ModelUpsertStatus(BaseModel):
+    objects: List[ObjectUpsertStatus]
+    connections_added: int
+    connection_errors: List[str] = []
+    instances: Optional[List[ObjectInstance]] = Field(None, description='full object instances, only when return_objects is set')
+
 
     
 def serialize_model_object_attribute(attribute: Any) -> AttributeValue:
 
-    attribute_type = new_attribute_type_name_from_old(attribute.info()['datatype'])
     attribute_name = attribute._attr_name
-    info = attribute.info()
+    info = AttributeCatalog.get(attribute._shop_api).info[attribute._type][attribute_name]
+    attribute_type = new_attribute_type_name_from_old(info['datatype'])
 
     attribute_y_unit = info['yUnit'] if 'yUnit' in info else 'unknown'
     attribute_x_unit = info['xUnit'] if 'xUnit' in info else 'unknown'
@@ -358,7 +498,7 @@ def serialize_model_object_attribute(attribute: Any) -> AttributeValue:
 
         if type(value) == list and isinstance(value[0], pd.Series):
 
-            return { ser.name: # reference value is stored in series.name
+            return { float(ser.name): # reference value is stored in series.name
                 Curve(
                     x_unit = attribute_x_unit,
                     y_unit = attribute_y_unit,
@@ -370,9 +510,10 @@ def serialize_model_object_attribute(attribute: Any) -> AttributeValue:
     raise HTTPException(500, f"{attribute_type}: cannot parse <{type(value)}>")
 
 
-def serialize_model_object_instance(o: Any) -> ObjectInstance:
+def serialize_model_object_instance(o: Any, attribute_names: Optional[List[str]] = None) -> ObjectInstance:
 
-    attribute_names = list(o._attr_names)
+    if attribute_names is None:
+        attribute_names = list(o._attr_names)
 
     return ObjectInstance(
         object_type = o.get_type(),
@@ -382,7 +523,140 @@ def serialize_model_object_instance(o: Any) -> ObjectInstance:
         }
     )
 
+# The encode_* functions produce the same json as dump_json of the serialize_* results above, but from plain dicts
+# holding the numpy arrays read from the core, so that large objects are never built or validated as pydantic models.
+# Numbers are floats, like the float first AttributeValue union makes them.
+
+def _isoformat_utc(times: np.ndarray) -> List[str]:
+    times = np.asarray(times).astype('datetime64[us]')
+    unit = 's' if np.all(times.astype('datetime64[s]') == times) else 'us'
+    return [t + '+00:00' for t in np.datetime_as_string(times, unit=unit).tolist()]
+
+def _encode_curve(series: pd.Series, x_unit: str, y_unit: str) -> Dict[str, Any]:
+    return {
+        'x_unit': x_unit,
+        'y_unit': y_unit,
+        'x_values': np.ascontiguousarray(series.index.values, dtype=float),
+        'y_values': np.ascontiguousarray(series.values, dtype=float)
+    }
+
+def encode_model_object_attribute(attribute: Any) -> Any:
+
+    attribute_name = attribute._attr_name
+    info = AttributeCatalog.get(attribute._shop_api).info[attribute._type][attribute_name]
+    attribute_type = new_attribute_type_name_from_old(info['datatype'])
+
+    attribute_y_unit = info['yUnit'] if 'yUnit' in info else 'unknown'
+    attribute_x_unit = info['xUnit'] if 'xUnit' in info else 'unknown'
+
+    value = attribute.get()
+
+    if value is None:
+        return None
+
+    if attribute_type in (ObjectAttributeTypeEnum.boolean, ObjectAttributeTypeEnum.integer, ObjectAttributeTypeEnum.float):
+        return float(value)
+
+    if attribute_type in (ObjectAttributeTypeEnum.string, ObjectAttributeTypeEnum.datetime):
+        return str(value)
+
+    if attribute_type in (ObjectAttributeTypeEnum.float_array, ObjectAttributeTypeEnum.integer_array):
+        return np.ascontiguousarray(value, dtype=float)
+
+    if attribute_type == ObjectAttributeTypeEnum.TimeSeries:
+
+        if isinstance(value, pd.Series) or isinstance(value, pd.DataFrame):
+            # one row of values per scenario
+            values = value.values.reshape(1, -1) if isinstance(value, pd.Series) else value.values.transpose()
+            return {
+                'name': None if value.name is None else str(value.name),
+                'unit': attribute_y_unit,
+                'timestamps': _isoformat_utc(value.index.values),
+                'values': np.ascontiguousarray(values, dtype=float)
+            }
+
+    if attribute_type == ObjectAttributeTypeEnum.Curve:
+
+        if isinstance(value, pd.Series):
+            return _encode_curve(value, attribute_x_unit, attribute_y_unit)
+
+    if attribute_type == ObjectAttributeTypeEnum.MapTimeCurve:
+        return f'{attribute_type}: {type(value)}'
+
+    if attribute_type == ObjectAttributeTypeEnum.MapFloatCurve:
+
+        if type(value) == list and isinstance(value[0], pd.Series):
+            # reference value is stored in series.name
+            return {str(float(ser.name)): _encode_curve(ser, attribute_x_unit, attribute_y_unit) for ser in value}
+
+    raise HTTPException(500, f"{attribute_type}: cannot parse <{type(value)}>")
+
+
+def encode_model_object_instance(o: Any, attribute_names: Optional[List[str]] = None) -> bytes:
+
+    if attribute_names is None:
+        attribute_names = list(o._attr_names)
+
+    return dump_json({
+        'object_name': o.get_name(),
+        'object_type': o.get_type(),
+        'attributes': {name: encode_model_object_attribute(getattr(o, name)) for name in attribute_names}
+    })
+
+class AttributeQuery(BaseModel):
+    object_types: List[str] = Field(['*'], description='object type globs')
+    object_names: List[str] = Field(['*'], description='object name globs, e.g. gen_1_*')
+    attributes: List[str] = Field(description='txy attributes, read from every selected object whose type has them')
+    start_time: Optional[datetime] = Field(None, description='start of the [start_time, end_time) window, defaults to the start of the optimization horizon')
+    end_time: Optional[datetime] = Field(None, description='end of the window, defaults to the end of the optimization horizon')
+
 class CommandArguments(BaseModel):
     options: List[str] = []
     values: List[str] = []
 
+class CommandListEntry(CommandArguments):
+    command: ShopCommandEnum
+
+class CommandList(BaseModel):
+    commands: List[CommandListEntry]
+
+class CommandResult(CommandStatus):
+    command: str
+    options: List[str] = []
+    values: List[str] = []
+    executed: bool = Field(description='false for commands skipped after a failed command')
+    wall_seconds: float = Field(description='time spent executing the command in SHOP')
+
+class CommandListStatus(CommandStatus):
+    wall_seconds: float = Field(description='time spent executing all commands in SHOP')
+    results: List[CommandResult]
+
+class SweepAggregateEnum(str, Enum):
+    sum = 'sum'
+    mean = 'mean'
+    min = 'min'
+    max = 'max'
+
+class SweepOutput(BaseModel):
+    object_type: str
+    object_name: str
+    attribute_name: str
+    aggregate: SweepAggregateEnum = Field(SweepAggregateEnum.sum, description='reduces txy attributes to a single number, ignored for numbers')
+
+class SweepVariant(BaseModel):
+    name: Optional[str] = None
+    objects: List[ObjectInstance] = Field([], description='attributes to set on the copy of the base session before the commands run')
+
+class Sweep(BaseModel):
+    variants: List[SweepVariant]
+    commands: List[CommandListEntry] = Field(description='run on every variant after its attributes are set')
+    outputs: List[SweepOutput] = Field(description='read from every variant once the commands are done')
+
+class SweepResult(BaseModel):
+    variant: int = Field(description='index of the variant in the sweep')
+    name: Optional[str] = None
+    status: bool
+    error: Optional[str] = None
+    wall_seconds: float = Field(description='time from the start of the variant until its outputs were read')
+    outputs: Dict[str, Optional[float]] = Field({}, description='object_type.object_name.attribute_name, with .aggregate for txy attributes')
+
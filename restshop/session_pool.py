@@ -0,0 +1,64 @@
+import collections
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Deque, Tuple, Callable, Any, Optional
+
+
+class ShopSessionPool:
+    # Idle, fully initialized shop sessions ready to be handed out by UserSession.add_shop_session, so that creating a
+    # session does not wait for a new ShopCore, the ModelBuilderType scan and the command listing. Every idle session
+    # comes with the single thread executor it was created on. A daemon thread keeps the pool filled up to size.
+
+    def __init__(self, size: int, factory: Callable[[], Any], retry_seconds: float = 5.0):
+        self.size = size
+        self._factory = factory
+        self._retry_seconds = retry_seconds
+        self._idle: Deque[Tuple[ThreadPoolExecutor, Any]] = collections.deque()
+        self._condition = threading.Condition()
+        self._thread: Optional[threading.Thread] = None
+
+    def start(self):
+        # started on demand rather than at import, worker processes import this module too
+        with self._condition:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._refill, name='shop_session_pool', daemon=True)
+                self._thread.start()
+
+    def _refill(self):
+        while True:
+            with self._condition:
+                while len(self._idle) >= self.size:
+                    self._condition.wait()
+
+            executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='shop_session_pooled')
+            try:
+                sess = executor.submit(self._factory).result()
+            except Exception:
+                # e.g. no license or a dead worker, try again later instead of spinning
+                executor.shutdown(wait=False)
+                with self._condition:
+                    self._condition.wait(self._retry_seconds)
+                continue
+
+            with self._condition:
+                self._idle.append((executor, sess))
+
+    def acquire(self) -> Optional[Tuple[ThreadPoolExecutor, Any]]:
+        # an idle session and its executor, or None if the pool is drained
+        self.start()
+        with self._condition:
+            entry = self._idle.popleft() if self._idle else None
+            self._condition.notify_all()
+        return entry
+
+    def release(self, executor: ThreadPoolExecutor, sess: Any) -> bool:
+        # takes back an unused session, returns False if the pool is full and the session should be torn down
+        with self._condition:
+            if len(self._idle) >= self.size:
+                return False
+            self._idle.append((executor, sess))
+            return True
+
+    def idle_count(self) -> int:
+        with self._condition:
+            return len(self._idle)
@@ -1,7 +1,131 @@
 from pyshop import ShopSession
 from fastapi import HTTPException
+from concurrent.futures import ThreadPoolExecutor, Future
+import asyncio
 import datetime as dt
-from typing import List, Dict
+import os
+import tempfile
+import threading
+import time
+import uuid
+from enum import Enum
+from typing import List, Dict, Tuple, Callable, Any, Union, Optional
+
+from . import config
+from . import profiling
+from . import timing
+from .metrics import Counter, Gauge, Histogram
+from .cache import PayloadCache, PayloadKey
+from .messages import MessageDrain, MessageLog
+from .workers import WorkerPool, RemoteShopSession
+from .session_pool import ShopSessionPool
+
+# part of every etag, so that versions handed out by an earlier server process never match
+_SERVER_INSTANCE = uuid.uuid4().hex[:12]
+
+SESSION_EVICTIONS = Counter('restshop_session_evictions_total', 'Shop sessions dumped to disk and dropped from memory')
+SESSION_EVICTION_SECONDS = Histogram('restshop_session_eviction_seconds', 'Time spent dumping a shop session to disk')
+SESSION_RELOADS = Counter('restshop_session_reloads_total', 'Evicted shop sessions loaded back from disk')
+SESSION_RELOAD_SECONDS = Histogram('restshop_session_reload_seconds', 'Time spent loading an evicted shop session')
+SESSIONS = Gauge('restshop_sessions', 'Shop sessions, by whether they are held in memory or evicted to disk')
+SHOP_OPERATION_SECONDS = Histogram('restshop_shop_operation_seconds', 'Time spent running operations on shop sessions')
+SHOP_COMMAND_SECONDS = Histogram('restshop_shop_command_seconds', 'Time spent executing SHOP commands, by command')
+SESSION_BUSY_SECONDS = Counter(
+    'restshop_session_busy_seconds_total',
+    'Time each shop session spent in calls into the SHOP core'
+)
+
+
+class EvictedShopSession:
+    # Stands in for a shop session that was dumped to disk by UserSession.evict_shop_session
+
+    def __init__(self, name: str, id: int, path: str):
+        self._name = name
+        self._id = id
+        self.path = path
+
+
+def _call_shop_session(sess: Union[ShopSession, RemoteShopSession], func: Callable, args: tuple, kwargs: dict,
+                       sink: Optional[Callable[[List[Any]], None]] = None) -> Any:
+    # with a sink, the SHOP messages are drained between the commands func runs and when it returns, and passed to it
+    if isinstance(sess, RemoteShopSession):
+        if sink:
+            return sess.call_drained(sink, func, *args, **kwargs)
+        return sess.call(func, *args, **kwargs)
+    if sink:
+        with MessageDrain(sess.shop_api, sink):
+            return func(sess, *args, **kwargs)
+    return func(sess, *args, **kwargs)
+
+
+def _run_in_shop_session(us: 'UserSession', session_id: int, func: Callable, args: tuple, kwargs: dict,
+                         on_start: Callable = None, profile: Optional[profiling.RequestProfile] = None) -> Any:
+    # looks the session up when the call starts, an evicted session is loaded back first. With a profile, func is run
+    # under cProfile where the session lives and the stats are added to it.
+    if on_start:
+        on_start()
+    if session_id not in us.shop_sessions:
+        raise HTTPException(400, f'Session {{{session_id}}} does not exist.')
+    sess = us.shop_sessions[session_id]
+    if isinstance(sess, EvictedShopSession):
+        sess = us.restore_shop_session(session_id)
+
+    # the messages of SHOP commands are forwarded to GET /messages, after each command of a list
+    sink = None
+    if getattr(func, 'runs_shop_command', False) or getattr(func, 'runs_shop_command_list', False):
+        sink = us.shop_sessions_messages[session_id].extend
+
+    # the session is busy for the time spent in the SHOP core, measured where the session lives, see restshop.timing
+    start = time.perf_counter()
+    shop_seconds = 0.0
+    try:
+        if profile is None:
+            result, shop_seconds = _call_shop_session(sess, timing.timed_call, (func,) + tuple(args), kwargs, sink)
+        else:
+            (result, stats), shop_seconds = _call_shop_session(
+                sess, timing.timed_call, (profiling.profiled_call, func) + tuple(args), kwargs, sink)
+            profile.add(stats)
+    finally:
+        elapsed = time.perf_counter() - start
+        SHOP_OPERATION_SECONDS.observe(elapsed, operation=func.__name__)
+        SESSION_BUSY_SECONDS.inc(shop_seconds, user=us.username, session_id=str(session_id))
+        # the command is the first argument of operations marked with restshop.operations.runs_shop_command
+        if getattr(func, 'runs_shop_command', False):
+            command = args[0].value if isinstance(args[0], Enum) else args[0]
+            SHOP_COMMAND_SECONDS.observe(elapsed, command=command)
+
+    # operations marked with restshop.operations.runs_shop_command_list time each of their commands
+    if getattr(func, 'runs_shop_command_list', False):
+        for r in result:
+            if r['executed']:
+                SHOP_COMMAND_SECONDS.observe(r['wall_seconds'], command=r['command'])
+    return result
+
+
+def _dump_yaml(sess: ShopSession, path: str):
+    sess.dump_yaml(file_path=path, compress_txy=True, compress_connection=True)
+
+
+def _load_yaml(sess: ShopSession, path: str):
+    sess.load_yaml(file_path=path)
+
+
+def _dump_yaml_string(sess: ShopSession) -> str:
+    return sess.dump_yaml()
+
+
+def _load_yaml_string(sess: ShopSession, yaml_string: str):
+    sess.load_yaml(yaml_string=yaml_string)
+
+
+def _create_shop_session(**kwargs) -> Union[ShopSession, RemoteShopSession]:
+    if SessionManager.worker_pool:
+        return SessionManager.worker_pool.create_session(**kwargs)
+    return timing.time_shop_calls(ShopSession(**kwargs))
+
+
+def _create_pooled_shop_session() -> Union[ShopSession, RemoteShopSession]:
+    return _create_shop_session(license_path='', silent=False, log_file='', name='unnamed', id=0)
 
 
 class UserSession:
@@ -9,25 +133,166 @@ class UserSession:
     def __init__(self, username: str, expires: dt.datetime):
         self.username: str = username
         self.expires: dt.datetime = expires
-        self.shop_sessions: Dict[int, ShopSession] = {}
+        self.shop_sessions: Dict[int, Union[ShopSession, RemoteShopSession]] = {}
         self.shop_sessions_time_resolution_is_set: Dict[int, bool] = {}
+        # every shop session owns a single thread, all calls into its shop_api are made from that thread
+        self.shop_sessions_executor: Dict[int, ThreadPoolExecutor] = {}
+        # bumped by every operation that modifies the shop session, see restshop.operations.modifies_session
+        self.shop_sessions_version: Dict[int, int] = {}
+        # used by the evictor
+        self.shop_sessions_last_used: Dict[int, float] = {}
+        self.shop_sessions_in_flight: Dict[int, int] = {}
+        # serialized object payloads, see SessionManager.call_cached
+        self.shop_sessions_cache: Dict[int, PayloadCache] = {}
+        # SHOP messages drained while commands run, see restshop.messages
+        self.shop_sessions_messages: Dict[int, MessageLog] = {}
+        # session ids are handed out from several threads, e.g. by sweeps cloning variants in parallel
         self.session_counter: int = 0
+        self._lock = threading.Lock()
+
+    def _next_session_id(self) -> int:
+        with self._lock:
+            self.session_counter += 1
+            return self.session_counter
 
-    def add_shop_session(self, session_name: str) -> ShopSession:
-        self.session_counter += 1
-        new_shop_session = ShopSession(license_path='', silent=False, log_file='', name=session_name, id=self.session_counter)
-        self.shop_sessions[self.session_counter] = new_shop_session
-        self.shop_sessions_time_resolution_is_set[self.session_counter] = False
+    def add_shop_session(self, session_name: str) -> Union[ShopSession, RemoteShopSession]:
+        session_id = self._next_session_id()
+        pooled = SessionManager.session_pool.acquire() if SessionManager.session_pool else None
+        if pooled:
+            executor, new_shop_session = pooled
+            new_shop_session._name = session_name
+            new_shop_session._id = session_id
+        else:
+            executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix=f'shop_session_{self.username}_{session_id}')
+            kwargs = dict(license_path='', silent=False, log_file='', name=session_name, id=session_id)
+            new_shop_session = executor.submit(_create_shop_session, **kwargs).result()
+        self._register_shop_session(session_id, new_shop_session, executor)
         return new_shop_session
 
+    def _register_shop_session(self, session_id: int, shop_session: Union[ShopSession, RemoteShopSession],
+                               executor: ThreadPoolExecutor):
+        self.shop_sessions[session_id] = shop_session
+        self.shop_sessions_time_resolution_is_set[session_id] = False
+        self.shop_sessions_executor[session_id] = executor
+        self.shop_sessions_version[session_id] = 0
+        self.shop_sessions_last_used[session_id] = time.monotonic()
+        self.shop_sessions_in_flight[session_id] = 0
+        self.shop_sessions_messages[session_id] = MessageLog()
+        if config.SESSION_CACHE_MB > 0:
+            self.shop_sessions_cache[session_id] = PayloadCache(int(config.SESSION_CACHE_MB * 1024 * 1024))
+
+    def clone_shop_session(self, session_id: int, session_name: str, fork: bool = False) -> Union[ShopSession, RemoteShopSession]:
+        # New session holding a copy of the model of session_id. The copy is made on the executor of the source, after
+        # the calls already queued on it. With fork the worker hosting the source is forked, otherwise the model is
+        # copied through an in-memory yaml dump.
+        source_executor = self.shop_sessions_executor[session_id]
+
+        if fork:
+            clone_id = self._next_session_id()
+            executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix=f'shop_session_{self.username}_{clone_id}')
+            clone = source_executor.submit(self._fork_shop_session, session_id, session_name, clone_id).result()
+            self._register_shop_session(clone_id, clone, executor)
+        else:
+            yaml_string = source_executor.submit(_run_in_shop_session, self, session_id, _dump_yaml_string, (), {}).result()
+            clone = self.add_shop_session(session_name)
+            clone_id = clone._id
+            self.shop_sessions_executor[clone_id].submit(
+                _run_in_shop_session, self, clone_id, _load_yaml_string, (yaml_string,), {}
+            ).result()
+
+        self.shop_sessions_time_resolution_is_set[clone_id] = self.shop_sessions_time_resolution_is_set[session_id]
+        self.shop_sessions_version[clone_id] = self.shop_sessions_version[session_id]
+        return clone
+
+    def _fork_shop_session(self, session_id: int, session_name: str, clone_id: int) -> RemoteShopSession:
+        # runs on the executor of the source session
+        sess = self.shop_sessions[session_id]
+        if isinstance(sess, EvictedShopSession):
+            sess = self.restore_shop_session(session_id)
+        if not isinstance(sess, RemoteShopSession):
+            raise HTTPException(400, f'Session {{{session_id}}} does not live in a worker process and cannot be forked')
+        return SessionManager.worker_pool.fork_session(sess, session_name, clone_id)
+
     def remove_shop_session(self, session_id: int) -> bool:
         if session_id in self.shop_sessions:
             shop_session = self.shop_sessions.pop(session_id)
+            executor = self.shop_sessions_executor.pop(session_id)
+            self.shop_sessions_time_resolution_is_set.pop(session_id, None)
+            version = self.shop_sessions_version.pop(session_id, 0)
+            self.shop_sessions_last_used.pop(session_id, None)
+            self.shop_sessions_in_flight.pop(session_id, None)
+            self.shop_sessions_cache.pop(session_id, None)
+            self.shop_sessions_messages.pop(session_id).close()
+            SESSION_BUSY_SECONDS.remove(user=self.username, session_id=str(session_id))
+            if isinstance(shop_session, EvictedShopSession):
+                executor.shutdown(wait=False)
+                if os.path.exists(shop_session.path):
+                    os.remove(shop_session.path)
+                return True
+            # ShopCore has no reset, so only sessions that were never modified go back to the pool, it is cheaper
+            # than building a new core. Modified sessions are torn down.
+            if version == 0 and SessionManager.session_pool and SessionManager.session_pool.release(executor, shop_session):
+                shop_session._name = 'unnamed'
+                shop_session._id = 0
+                return True
+            if isinstance(shop_session, RemoteShopSession):
+                executor.submit(shop_session.close)
+            executor.shutdown(wait=False)
             del shop_session
             return True
         else:
             return False
 
+    def evict_shop_session(self, session_id: int, reason: str = 'idle') -> bool:
+        # runs on the executor of the shop session. Dumps the session to disk and drops its core, it is loaded back the
+        # next time it is used, see restore_shop_session
+        sess = self.shop_sessions.get(session_id)
+        if sess is None or isinstance(sess, EvictedShopSession):
+            return False
+
+        start = time.perf_counter()
+        os.makedirs(config.SESSION_SPILL_DIR, exist_ok=True)
+        fd, path = tempfile.mkstemp(prefix=f'session_{session_id}_', suffix='.yaml', dir=config.SESSION_SPILL_DIR)
+        os.close(fd)
+        try:
+            _call_shop_session(sess, _dump_yaml, (path,), {})
+        except Exception:
+            os.remove(path)
+            raise
+        if isinstance(sess, RemoteShopSession):
+            sess.close()
+        self.shop_sessions[session_id] = EvictedShopSession(sess._name, sess._id, path)
+        del sess
+        if session_id in self.shop_sessions_cache:
+            self.shop_sessions_cache[session_id].clear()
+
+        SESSION_EVICTIONS.inc(reason=reason)
+        SESSION_EVICTION_SECONDS.observe(time.perf_counter() - start)
+        return True
+
+    def restore_shop_session(self, session_id: int) -> Union[ShopSession, RemoteShopSession]:
+        # runs on the executor of the shop session, so a new local core is created on the thread that will use it
+        evicted: EvictedShopSession = self.shop_sessions[session_id]
+
+        start = time.perf_counter()
+        kwargs = dict(license_path='', silent=False, log_file='', name=evicted._name, id=evicted._id)
+        sess = _create_shop_session(**kwargs)
+        try:
+            _call_shop_session(sess, _load_yaml, (evicted.path,), {})
+        except Exception as e:
+            if isinstance(sess, RemoteShopSession):
+                sess.close()
+            raise HTTPException(500, f'Session {{{session_id}}} could not be restored from {{{evicted.path}}}: {e}')
+        self.shop_sessions[session_id] = sess
+        os.remove(evicted.path)
+        # a reloaded model may differ in representation, e.g. compressed time series
+        if session_id in self.shop_sessions_cache:
+            self.shop_sessions_cache[session_id].clear()
+
+        SESSION_RELOADS.inc()
+        SESSION_RELOAD_SECONDS.observe(time.perf_counter() - start)
+        return sess
+
     def update_expiry_time(self, expires: dt.datetime):
         self.expires = expires
         dt.datetime.utcnow()
@@ -36,6 +301,16 @@ class UserSession:
 class SessionManager:
 
     user_sessions: Dict[str, UserSession] = {}
+    worker_pool: WorkerPool = WorkerPool(config.WORKER_POOL_SIZE) if config.WORKER_POOL_SIZE > 0 else None
+    session_pool: ShopSessionPool = \
+        ShopSessionPool(config.SESSION_POOL_SIZE, _create_pooled_shop_session) if config.SESSION_POOL_SIZE > 0 else None
+
+    @staticmethod
+    def count_shop_sessions(evicted: bool = False) -> int:
+        return sum(
+            isinstance(sess, EvictedShopSession) == evicted
+            for us in list(SessionManager.user_sessions.values()) for sess in list(us.shop_sessions.values())
+        )
 
     @staticmethod
     def get_user_sessions() -> Dict[str, UserSession]:
@@ -85,13 +360,99 @@ class SessionManager:
         return sess
 
     @staticmethod
-    def add_shop_session(username: str, session_name: str) -> ShopSession:
+    def submit(username: str, session_id: int, func: Callable, *args, on_start: Callable = None,
+               invalidates: Optional[List[Tuple[str, str]]] = None, profile: Optional[profiling.RequestProfile] = None,
+               **kwargs) -> Future:
+        # queues func(shop_session, *args, **kwargs) on the executor owned by the shop session. For sessions living in
+        # a worker process the executor thread forwards the call over the worker's pipe. on_start is called from the
+        # executor thread right before func starts. When func modifies the session, the cached payloads of the
+        # (object_type, object_name) pairs in invalidates are dropped, or all of them if invalidates is None. With a
+        # profile, func is run under cProfile and its stats are added to the profile.
+        SessionManager.get_shop_session(username, session_id)
+        us = SessionManager.get_user_session(username)
+        executor = us.shop_sessions_executor[session_id]
+        if getattr(func, 'modifies_session', False):
+            us.shop_sessions_version[session_id] += 1
+            cache = us.shop_sessions_cache.get(session_id)
+            if cache is not None and invalidates is None:
+                cache.clear()
+            elif cache is not None:
+                cache.invalidate(invalidates)
+        us.shop_sessions_last_used[session_id] = time.monotonic()
+        us.shop_sessions_in_flight[session_id] += 1
+        future = executor.submit(_run_in_shop_session, us, session_id, func, args, kwargs, on_start, profile)
+        future.add_done_callback(lambda _: SessionManager._call_done(us, session_id))
+        return future
+
+    @staticmethod
+    def get_message_log(username: str, session_id: int) -> MessageLog:
+        SessionManager.get_shop_session(username, session_id)
+        return SessionManager.get_user_session(username).shop_sessions_messages[session_id]
+
+    @staticmethod
+    def get_etag(username: str, session_id: int, variant: str = '') -> str:
+        # changes whenever an operation that modifies the session is submitted, see restshop.operations.modifies_session
+        SessionManager.get_shop_session(username, session_id)
+        version = SessionManager.get_user_session(username).shop_sessions_version[session_id]
+        return f'"{_SERVER_INSTANCE}-{session_id}-{version}{"-" + variant if variant else ""}"'
+
+    @staticmethod
+    def _call_done(us: UserSession, session_id: int):
+        if session_id in us.shop_sessions_in_flight:
+            us.shop_sessions_in_flight[session_id] -= 1
+            us.shop_sessions_last_used[session_id] = time.monotonic()
+
+    @staticmethod
+    async def call(username: str, session_id: int, func: Callable, *args, **kwargs) -> Any:
+        # awaits func(shop_session, *args, **kwargs) run on the executor of the shop session, so that a long running
+        # command in one session does not block the event loop serving the other sessions
+        profile = profiling.active_profile.get()
+        if profile is None:
+            return await asyncio.wrap_future(SessionManager.submit(username, session_id, func, *args, **kwargs))
+        # a profiled request, the profiler of the event loop pauses while func runs under one of its own
+        profile.suspend()
+        try:
+            return await asyncio.wrap_future(SessionManager.submit(username, session_id, func, *args, profile=profile, **kwargs))
+        finally:
+            profile.resume()
+
+    @staticmethod
+    async def call_cached(username: str, session_id: int, key: PayloadKey, func: Callable, *args, **kwargs) -> bytes:
+        # like call for a func returning a serialized payload of the object key[:2], answered from the payload cache of
+        # the session when possible. A payload is only stored if nothing modified the session while it was built.
+        SessionManager.get_shop_session(username, session_id)
+        us = SessionManager.get_user_session(username)
+        cache = us.shop_sessions_cache.get(session_id)
+        if cache is None:
+            return await SessionManager.call(username, session_id, func, *args, **kwargs)
+
+        payload = cache.get(key)
+        if payload is None:
+            version = us.shop_sessions_version[session_id]
+            payload = await SessionManager.call(username, session_id, func, *args, **kwargs)
+            if us.shop_sessions_version.get(session_id) == version:
+                cache.put(key, payload)
+        return payload
+
+    @staticmethod
+    def is_cached(username: str, session_id: int, key: PayloadKey) -> bool:
+        # whether the payload cache of the session holds key, the object key[:2] then exists at the current version
+        cache = SessionManager.get_user_session(username).shop_sessions_cache.get(session_id)
+        return cache is not None and cache.get(key) is not None
+
+    @staticmethod
+    def add_shop_session(username: str, session_name: str) -> Union[ShopSession, RemoteShopSession]:
         us = SessionManager.get_user_session(username)
         if us:
             return us.add_shop_session(session_name)
         else:
             return None
 
+    @staticmethod
+    def clone_shop_session(username: str, session_id: int, session_name: str, fork: bool = False) -> Union[ShopSession, RemoteShopSession]:
+        SessionManager.get_shop_session(username, session_id)
+        return SessionManager.get_user_session(username).clone_shop_session(session_id, session_name, fork)
+
     @staticmethod
     def remove_shop_session(username: str, session_id: int) -> bool:
         us = SessionManager.get_user_session(username)
@@ -100,12 +461,35 @@ class SessionManager:
         else:
             return False
 
+    @staticmethod
+    def evict_shop_session(username: str, session_id: int, reason: str = 'idle') -> Future:
+        # queued behind the calls already waiting on the session, calls queued after it load the session back
+        us = SessionManager.get_user_session(username)
+        if us is None or session_id not in us.shop_sessions_executor:
+            raise HTTPException(400, f'Session {{{session_id}}} does not exist.')
+        return us.shop_sessions_executor[session_id].submit(us.evict_shop_session, session_id, reason)
+
+    @staticmethod
+    def get_idle_shop_sessions() -> List[tuple]:
+        # (last_used, username, session_id) of resident sessions with no call queued or running, least recently used first
+        idle = []
+        for username, us in list(SessionManager.user_sessions.items()):
+            for session_id, sess in list(us.shop_sessions.items()):
+                if isinstance(sess, EvictedShopSession):
+                    continue
+                if us.shop_sessions_in_flight.get(session_id, 0) == 0:
+                    idle += [(us.shop_sessions_last_used.get(session_id, 0.0), username, session_id)]
+        return sorted(idle)
+
     @staticmethod
     def cleanup_user_sessions() -> None:
-        for user in SessionManager.get_user_session_list():
-            us = SessionManager.get_user_session(user)
-            if dt.datetime.utcnow() > us.expires:
-                SessionManager.remove_user_session(user)
+        # removes users whose login has expired, together with their shop sessions
+        now = dt.datetime.utcnow()
+        for username, us in list(SessionManager.user_sessions.items()):
+            if us.expires is not None and now > us.expires:
+                for session_id in list(us.shop_sessions):
+                    us.remove_shop_session(session_id)
+                SessionManager.remove_user_session(username)
 
     @staticmethod
     def update_expiry_time(username: str, expires: dt.datetime) -> None:
@@ -124,4 +508,8 @@ class SessionManager:
         model_object_generator = SessionManager.get_model_object_generator(username, session_id, object_type)
         if object_name not in model_object_generator._names:
             raise HTTPException(400, f'object_name {{{object_name}}} is not an instance of object_type {{{object_type}}}.')
-        return model_object_generator[object_name]
\ No newline at end of file
+        return model_object_generator[object_name]
+
+
+SESSIONS.set_function(lambda: SessionManager.count_shop_sessions(evicted=False), state='in_memory')
+SESSIONS.set_function(lambda: SessionManager.count_shop_sessions(evicted=True), state='evicted')
@@ -0,0 +1,87 @@
+import asyncio
+import functools
+import time
+from typing import AsyncIterator
+
+from fastapi import HTTPException
+from fastapi.concurrency import run_in_threadpool
+
+from . import config
+from . import operations
+from .schemas import Sweep, SweepVariant, SweepResult, ModelUpsert
+from .sessions import SessionManager
+
+# Parameter sweeps. Every variant runs on a clone of the base session, forked off the worker process hosting it when
+# possible, so that variants run side by side in processes of their own. The clone gets the attributes of the variant,
+# runs the commands, has its outputs read and is removed again. Results are yielded in the order variants finish.
+
+# variants run at once without worker processes, every one of them is a full SHOP core in the API process
+IN_PROCESS_PARALLELISM = 2
+
+
+def default_parallelism() -> int:
+    return config.SWEEP_PARALLELISM or config.WORKER_POOL_SIZE or IN_PROCESS_PARALLELISM
+
+
+def _remove_clone(username: str, future: asyncio.Future):
+    # done callback of a clone whose variant was cancelled while the clone was made
+    if not future.cancelled() and future.exception() is None:
+        SessionManager.remove_shop_session(username, future.result()._id)
+
+
+async def _run_variant(username: str, session_id: int, sweep: Sweep, index: int, variant: SweepVariant, fork: bool,
+                       semaphore: asyncio.Semaphore) -> SweepResult:
+    async with semaphore:
+        start = time.perf_counter()
+        clone_id = None
+        try:
+            name = f'sweep_{session_id}_{variant.name or index}'
+            # the clone is registered by the thread making it whether or not the variant is cancelled meanwhile, so it
+            # is removed by a callback in that case
+            cloning = asyncio.ensure_future(run_in_threadpool(SessionManager.clone_shop_session, username, session_id, name, fork))
+            try:
+                clone = await asyncio.shield(cloning)
+            except asyncio.CancelledError:
+                cloning.add_done_callback(functools.partial(_remove_clone, username))
+                raise
+            clone_id = clone._id
+
+            status = await SessionManager.call(username, clone_id, operations.upsert_model, ModelUpsert(objects=variant.objects), False)
+            errors = [f'{o.object_type}.{o.object_name}: {o.error}' for o in status.objects if o.error]
+            if errors:
+                raise HTTPException(400, f'could not set attributes -- {"; ".join(errors)}')
+
+            commands = [dict(c.dict(), command=c.command.value) for c in sweep.commands]
+            results = await SessionManager.call(username, clone_id, operations.execute_command_list, commands)
+            failed = [r for r in results if r['executed'] and not r['status']]
+            if failed:
+                raise HTTPException(500, f'command {{{failed[0]["command"]}}} failed -- {failed[0].get("error") or failed[0]["message"]}')
+
+            outputs = await SessionManager.call(username, clone_id, operations.summarize_outputs, sweep.outputs)
+            return SweepResult(
+                variant=index, name=variant.name, status=True, wall_seconds=time.perf_counter() - start, outputs=outputs
+            )
+        except HTTPException as e:
+            error = str(e.detail)
+        except Exception as e:
+            error = str(e)
+        finally:
+            # not awaited, a cancelled variant would be cancelled again here. Removing does not wait for SHOP.
+            if clone_id is not None:
+                SessionManager.remove_shop_session(username, clone_id)
+        return SweepResult(variant=index, name=variant.name, status=False, error=error, wall_seconds=time.perf_counter() - start)
+
+
+async def run_sweep(username: str, session_id: int, sweep: Sweep, parallelism: int, fork: bool) -> AsyncIterator[SweepResult]:
+    semaphore = asyncio.Semaphore(parallelism)
+    tasks = [
+        asyncio.ensure_future(_run_variant(username, session_id, sweep, i, variant, fork, semaphore))
+        for i, variant in enumerate(sweep.variants)
+    ]
+    try:
+        for task in asyncio.as_completed(tasks):
+            yield await task
+    finally:
+        # the client went away, variants that did not start are dropped and running ones remove their clone when done
+        for task in tasks:
+            task.cancel()
@@ -0,0 +1,52 @@
+import time
+from typing import Any, Tuple
+
+from pyshop import ShopSession
+from pyshop.shopcore.model_builder import ModelBuilderType
+
+# Time spent inside the SHOP core, reported per shop session as restshop_session_busy_seconds_total. Every ShopSession
+# gets a TimedShopApi in place of its shop_api when it is created, in whichever process holds it, and timed_call
+# returns the time an operation spent in pybind calls next to its result. Only that time is counted, not the reading
+# of requests and the serialization of responses around it.
+
+
+class TimedShopApi:
+    # Stands in for the shop_api of a ShopSession and adds up the seconds spent in its methods. Only the thread of the
+    # session calls into it, so seconds needs no lock.
+
+    def __init__(self, shop_api):
+        self._shop_api = shop_api
+        self.seconds = 0.0
+
+    def __getattr__(self, name: str):
+        attr = getattr(self._shop_api, name)
+        if not callable(attr):
+            return attr
+
+        def timed(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return attr(*args, **kwargs)
+            finally:
+                self.seconds += time.perf_counter() - start
+
+        # found in __dict__ from now on, __getattr__ runs once per method
+        self.__dict__[name] = timed
+        return timed
+
+
+def time_shop_calls(sess: ShopSession) -> ShopSession:
+    # the model builder keeps the shop_api it was made with, it is made again around the timed one
+    if not isinstance(sess.shop_api, TimedShopApi):
+        sess.shop_api = TimedShopApi(sess.shop_api)
+        sess.model = ModelBuilderType(sess.shop_api)
+    return sess
+
+
+def timed_call(sess: ShopSession, func, *args, **kwargs) -> Tuple[Any, float]:
+    # runs func(sess, *args, **kwargs) and returns its result and the seconds it spent in the SHOP core. An operation
+    # that raises is not counted.
+    shop_api = sess.shop_api
+    start = getattr(shop_api, 'seconds', 0.0)
+    result = func(sess, *args, **kwargs)
+    return result, getattr(shop_api, 'seconds', 0.0) - start
@@ -0,0 +1,369 @@
+import itertools
+import multiprocessing as mp
+import os
+import shutil
+import signal
+import socket
+import tempfile
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+from multiprocessing.connection import Connection
+from typing import Dict, List, Tuple, Callable, Any, Optional
+
+from fastapi import HTTPException
+
+from .messages import MessageDrain
+
+# Worker pool hosting ShopSessions in child processes.
+#
+# The API process talks to a worker over a multiprocessing Pipe. Every request is a tuple (request_id, opcode,
+# session_key, ...) and is answered by exactly one reply tuple (request_id, ...):
+#
+#   ('create', key, kwargs)              -> ('ok', None)     creates ShopSession(**kwargs) in the worker
+#   ('call', key, func, args, kwargs)    -> ('ok', result)   runs func(shop_session, *args, **kwargs) in the worker
+#   ('call_drained', key, func, args, kwargs)                like call, the SHOP messages drained between the commands
+#                                        -> ('messages', [...]) ... ('ok', result)   of func are sent ahead of the reply
+#   ('remove', key)                      -> ('ok', None)     drops the shop session
+#   ('fork', key, new_key, address)      -> ('ok', pid)      forks the worker, see WorkerPool.fork_session
+#
+# Failures are answered with ('http_error', status_code, detail) or ('error', exception). Functions are pickled by
+# reference, so only module level functions like the ones in restshop.operations can be called.
+#
+# Every session gets a thread of its own in its worker, which makes all calls into its shop_api, and requests are
+# matched to their replies by request_id. Sessions placed on the same worker thus do not wait for each other, a long
+# command in one leaves the others free to serve reads. New sessions go to an empty worker while fewer than the pool
+# size are running, so with at most that many sessions every session has a process, and a GIL, of its own.
+
+# fork needs os.fork and unix sockets for the forked worker to connect back to the API process
+FORK_AVAILABLE: bool = hasattr(os, 'fork') and hasattr(socket, 'AF_UNIX')
+
+
+def _send_reply(conn, request_id: int, reply: tuple):
+    try:
+        conn.send((request_id,) + reply)
+    except Exception as e:
+        # the result or the exception could not be pickled, send the message text instead
+        if reply[0] == 'error':
+            detail = str(reply[1])
+        else:
+            detail = f'cannot send result of type {type(reply[1]).__name__} from shop worker: {e}'
+        conn.send((request_id, 'error', RuntimeError(detail)))
+
+
+class _ForkLock:
+    # Held shared by every request a worker runs and exclusively by a fork, so that no thread of the worker is inside
+    # the SHOP core or sending a reply when it forks. A waiting fork holds back new requests, it is not starved by them.
+
+    def __init__(self):
+        self._condition = threading.Condition()
+        self._shared = 0
+        self._exclusive = False
+        self._waiting = 0
+
+    def acquire_shared(self):
+        with self._condition:
+            self._condition.wait_for(lambda: not self._exclusive and not self._waiting)
+            self._shared += 1
+
+    def release_shared(self):
+        with self._condition:
+            self._shared -= 1
+            self._condition.notify_all()
+
+    def acquire_exclusive(self):
+        with self._condition:
+            self._waiting += 1
+            self._condition.wait_for(lambda: not self._exclusive and not self._shared)
+            self._waiting -= 1
+            self._exclusive = True
+
+    def release_exclusive(self):
+        with self._condition:
+            self._exclusive = False
+            self._condition.notify_all()
+
+
+def _worker_main(conn):
+    if FORK_AVAILABLE:
+        # forked workers are reaped by the kernel
+        signal.signal(signal.SIGCHLD, signal.SIG_IGN)
+    _serve(conn, {})
+
+
+def _serve(conn, sessions: Dict[int, 'ShopSession']):
+    # Reads requests on this thread and runs each on the thread of its session, which sends the reply
+    from pyshop import ShopSession
+    from .timing import time_shop_calls
+
+    send_lock = threading.Lock()
+    fork_lock = _ForkLock()
+    executors: Dict[int, ThreadPoolExecutor] = {
+        key: ThreadPoolExecutor(max_workers=1, thread_name_prefix=f'shop_session_{key}') for key in sessions
+    }
+
+    def send(request_id: int, reply: tuple):
+        with send_lock:
+            _send_reply(conn, request_id, reply)
+
+    def handle(request_id: int, opcode: str, key: int, args: tuple):
+        # the other sessions of the worker are left alone by a fork, they must not be running SHOP when it happens
+        if opcode == 'fork':
+            fork_lock.acquire_exclusive()
+        else:
+            fork_lock.acquire_shared()
+        try:
+            run(request_id, opcode, key, args)
+        finally:
+            if opcode == 'fork':
+                fork_lock.release_exclusive()
+            else:
+                fork_lock.release_shared()
+
+    def run(request_id: int, opcode: str, key: int, args: tuple):
+        try:
+            if opcode == 'create':
+                sessions[key] = time_shop_calls(ShopSession(**args[0]))
+                reply = ('ok', None)
+            elif opcode == 'call':
+                func, func_args, kwargs = args
+                reply = ('ok', func(sessions[key], *func_args, **kwargs))
+            elif opcode == 'call_drained':
+                func, func_args, kwargs = args
+                with MessageDrain(sessions[key].shop_api, lambda messages: send(request_id, ('messages', messages))):
+                    reply = ('ok', func(sessions[key], *func_args, **kwargs))
+            elif opcode == 'remove':
+                sessions.pop(key, None)
+                reply = ('ok', None)
+            elif opcode == 'fork':
+                new_key, address = args
+                source = sessions[key]
+                pid = os.fork()
+                if pid == 0:
+                    # the forked worker serves only the copy of the source session, on a connection of its own. The
+                    # sessions of the parent stay referenced by this frame, so that their pages stay shared with it.
+                    # The copied threads of the parent do not exist in the child, it exits when its connection closes.
+                    try:
+                        conn.close()
+                        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+                        sock.connect(address)
+                        _serve(Connection(sock.detach()), {new_key: source})
+                    finally:
+                        os._exit(0)
+                reply = ('ok', pid)
+            else:
+                reply = ('error', ValueError(f'unknown opcode {{{opcode}}}'))
+        except HTTPException as e:
+            reply = ('http_error', e.status_code, e.detail)
+        except Exception as e:
+            reply = ('error', e)
+        send(request_id, reply)
+
+    while True:
+        try:
+            message = conn.recv()
+        except EOFError:
+            break
+
+        request_id, opcode, key = message[:3]
+        if opcode == 'create':
+            executors[key] = ThreadPoolExecutor(max_workers=1, thread_name_prefix=f'shop_session_{key}')
+        if key not in executors:
+            send(request_id, ('error', KeyError(f'no shop session {{{key}}} in this worker')))
+            continue
+        executors[key].submit(handle, request_id, opcode, key, message[3:])
+        if opcode == 'remove':
+            # the remove already queued still runs
+            executors.pop(key).shutdown(wait=False)
+
+    for executor in executors.values():
+        executor.shutdown(wait=False)
+
+
+class ShopWorker:
+    # Either a worker process spawned by the pool, or a worker forked from one of those by WorkerPool.fork_session.
+    # Forked workers are not children of the API process and only live as long as they host a session.
+
+    def __init__(self, conn: Connection, name: str, pid: int, process: Optional[mp.Process] = None):
+        self._conn = conn
+        self._process = process
+        self.name = name
+        self.pid = pid
+        self.forked: bool = process is None
+        # requests of different sessions are outstanding at the same time, replies are read by a thread of their own
+        # and handed to the waiting request by request id
+        self._lock = threading.Lock()
+        self._request_ids = itertools.count(1)
+        self._pending: Dict[int, Tuple[Future, Optional[Callable[[List[Any]], None]]]] = {}
+        self.session_keys = set()
+        self.alive: bool = True
+        self._reader = threading.Thread(target=self._read_replies, name=f'{name}_replies', daemon=True)
+        self._reader.start()
+
+    @staticmethod
+    def spawn(context, index: int) -> 'ShopWorker':
+        conn, child_conn = context.Pipe()
+        process = context.Process(target=_worker_main, args=(child_conn,), name=f'shop_worker_{index}', daemon=True)
+        process.start()
+        child_conn.close()
+        return ShopWorker(conn, process.name, process.pid, process)
+
+    def _read_replies(self):
+        try:
+            while True:
+                request_id, *reply = self._conn.recv()
+                with self._lock:
+                    future, on_messages = self._pending[request_id]
+                    if reply[0] != 'messages':
+                        del self._pending[request_id]
+                if reply[0] != 'messages':
+                    future.set_result(reply)
+                elif on_messages:
+                    on_messages(reply[1])
+        except (EOFError, OSError):
+            pass
+
+        with self._lock:
+            self.alive = False
+            pending, self._pending = self._pending, {}
+        for future, _ in pending.values():
+            future.set_exception(self._lost())
+
+    def _lost(self) -> HTTPException:
+        exitcode = self._process.exitcode if self._process else None
+        return HTTPException(500, f'shop worker {{{self.name}}} terminated unexpectedly (exitcode {exitcode}), '
+                                  f'its sessions are lost')
+
+    def request(self, *message, on_messages: Optional[Callable[[List[Any]], None]] = None) -> Any:
+        future = Future()
+        with self._lock:
+            if not self.alive:
+                raise HTTPException(500, f'shop worker {{{self.name}}} is not running, its sessions are lost')
+            request_id = next(self._request_ids)
+            self._pending[request_id] = (future, on_messages)
+            try:
+                self._conn.send((request_id,) + message)
+            except (EOFError, OSError):
+                self.alive = False
+                del self._pending[request_id]
+                raise self._lost()
+
+        reply = future.result()
+        if reply[0] == 'ok':
+            return reply[1]
+        if reply[0] == 'http_error':
+            raise HTTPException(reply[1], reply[2])
+        raise reply[1]
+
+    def terminate(self):
+        self.alive = False
+        if self._process:
+            self._process.terminate()
+            return
+        self._conn.close()
+        try:
+            os.kill(self.pid, signal.SIGTERM)
+        except ProcessLookupError:
+            pass
+
+
+class RemoteShopSession:
+    # Stands in for a ShopSession living in a worker process, only name and id are known to the API process
+
+    def __init__(self, worker: ShopWorker, key: int, name: str, id: int):
+        self._worker = worker
+        self._key = key
+        self._name = name
+        self._id = id
+
+    def call(self, func: Callable, *args, **kwargs) -> Any:
+        return self._worker.request('call', self._key, func, args, kwargs)
+
+    def call_drained(self, sink: Callable[[List[Any]], None], func: Callable, *args, **kwargs) -> Any:
+        # like call, the SHOP messages drained in the worker while func runs are passed to sink as they arrive
+        return self._worker.request('call_drained', self._key, func, args, kwargs, on_messages=sink)
+
+    def close(self):
+        self._worker.session_keys.discard(self._key)
+        if self._worker.alive:
+            self._worker.request('remove', self._key)
+        if self._worker.forked and not self._worker.session_keys:
+            self._worker.terminate()
+
+
+class WorkerPool:
+
+    def __init__(self, size: int):
+        self.size = size
+        self.workers: List[ShopWorker] = []
+        # workers created by fork_session, they are not used for new sessions
+        self.forked_workers: List[ShopWorker] = []
+        self._context = mp.get_context('spawn')
+        self._keys = itertools.count(1)
+        self._worker_index = itertools.count(1)
+        self._lock = threading.Lock()
+
+    def _pick_worker(self, key: int) -> ShopWorker:
+        # an empty worker first, then a new one, and the least loaded once the pool is full
+        with self._lock:
+            self.workers = [w for w in self.workers if w.alive]
+            empty = [w for w in self.workers if not w.session_keys]
+            if empty:
+                worker = empty[0]
+            elif len(self.workers) < self.size:
+                worker = ShopWorker.spawn(self._context, next(self._worker_index))
+                self.workers.append(worker)
+            else:
+                worker = min(self.workers, key=lambda w: len(w.session_keys))
+            worker.session_keys.add(key)
+            return worker
+
+    def create_session(self, **kwargs) -> RemoteShopSession:
+        key = next(self._keys)
+        worker = self._pick_worker(key)
+        try:
+            worker.request('create', key, kwargs)
+        except Exception:
+            worker.session_keys.discard(key)
+            raise
+        return RemoteShopSession(worker, key, kwargs.get('name', 'unnamed'), kwargs.get('id', 1))
+
+    def fork_session(self, sess: RemoteShopSession, name: str, id: int, timeout: float = 60.0) -> RemoteShopSession:
+        # Forks the worker hosting sess. The forked worker shares the memory of its parent copy-on-write and serves
+        # a single session holding the model of sess, so a clone costs almost nothing until it diverges. Must not run
+        # concurrently with other calls on sess. The worker forks once the calls running on its other sessions have
+        # returned, and holds back new ones until then.
+        if not FORK_AVAILABLE:
+            raise HTTPException(400, 'forking shop workers requires os.fork and unix sockets')
+
+        key = next(self._keys)
+        directory = tempfile.mkdtemp(prefix='restshop_fork_')
+        address = os.path.join(directory, 'worker.sock')
+        server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            server.bind(address)
+            server.listen(1)
+            server.settimeout(timeout)
+            pid = sess._worker.request('fork', sess._key, key, address)
+            try:
+                client, _ = server.accept()
+            except socket.timeout:
+                raise HTTPException(500, f'forked shop worker {{{pid}}} did not connect within {timeout} seconds')
+        finally:
+            server.close()
+            shutil.rmtree(directory, ignore_errors=True)
+
+        client.settimeout(None)
+        worker = ShopWorker(Connection(client.detach()), f'{sess._worker.name}_fork_{key}', pid)
+        worker.session_keys.add(key)
+        with self._lock:
+            self.forked_workers = [w for w in self.forked_workers if w.alive] + [worker]
+        return RemoteShopSession(worker, key, name, id)
+
+    def all_workers(self) -> List[ShopWorker]:
+        return [w for w in self.workers + self.forked_workers if w.alive]
+
+    def shutdown(self):
+        for worker in self.workers + self.forked_workers:
+            worker.terminate()
+        self.workers = []
+        self.forked_workers = []
@@ -34,5 +34,10 @@ setup(
       'pytest',
       'pytest-order',
       'requests'
-    ]
+    ],
+    extras_require={
+      'arrow': ['pyarrow'],
+      'orjson': ['orjson'],
+      'zstd': ['zstandard'],
+    }
 )
@@ -3,9 +3,15 @@ import pytest
 from fastapi.testclient import TestClient
 
 from restshop.schemas import *
+from restshop.sessions import SessionManager
 from main import app
 
+import asyncio
 import json
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 
 
 client = TestClient(app)
@@ -313,15 +319,932 @@ def test_put_connections():
 def test_get_connections():
     response = client.get('/connections')
     assert response.status_code == 200
-    
-    # TODO: connection output is a mess ... SHOP's fault?
-    print(json.dumps(response.json(), indent=4))
+    assert {
+        'from_object': {'object_type': 'reservoir', 'object_name': 'r1'},
+        'to_object': {'object_type': 'plant', 'object_name': 'p1'},
+        'relation_type': 'connection_standard',
+        'relation_direction': 'output'
+    } in response.json()
+
+# JOBS
+
+@pytest.mark.order(21)
+def test_post_simulation_command_as_job():
+    response = client.post(
+        '/simulation/set_code?run_as_job=true',
+        json={'options': ['incremental'], 'values': []}
+    )
+    assert response.status_code == 202
+    job = Job(**response.json())
+    assert job.command == 'set_code'
+
+    for _ in range(100):
+        job = Job(**client.get(f'/jobs/{job.job_id}').json())
+        if job.status not in [JobStatusEnum.queued, JobStatusEnum.running]:
+            break
+        time.sleep(0.1)
+    assert job.status == JobStatusEnum.finished
+    assert job.result.status == True
+
+    response = client.delete(f'/jobs/{job.job_id}')
+    assert response.status_code == 200
+    assert client.get(f'/jobs/{job.job_id}').status_code == 404
+
+    # without a body the command runs without options or values
+    response = client.post('/simulation/set_code?run_as_job=true')
+    assert response.status_code == 202
+    job = Job(**response.json())
+    for _ in range(100):
+        job = Job(**client.get(f'/jobs/{job.job_id}').json())
+        if job.status not in [JobStatusEnum.queued, JobStatusEnum.running]:
+            break
+        time.sleep(0.1)
+    assert job.status == JobStatusEnum.finished
+
+@pytest.mark.order(22)
+def test_get_job_that_doesnt_exist():
+    response = client.get('/jobs/42')
+    assert response.status_code == 404
+    assert response.json() == {
+        'detail': 'Job with id {42} not found'
+    }
+
+# BULK MODEL
+
+@pytest.mark.order(23)
+def test_put_model_bulk():
+    response = client.put(
+        '/model',
+        json={
+            'objects': [
+                {'object_type': 'reservoir', 'object_name': 'r2', 'attributes': {'max_vol': 12, 'lrl': 90, 'hrl': 100}},
+                {'object_type': 'plant', 'object_name': 'p2', 'attributes': {'outlet_line': 40}},
+                {'object_type': 'reservoir', 'object_name': 'r1', 'attributes': {'not_an_attribute': 1}}
+            ],
+            'connections': [
+                {
+                    'from_object': {'object_type': 'reservoir', 'object_name': 'r2'},
+                    'to_object': {'object_type': 'plant', 'object_name': 'p2'}
+                }
+            ]
+        }
+    )
+    assert response.status_code == 200
+    result = ModelUpsertStatus(**response.json())
+    assert [(o.object_name, o.created, o.attributes_set) for o in result.objects[:2]] == [('r2', True, 3), ('p2', True, 1)]
+    assert result.objects[2].error is not None
+    assert result.connections_added == 1
+    assert result.instances is None
+
+    response = client.get('/model/reservoir?object_name=r2')
+    assert response.json()['attributes']['max_vol'] == 12
+
+# ATTRIBUTE SELECTION
+
+@pytest.mark.order(24)
+def test_get_model_object_instance_attribute_selection():
+    response = client.get('/model/reservoir?object_name=test_res&attributes=vol_head&attributes=inflow')
+    assert response.status_code == 200
+    assert list(response.json()['attributes'].keys()) == ['vol_head', 'inflow']
+
+    response = client.get('/model/reservoir?object_name=test_res&attribute_filter=^inflow$')
+    assert response.status_code == 200
+    assert list(response.json()['attributes'].keys()) == ['inflow']
+
+    response = client.get('/model/reservoir?object_name=test_res&inputs_only=true')
+    assert response.status_code == 200
+    info = client.get('/model/reservoir/information?verbose=true').json()
+    assert set(response.json()['attributes']) == {n for n, a in info['attributes'].items() if a['is_input']}
+
+@pytest.mark.order(25)
+def test_get_model_object_instance_unknown_attribute():
+    response = client.get('/model/reservoir?object_name=test_res&attributes=not_an_attribute')
+    assert response.status_code == 400
+    assert response.json() == {
+        'detail': 'attributes {not_an_attribute} are not attributes of object_type {reservoir}.'
+    }
+
+# CONNECTION GRAPH
+
+@pytest.mark.order(26)
+def test_get_connections_graph_formats():
+    connections = client.get('/connections').json()
+
+    edge_list = ConnectionGraph(**client.get('/connections?format=edge_list').json())
+    assert len(edge_list.edges) == len(edge_list.relation_types) == len(connections)
+    r1 = edge_list.nodes.index(ObjectID(object_type='reservoir', object_name='r1'))
+    p1 = edge_list.nodes.index(ObjectID(object_type='plant', object_name='p1'))
+    assert [r1, p1] in edge_list.edges
+
+    csr = ConnectionGraph(**client.get('/connections?format=csr').json())
+    assert csr.nodes == edge_list.nodes
+    assert len(csr.indptr) == len(csr.nodes) + 1
+    assert csr.indptr[-1] == len(csr.indices) == len(connections)
+    assert p1 in csr.indices[csr.indptr[r1]:csr.indptr[r1 + 1]]
+
+# OBJECT TYPE INFORMATION CACHING
+
+@pytest.mark.order(27)
+def test_get_model_object_type_info_etag():
+    response = client.get('/model/reservoir/information?verbose=true')
+    assert response.status_code == 200
+    etag = response.headers['etag']
+    assert 'test_res' in ObjectType(**response.json()).instances
+
+    response = client.get('/model/reservoir/information?verbose=true', headers={'If-None-Match': etag})
+    assert response.status_code == 304
+
+    # a new instance changes the etag
+    client.put('/model/reservoir?object_name=test_res_etag')
+    response = client.get('/model/reservoir/information?verbose=true', headers={'If-None-Match': etag})
+    assert response.status_code == 200
+    assert response.headers['etag'] != etag
+
+# COLUMNAR ATTRIBUTES
+
+@pytest.mark.order(28)
+def test_model_object_attribute_npy():
+    import io
+    import numpy as np
+
+    response = client.get('/model/reservoir/attributes/vol_head?object_name=test_res', headers={'Accept': 'application/x-npy'})
+    assert response.status_code == 200
+    assert response.headers['content-type'] == 'application/x-npy'
+    curve = np.load(io.BytesIO(response.content))
+    assert curve['x'].tolist() == [10.0, 20.0, 30.0]
+    assert curve['y'].tolist() == [42.0, 43.0, 45.0]
+
+    inflow = np.load(io.BytesIO(client.get(
+        '/model/reservoir/attributes/inflow?object_name=test_res', headers={'Accept': 'application/x-npy'}
+    ).content))
+    assert inflow.dtype.names == ('time', 'y_0')
+    assert inflow['time'][0] == np.datetime64('2021-05-02T00:00:00')
+
+    inflow['y_0'] = np.arange(inflow.size, dtype=float)
+    buffer = io.BytesIO()
+    np.save(buffer, inflow)
+    response = client.put(
+        '/model/reservoir/attributes/inflow?object_name=test_res',
+        data=buffer.getvalue(), headers={'Content-Type': 'application/x-npy'}
+    )
+    assert response.status_code == 200
+
+    response = client.get('/model/reservoir/attributes/inflow?object_name=test_res')
+    assert response.status_code == 200
+    assert TimeSeries(**response.json()).values == [list(np.arange(inflow.size, dtype=float))]
+
+@pytest.mark.order(29)
+def test_model_object_attribute_arrow():
+    pa = pytest.importorskip('pyarrow')
+
+    response = client.get(
+        '/model/reservoir/attributes/water_value_input?object_name=test_res',
+        headers={'Accept': 'application/vnd.apache.arrow.stream'}
+    )
+    assert response.status_code == 200
+    table = pa.ipc.open_stream(response.content).read_all()
+    assert table.column_names == ['ref', 'x', 'y']
+
+    batch = pa.RecordBatch.from_pydict({'ref': [0.0, 0.0, 1.0, 1.0], 'x': [10.0, 8.0, 10.0, 8.0], 'y': [40.0, 10.0, 30.0, 5.0]})
+    sink = pa.BufferOutputStream()
+    with pa.ipc.new_stream(sink, batch.schema) as writer:
+        writer.write_batch(batch)
+    response = client.put(
+        '/model/reservoir/attributes/water_value_input?object_name=test_res',
+        data=sink.getvalue().to_pybytes(), headers={'Content-Type': 'application/vnd.apache.arrow.stream'}
+    )
+    assert response.status_code == 200
+
+    curves = client.get('/model/reservoir/attributes/water_value_input?object_name=test_res').json()
+    assert list(curves) == ['0.0', '1.0']
+    assert curves['1.0']['y_values'] == [30.0, 5.0]
+
+@pytest.mark.order(30)
+def test_model_object_attribute_unsupported_media_type():
+    response = client.put(
+        '/model/reservoir/attributes/inflow?object_name=test_res', data=b'[]', headers={'Content-Type': 'text/plain'}
+    )
+    assert response.status_code == 415
+
+# SESSION REMOVAL
+
+@pytest.mark.order(31)
+def test_remove_session():
+    session_id = client.post('/session', json={'session_name': 'short_lived'}).json()['session_id']
+
+    response = client.delete(f'/session?session_id={session_id}')
+    assert response.status_code == 200
+    assert response.json() == {'session_id': session_id, 'session_name': 'short_lived'}
+
+    assert client.get(f'/session?session_id={session_id}').status_code == 404
+    assert client.delete(f'/session?session_id={session_id}').status_code == 404
+
+# SESSION EVICTION
+
+@pytest.mark.order(32)
+def test_evict_and_restore_session():
+    from restshop.sessions import EvictedShopSession
+
+    session_id = client.post('/session', json={'session_name': 'evicted'}).json()['session_id']
+    headers = {'session-id': str(session_id)}
+    client.put('/time_resolution', json={'start_time': '2021-05-02T00:00:00', 'end_time': '2021-05-03T00:00:00'}, headers=headers)
+    client.put('/model/reservoir?object_name=r_evicted', json={'attributes': {'max_vol': 42.0}}, headers=headers)
+
+    assert SessionManager.evict_shop_session('test_user', session_id).result()
+    sess = SessionManager.get_shop_session('test_user', session_id)
+    assert isinstance(sess, EvictedShopSession)
+    assert os.path.exists(sess.path)
+    assert {'session_id': session_id, 'session_name': 'evicted'} in client.get('/sessions').json()
+
+    response = client.get('/model/reservoir?object_name=r_evicted', headers=headers)
+    assert response.status_code == 200
+    assert response.json()['attributes']['max_vol'] == 42.0
+    assert not os.path.exists(sess.path)
+
+    response = client.get('/metrics')
+    assert response.status_code == 200
+    assert 'restshop_session_evictions_total{reason="idle"}' in response.text
+    assert 'restshop_session_reloads_total' in response.text
+
+    client.delete(f'/session?session_id={session_id}')
+
+# SESSION CLONING
+
+def _clone_and_check(method: str):
+    original = client.get('/model/reservoir?object_name=test_res').json()
+
+    response = client.post(f'/session/1/clone?session_name=variant&method={method}')
+    assert response.status_code == 200
+    clone_id = response.json()['session_id']
+    assert response.json()['session_name'] == 'variant'
+    headers = {'session-id': str(clone_id)}
+
+    assert client.get('/model/reservoir?object_name=test_res', headers=headers).json() == original
+
+    # the clone diverges without touching the original
+    client.put('/model/reservoir?object_name=test_res', json={'attributes': {'max_vol': 1.0}}, headers=headers)
+    assert client.get('/model/reservoir?object_name=test_res', headers=headers).json()['attributes']['max_vol'] == 1.0
+    assert client.get('/model/reservoir?object_name=test_res').json() == original
+
+    assert client.delete(f'/session?session_id={clone_id}').status_code == 200
+
+@pytest.mark.order(33)
+def test_clone_session_yaml():
+    _clone_and_check('yaml')
+
+@pytest.mark.order(34)
+def test_clone_session_auto():
+    # forks the worker when sessions live in worker processes, and falls back to yaml otherwise
+    _clone_and_check('auto')
+
+@pytest.mark.order(35)
+def test_clone_session_errors():
+    assert client.post('/session/42/clone').status_code == 404
+    if SessionManager.worker_pool is None:
+        response = client.post('/session/1/clone?method=fork')
+        assert response.status_code == 400
+        assert response.json() == {'detail': 'clone method {fork} requires worker processes and os.fork'}
+
+# SESSION VERSIONS
+
+@pytest.mark.order(36)
+def test_model_etag_follows_session_version():
+    response = client.get('/model/reservoir?object_name=test_res')
+    etag = response.headers['etag']
+    assert client.get('/model/reservoir?object_name=test_res', headers={'If-None-Match': etag}).status_code == 304
+    assert client.get('/connections', headers={'If-None-Match': etag}).status_code == 304
+
+    tr = client.get('/time_resolution')
+    assert tr.headers['etag'] == etag
+    assert client.get('/time_resolution', headers={'If-None-Match': etag}).status_code == 304
+
+    client.put('/model/reservoir?object_name=test_res', json={'attributes': {'max_vol': 40.0}})
+    response = client.get('/model/reservoir?object_name=test_res', headers={'If-None-Match': etag})
+    assert response.status_code == 200
+    assert response.headers['etag'] != etag
+    assert response.json()['attributes']['max_vol'] == 40.0
+
+    # * only matches objects that exist, whether or not their payload is cached
+    headers = {'If-None-Match': '*'}
+    SessionManager.get_user_session('test_user').shop_sessions_cache[1].clear()
+    assert client.get('/model/reservoir?object_name=test_res', headers=headers).status_code == 304
+    assert client.get('/model/reservoir/attributes/max_vol?object_name=test_res', headers=headers).status_code == 304
+    response = client.get('/model/reservoir?object_name=missing', headers=headers)
+    assert response.status_code == 400
+    assert response.json() == {'detail': 'object_name {missing} is not an instance of object_type {reservoir}.'}
+    assert client.get('/model/reservoir/attributes/max_vol?object_name=missing', headers=headers).status_code == 400
+    assert client.get('/model/reservoir/attributes/missing?object_name=test_res', headers=headers).status_code == 400
+
+# PAYLOAD CACHE
+
+@pytest.mark.order(37)
+def test_payload_cache_invalidation():
+    cache = SessionManager.get_user_session('test_user').shop_sessions_cache[1]
+    cache.clear()
+
+    test_res = client.get('/model/reservoir?object_name=test_res').json()
+    r2 = client.get('/model/reservoir?object_name=r2').json()
+    assert {key[:2] for key in cache._entries} == {('reservoir', 'test_res'), ('reservoir', 'r2')}
+    assert client.get('/model/reservoir?object_name=test_res').json() == test_res
+
+    # writing one object only drops its own payloads
+    client.put('/model/reservoir?object_name=test_res', json={'attributes': {'max_vol': 41.0}})
+    assert {key[:2] for key in cache._entries} == {('reservoir', 'r2')}
+    assert client.get('/model/reservoir?object_name=test_res').json()['attributes']['max_vol'] == 41.0
+    assert client.get('/model/reservoir?object_name=r2').json() == r2
+
+    # a simulation command may touch every object
+    response = client.post('/simulation/set_code', json={'options': ['incremental'], 'values': []})
+    assert response.status_code == 200
+    assert cache.size == 0
+
+# JSON ENCODING
+
+@pytest.mark.order(38)
+def test_encoded_instance_matches_schema():
+    response = client.get('/model/reservoir?object_name=test_res')
+    assert response.status_code == 200
+    ObjectInstance.parse_raw(response.content)
+
+    if SessionManager.worker_pool is None:
+        from restshop import operations
+        sess = SessionManager.get_shop_session('test_user', 1)
+        o = operations.get_model_object_instance(sess, 'reservoir', 'test_res')
+        assert encode_model_object_instance(o) == dump_json(serialize_model_object_instance(o))
+
+# COMPRESSION
+
+@pytest.mark.order(39)
+def test_response_compression():
+    url = '/model/reservoir/information?verbose=true'
+    plain = client.get(url, headers={'Accept-Encoding': 'identity'})
+    assert 'content-encoding' not in plain.headers
+
+    response = client.get(url, headers={'Accept-Encoding': 'gzip'})
+    assert response.headers['content-encoding'] == 'gzip'
+    assert 'Accept-Encoding' in response.headers['vary']
+    assert response.content == plain.content
+
+    # small bodies are not worth it
+    assert 'content-encoding' not in client.get('/time_resolution', headers={'Accept-Encoding': 'gzip'}).headers
+
+    zstandard = pytest.importorskip('zstandard')
+    response = client.get(url, headers={'Accept-Encoding': 'gzip;q=0.5, zstd'})
+    assert response.headers['content-encoding'] == 'zstd'
+    # recent urllib3 decodes zstd on its own
+    content = response.content
+    if content != plain.content:
+        content = zstandard.ZstdDecompressor().decompressobj().decompress(content)
+    assert content == plain.content
+
+# METRICS
+
+@pytest.mark.order(40)
+def test_metrics_timings():
+    client.post('/simulation/set_code', json={'options': ['incremental'], 'values': []})
+    client.get('/model/reservoir?object_name=test_res')
+
+    text = client.get('/metrics').text
+    assert 'restshop_http_request_seconds_count{method="GET",route="/model/{object_type}",status="200"}' in text
+    assert 'restshop_http_requests_in_flight 1.0' in text  # the scrape itself
+    assert 'restshop_sessions{state="in_memory"}' in text
+    assert 'restshop_shop_command_seconds_count{command="set_code"}' in text
+    busy = [l for l in text.splitlines() if l.startswith('restshop_session_busy_seconds_total{session_id="1",user="test_user"}')]
+    assert float(busy[0].split()[-1]) > 0.0
+
+# PROFILING
+
+@pytest.mark.order(41)
+def test_profile_request(monkeypatch):
+    from restshop import config
+    url = '/model/reservoir?object_name=test_res&profile=true'
+    monkeypatch.setattr(config, 'ADMIN_TOKEN', '')
+    assert client.get(url).status_code == 403
+
+    monkeypatch.setattr(config, 'ADMIN_TOKEN', 'secret')
+    assert client.get(url, headers={'X-Admin-Token': 'wrong'}).status_code == 403
+
+    # never more than one active profiler, python 3.12 refuses a second one
+    import cProfile
+    active, most_active = set(), [0]
+
+    class Profile(cProfile.Profile):
+        def enable(self, *args, **kwargs):
+            active.add(self)
+            most_active[0] = max(most_active[0], len(active))
+            super().enable(*args, **kwargs)
+
+        def disable(self):
+            active.discard(self)
+            super().disable()
+    monkeypatch.setattr(cProfile, 'Profile', Profile)
+
+    # not answered from the payload cache
+    SessionManager.get_user_session('test_user').shop_sessions_cache[1].clear()
+    response = client.get(url, headers={'X-Admin-Token': 'secret'})
+    assert most_active[0] == 1 and not active
+    assert response.status_code == 200
+    body = response.json()
+    assert body['response'] == client.get('/model/reservoir?object_name=test_res').json()
+    assert set(body['profile']['breakdown']) == {
+        'restshop.schemas', 'pyshop.shopcore.shop_api', 'shop_api native', 'event loop idle', 'other'
+    }
+    # the operation ran under the profiler wherever the session lives
+    assert body['profile']['breakdown']['restshop.schemas'] > 0
+    assert 'get_model_object_instance_serialized' in body['profile']['stats']
+
+# SHOP METADATA
+
+@pytest.mark.order(42)
+def test_shop_metadata_cache(monkeypatch, tmp_path):
+    from restshop import metadata, schemas
+    live = metadata.load_shop_metadata(str(tmp_path))
+    assert len(list(tmp_path.iterdir())) == 1
+
+    def no_core(*args, **kwargs):
+        raise AssertionError('a ShopCore was started')
+    monkeypatch.setattr(metadata, 'ShopSession', no_core)
+    cached = metadata.load_shop_metadata(str(tmp_path))
+    assert vars(cached) == vars(live)
+    assert [e.value for e in schemas.ObjectTypeEnum] == cached.object_types
+    assert cached.attribute_catalog().datatypes == schemas._attribute_catalog.datatypes
+
+    # a binary that was only touched is hashed once, and its new stat is written back
+    cache_path = next(tmp_path.iterdir())
+    content = json.loads(cache_path.read_text())
+    content['binary']['mtime_ns'] -= 1
+    cache_path.write_text(json.dumps(content))
+    assert vars(metadata.load_shop_metadata(str(tmp_path))) == vars(live)
+
+    def no_hash(path):
+        raise AssertionError('the binary was hashed')
+    monkeypatch.setattr(metadata, '_sha256', no_hash)
+    assert vars(metadata.load_shop_metadata(str(tmp_path))) == vars(live)
+
+# COMMAND LISTS
+
+@pytest.mark.order(43)
+def test_post_simulation_command_list():
+    response = client.post('/simulation', json={'commands': [
+        {'command': 'set_code', 'options': ['full']},
+        {'command': 'start_sim', 'values': ['1']},
+    ]})
+    assert response.status_code == 200
+    body = CommandListStatus(**response.json())
+    assert body.status
+    assert [(r.command, r.options, r.values, r.executed) for r in body.results] == [
+        ('set_code', ['full'], [], True), ('start_sim', [], ['1'], True)
+    ]
+    assert body.wall_seconds == pytest.approx(sum(r.wall_seconds for r in body.results))
+
+    run_file = '# solve\nset code /incremental\nstart sim 1\n'
+    response = client.post('/simulation', data=run_file, headers={'Content-Type': 'text/plain'})
+    assert response.status_code == 200
+    assert [(r['command'], r['options'], r['values']) for r in response.json()['results']] == [
+        ('set_code', ['incremental'], []), ('start_sim', [], ['1'])
+    ]
+    assert 'restshop_shop_command_seconds_count{command="start_sim"}' in client.get('/metrics').text
+
+    # nothing runs when a command is unknown
+    response = client.post('/simulation', data='start sim 1\nnot_a_command\n', headers={'Content-Type': 'text/plain'})
+    assert response.status_code == 400
+    assert client.post('/simulation', json={'commands': [{'command': 'not_a_command'}]}).status_code == 422
+
+# MESSAGES
+
+@pytest.mark.order(44)
+def test_stream_messages():
+    from restshop.messages import MessageDrain
+
+    client.post('/simulation/start_sim', json={'options': [], 'values': ['1']})
+    response = client.get('/messages?follow=false')
+    assert response.status_code == 200
+    assert response.headers['content-type'].startswith('text/event-stream')
+    events = [e for e in response.text.split('\n\n') if e]
+    assert 'executed start sim' in events[-1] and '"command": "start_sim"' in events[-1]
+    last_id = events[-1].split('\n')[0][len('id: '):]
+    assert client.get('/messages?follow=false', headers={'Last-Event-ID': last_id}).text == ': keepalive\n\n'
+
+    # messages are passed on after every command of a list, on the thread running the commands
+    from pyshop import ShopSession
+    from restshop import operations
+    sess = ShopSession(license_path='', silent=False, log_file='', name='drained', id=0)
+    drained = []
+
+    def sink(messages):
+        drained.append((threading.get_ident(), len(sess.shop_api.GetExecutedCommands()), messages))
+
+    with MessageDrain(sess.shop_api, sink):
+        operations.execute_command_list(sess, [{'command': 'start_sim', 'values': ['1']}] * 2)
+    assert [d[:2] for d in drained] == [(threading.get_ident(), 1), (threading.get_ident(), 2)]
+    assert all(m['command'] == 'start_sim' for d in drained for m in d[2])
+
+# QUERIES
+
+@pytest.mark.order(45)
+def test_query_model_attributes():
+    from restshop import columnar
+    client.post('/simulation/start_sim', json={'options': [], 'values': ['1']})
+    query = {
+        'object_types': ['plant', 'generator'], 'object_names': ['p*'], 'attributes': ['production', 'discharge'],
+        'start_time': '2021-05-02T06:00:00Z', 'end_time': '2021-05-02T18:00:00Z'
+    }
+    response = client.post('/model/query', json=query)
+    assert response.status_code == 200
+    frame = response.json()
+    assert set(frame) == {'time', 'plant.p1.production', 'plant.p1.discharge', 'plant.p2.production', 'plant.p2.discharge'}
+    assert frame['time'][0] == '2021-05-02T06:00:00+00:00' and len(frame['time']) == 12
+    # the value of 06:00 holds for the whole window
+    production = client.get('/model/plant/attributes/production?object_name=p2').json()
+    assert frame['plant.p2.production'] == [production['values'][0][6]] * 12
+
+    response = client.post('/model/query', json=query, headers={'Accept': columnar.NPY})
+    table = columnar.decode_table(response.content, columnar.NPY)
+    assert table['time'][0] == np.datetime64('2021-05-02T06:00:00') and list(table['plant.p1.production']) == frame['plant.p1.production']
+    assert client.post('/model/query', json=query, headers={'If-None-Match': response.headers['ETag'], 'Accept': columnar.NPY}).status_code == 304
+
+    assert client.post('/model/query', json=dict(query, attributes=['outlet_line'])).status_code == 400
+    assert client.post('/model/query', json=dict(query, object_names=['nothing*'])).status_code == 404
+
+# SWEEPS
+
+@pytest.mark.order(46)
+def test_sweep(monkeypatch):
+    sessions = client.get('/sessions').json()
+    sweep = {
+        'variants': [
+            {'name': 'low', 'objects': [{'object_type': 'reservoir', 'object_name': 'r1', 'attributes': {'max_vol': 10}}]},
+            {'name': 'high', 'objects': [{'object_type': 'reservoir', 'object_name': 'r1', 'attributes': {'max_vol': 20}}]},
+            {'name': 'broken', 'objects': [{'object_type': 'reservoir', 'object_name': 'r1', 'attributes': {'not_an_attribute': 1}}]},
+        ],
+        'commands': [{'command': 'start_sim', 'values': ['1']}],
+        'outputs': [
+            {'object_type': 'reservoir', 'object_name': 'r1', 'attribute_name': 'max_vol'},
+            {'object_type': 'plant', 'object_name': 'p1', 'attribute_name': 'production', 'aggregate': 'max'},
+        ],
+    }
+    response = client.post('/sweep?parallelism=2', json=sweep)
+    assert response.status_code == 200
+    assert response.headers['content-type'].startswith('application/x-ndjson')
+    results = {r['name']: SweepResult(**r) for r in map(json.loads, response.text.splitlines())}
+    assert results['low'].status and results['low'].outputs['reservoir.r1.max_vol'] == 10
+    assert results['high'].outputs['reservoir.r1.max_vol'] == 20
+    assert results['high'].outputs['plant.p1.production.max'] is not None
+    assert not results['broken'].status and 'not_an_attribute' in results['broken'].error
+    # the clones are gone
+    assert client.get('/sessions').json() == sessions
+
+    # also when the client goes away while a clone is made
+    from restshop import sweeps
+    removed = []
+    remove_shop_session = SessionManager.remove_shop_session
+    monkeypatch.setattr(SessionManager, 'remove_shop_session', staticmethod(
+        lambda username, session_id: removed.append(session_id) or remove_shop_session(username, session_id)
+    ))
+
+    async def cancel_variant():
+        task = asyncio.ensure_future(sweeps._run_variant(
+            'test_user', 1, Sweep(**sweep), 0, Sweep(**sweep).variants[0], False, asyncio.Semaphore(1)
+        ))
+        await asyncio.sleep(0)
+        task.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await task
+        # the clone is made and then removed
+        for _ in range(100):
+            if removed:
+                break
+            await asyncio.sleep(0.05)
+
+    asyncio.get_event_loop().run_until_complete(cancel_variant())
+    assert client.get('/sessions').json() == sessions
+
+    response = client.post('/sweep', json=dict(sweep, outputs=[{'object_type': 'plant', 'object_name': 'nope', 'attribute_name': 'production'}]))
+    assert response.status_code == 400
+
+# PATCHES
+
+@pytest.mark.order(47)
+def test_patch_txy_window():
+    from restshop import columnar
+    url = '/model/reservoir/attributes/inflow?object_name=r1'
+    npy = {'Accept': columnar.NPY}
+    hours = np.datetime64('2021-05-02T00:00:00') + np.arange(24) * np.timedelta64(3600, 's')
+    content = columnar.encode_table({'time': hours, 'y_0': np.arange(24.0)}, columnar.NPY)
+    client.put(url, data=content, headers={'Content-Type': columnar.NPY})
+
+    patch = {'timestamps': ['2021-05-02T06:00:00Z', '2021-05-02T07:00:00Z', '2021-05-02T08:00:00Z'], 'values': [[100, 101, 102]]}
+    assert client.patch(url, json=patch).status_code == 200
+    table = columnar.decode_table(client.get(url, headers=npy).content, columnar.NPY)
+    assert list(table['time']) == list(hours)
+    assert list(table['y_0']) == list(range(6)) + [100, 101, 102] + list(range(9, 24))
+
+    # the last value of the patch holds until end_time, the series keeps its value after it
+    client.put(url, data=columnar.encode_table({'time': hours[:1], 'y_0': np.array([5.0])}, columnar.NPY), headers={'Content-Type': columnar.NPY})
+    assert client.patch(url + '&end_time=2021-05-02T12:00:00Z', json=patch).status_code == 200
+    table = columnar.decode_table(client.get(url, headers=npy).content, columnar.NPY)
+    assert list(table['y_0']) == [5] * 6 + [100, 101, 102, 102, 102, 102] + [5] * 12
+
+    assert client.patch(url, json=dict(patch, values=[[1, 2]])).status_code == 400
+    assert client.patch('/model/reservoir/attributes/max_vol?object_name=r1', json=patch).status_code == 400
+
+# SESSION LOCKS
+
+@pytest.mark.order(48)
+def test_session_lock():
+    from restshop.locking import SessionLockMiddleware, WAIT_HEADER
+
+    response = client.get('/model/reservoir?object_name=r1')
+    assert float(response.headers[WAIT_HEADER]) >= 0
+    assert WAIT_HEADER not in client.get('/metrics').headers
+
+    # requests on one session are served in order, the ones over the queue limit are turned away
+    order = []
+
+    async def app(scope, receive, send):
+        order.append(scope['path'])
+        await asyncio.sleep(0.05)
+        await send({'type': 'http.response.start', 'status': 200, 'headers': []})
+        await send({'type': 'http.response.body', 'body': b''})
+
+    async def request(middleware, path, session_id):
+        messages = []
+
+        async def send(message):
+            messages.append(message)
+        scope = {'type': 'http', 'path': path, 'headers': [(b'session-id', session_id)]}
+        await middleware(scope, None, send)
+        return messages[0]['status'], dict(messages[0]['headers'])
+
+    async def run():
+        middleware = SessionLockMiddleware(app, queue_limit=2)
+        start = time.perf_counter()
+        results = await asyncio.gather(*[request(middleware, f'/{i}', b'1') for i in range(4)], request(middleware, '/other', b'2'))
+        return results, time.perf_counter() - start
+
+    results, elapsed = asyncio.get_event_loop().run_until_complete(run())
+    assert [status for status, _ in results] == [200, 200, 200, 429, 200]
+    assert [path for path in order if path != '/other'] == ['/0', '/1', '/2']
+    assert float(results[2][1][WAIT_HEADER.lower().encode()]) >= 90
+    # the other session did not wait
+    assert float(results[4][1][WAIT_HEADER.lower().encode()]) < 40
+    assert elapsed < 0.3
+
+# WORKERS
+
+@pytest.mark.order(49)
+def test_worker_pool(monkeypatch):
+    from restshop import operations
+    from restshop.workers import WorkerPool
+
+    # the workers install the fake ShopCore through benchmarks/sitecustomize.py, and sleep in every command
+    root = os.path.dirname(os.path.abspath(__file__))
+    paths = [os.path.join(root, 'benchmarks'), os.path.join(root, 'SDK'), os.environ.get('PYTHONPATH', '')]
+    monkeypatch.setenv('PYTHONPATH', os.pathsep.join(paths))
+    monkeypatch.setenv('FAKE_SHOP_COMMAND_SLEEP', '1')
+
+    pool = WorkerPool(1)
+    try:
+        kwargs = dict(license_path='', silent=False, log_file='')
+        a = pool.create_session(name='a', id=1, **kwargs)
+        b = pool.create_session(name='b', id=2, **kwargs)
+        assert a._worker is b._worker and a._worker.session_keys == {a._key, b._key}
+
+        # a long command in one session does not hold up the other session on the same worker
+        messages = []
+        with ThreadPoolExecutor(max_workers=1) as executor:
+            solving = executor.submit(a.call_drained, messages.extend, operations.execute_command, 'start_sim', [], ['1'])
+            time.sleep(0.2)
+            start = time.perf_counter()
+            assert 'reservoir' in b.call(operations.get_model_object_types)
+            assert time.perf_counter() - start < 0.5
+            assert not solving.done()
+            assert solving.result()
+        assert messages == [{'message': 'executed start sim', 'severity': 'INFO', 'command': 'start_sim'}]
+
+        # a fork waits for the command running in the other session of the worker, no thread is in SHOP when it forks
+        with ThreadPoolExecutor(max_workers=1) as executor:
+            solving = executor.submit(a.call, operations.execute_command, 'start_sim', [], ['1'])
+            time.sleep(0.2)
+            fork = pool.fork_session(b, 'fork', 3)
+            assert solving.done() and solving.result()
+        assert 'reservoir' in fork.call(operations.get_model_object_types)
+        fork.close()
+
+        a.close()
+        assert a._worker.session_keys == {b._key}
+        with pytest.raises(KeyError):
+            a.call(operations.get_model_object_types)
+        b.close()
+        assert a._worker.alive and not a._worker.session_keys
+    finally:
+        pool.shutdown()
+
+# CONCURRENCY
+
+@pytest.mark.order(50)
+def test_long_command_does_not_block_other_sessions(monkeypatch):
+    import functools
+    from restshop import operations
+
+    from pyshop import ShopSession
+
+    # a session in this process, so that the patched operation is the one that runs even with worker processes
+    us = SessionManager.get_user_session('test_user')
+    slow_id = us._next_session_id()
+    executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix=f'shop_session_test_user_{slow_id}')
+    slow = executor.submit(ShopSession, license_path='', silent=False, log_file='', name='slow', id=slow_id).result()
+    us._register_shop_session(slow_id, slow, executor)
+    client.put('/time_resolution', headers={'session-id': str(slow_id)}, json={
+        'start_time': '2021-05-02T00:00:00.00Z', 'end_time': '2021-05-03T00:00:00.00Z', 'time_unit': 'hour'
+    })
+    execute_command = operations.execute_command
+
+    @functools.wraps(execute_command)
+    def slow_execute_command(*args, **kwargs):
+        time.sleep(1.0)
+        return execute_command(*args, **kwargs)
+    monkeypatch.setattr(operations, 'execute_command', slow_execute_command)
+
+    def solve():
+        # a client of its own, the TestClient runs every request to completion on the event loop of its thread
+        return TestClient(app).post('/simulation/start_sim', headers={'session-id': str(slow_id)}, json={'options': [], 'values': ['1']})
+
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        solving = executor.submit(solve)
+        time.sleep(0.2)
+        start = time.perf_counter()
+        assert client.get('/sessions').status_code == 200
+        assert client.get('/time_resolution', headers={'session-id': '1'}).status_code == 200
+        assert time.perf_counter() - start < 0.5
+        assert not solving.done()
+        assert solving.result().json()['status']
+
+    assert client.delete(f'/session?session_id={slow_id}').status_code == 200
+
+# RELATIONS
+
+@pytest.mark.order(51)
+def test_relation_index_matches_pyshop():
+    from pyshop import ShopSession
+    from restshop.relations import RelationIndex
+
+    sess = ShopSession(license_path='', silent=False, log_file='', name='relations', id=0)
+    for object_type, object_name in [('reservoir', 'r1'), ('reservoir', 'r2'), ('plant', 'p1'), ('generator', 'g1')]:
+        sess.model[object_type].add_object(object_name)
+    sess.model.reservoir.r1.connect().plant.p1.add()
+    sess.model.reservoir.r1.connect(connection_type='spill').reservoir.r2.add()
+    sess.model.plant.p1.connect().reservoir.r2.add()
+    sess.model.plant.p1.connect().generator.g1.add()
+
+    index = RelationIndex.build(sess.shop_api)
+    types, names = index.object_types, index.object_names
+    physical = {(types[i], names[i], types[j], names[j], r) for i, j, r, d in index.edges if d == 'output'}
+    logical = {(frozenset([(types[i], names[i]), (types[j], names[j])]), r) for i, j, r, d in index.edges if d == 'both'}
+    # every edge once
+    assert len(index.edges) == len(physical) + len(logical)
+
+    # the same edges as pyshop's get_relations finds from every object
+    expected_physical, expected_logical = set(), set()
+    for object_type, object_name in zip(types, names):
+        o = sess.model[object_type][object_name]
+        for relation_type in sess.shop_api.GetValidRelationTypes(object_type):
+            for r in o.get_relations(direction='output', relation_type=relation_type, relation_category='physical'):
+                expected_physical.add((object_type, object_name, r._type, r._name, relation_type))
+            for r in o.get_relations(direction='both', relation_type=relation_type, relation_category='logical'):
+                expected_logical.add((frozenset([(object_type, object_name), (r._type, r._name)]), relation_type))
+    assert physical == expected_physical
+    assert logical == expected_logical == {(frozenset([('plant', 'p1'), ('generator', 'g1')]), 'generator_of_plant')}
+
+# JOB RETENTION
+
+@pytest.mark.order(52)
+def test_job_retention(monkeypatch):
+    import datetime as dt
+    from restshop import config
+    from restshop.jobs import JobManager
+
+    def run_job():
+        job = Job(**client.post('/simulation/set_code?run_as_job=true', json={'options': ['incremental'], 'values': []}).json())
+        for _ in range(100):
+            if JobManager.get_job('test_user', 1, job.job_id).finished_at is not None:
+                break
+            time.sleep(0.01)
+        return job.job_id
+
+    # only the most recent jobs that are done are kept
+    monkeypatch.setattr(config, 'JOB_RETENTION_COUNT', 2)
+    job_ids = [run_job() for _ in range(3)]
+    assert client.get(f'/jobs/{job_ids[0]}').status_code == 404
+    assert all(client.get(f'/jobs/{job_id}').status_code == 200 for job_id in job_ids[1:])
+
+    # and not for longer than the retention time
+    monkeypatch.setattr(config, 'JOB_RETENTION_SECONDS', 60)
+    JobManager.get_job('test_user', 1, job_ids[1]).finished_at -= dt.timedelta(seconds=61)
+    assert client.get(f'/jobs/{job_ids[1]}').status_code == 404
+    assert client.get(f'/jobs/{job_ids[2]}').status_code == 200
+
+# BENCHMARK
+
+@pytest.mark.order(53)
+def test_benchmark_smoke(tmp_path):
+    # the benchmark runs against the fake ShopCore, on a tiny topology
+    import subprocess
+    import sys
+    root = os.path.dirname(os.path.abspath(__file__))
+    env = dict(os.environ, RESTSHOP_METADATA_CACHE_DIR=str(tmp_path))
+    env['PYTHONPATH'] = os.pathsep.join([os.path.join(root, 'benchmarks'), os.path.join(root, 'SDK'), env.get('PYTHONPATH', '')])
+    output = tmp_path / 'bench.json'
+    args = ['--cascades', '1', '--depth', '2', '--generators', '1', '--hours', '24', '--requests', '2', '--warmup', '0',
+            '--model-repeats', '1', '--output', str(output)]
+    process = subprocess.run([sys.executable, os.path.join(root, 'benchmarks', 'bench.py')] + args, env=env,
+                             stdout=subprocess.PIPE, stderr=subprocess.STDOUT, timeout=300)
+    assert process.returncode == 0, process.stdout.decode()
+    results = json.loads(output.read_text())['results']
+    assert {'PUT /model', 'GET /model/{object_type}', 'GET /connections (csr)', 'POST /simulation/{command}'} <= set(results)
+    assert all(r['n'] > 0 and r['p50_ms'] > 0 for r in results.values())
+
+@pytest.mark.order(54)
+def test_evictor_skips_failed_session(monkeypatch):
+    import restshop.evictor as evictor_module
+    import restshop.sessions as sessions
+    from restshop.evictor import SessionEvictor
+    from restshop.sessions import EvictedShopSession
+
+    session_ids = [client.post('/session', json={'session_name': f'evict_{i}'}).json()['session_id'] for i in range(3)]
+    failing = session_ids[0]
+
+    # only the sessions of this test are considered, with the failing one least recently used
+    get_idle = SessionManager.get_idle_shop_sessions
+    monkeypatch.setattr(SessionManager, 'get_idle_shop_sessions', staticmethod(
+        lambda: [(i, u, s) for i, (_, u, s) in enumerate(e for e in get_idle() if e[2] in session_ids)]))
+
+    call_shop_session = sessions._call_shop_session
+    def failing_dump(sess, func, args, kwargs, sink=None):
+        if func is sessions._dump_yaml and sess._id == failing:
+            raise RuntimeError('dump failed')
+        return call_shop_session(sess, func, args, kwargs, sink)
+    monkeypatch.setattr(sessions, '_call_shop_session', failing_dump)
+
+    # idle eviction goes on past the failed session
+    evictor = SessionEvictor(idle_ttl=1e-9, memory_budget=0, interval=60.0)
+    assert evictor.run_once() == 2
+    assert not isinstance(SessionManager.get_shop_session('test_user', failing), EvictedShopSession)
+    assert all(isinstance(SessionManager.get_shop_session('test_user', s), EvictedShopSession) for s in session_ids[1:])
+
+    # the budget pass skips the failed session and evicts the next one
+    for s in session_ids[1:]:
+        assert client.get('/model', headers={'session-id': str(s)}).status_code == 200
+    monkeypatch.setattr(evictor_module, 'memory_usage', lambda: 2)
+    evictor = SessionEvictor(idle_ttl=0.0, memory_budget=1, interval=60.0)
+    assert evictor.run_once() == 1
+    assert not isinstance(SessionManager.get_shop_session('test_user', failing), EvictedShopSession)
+    assert sum(isinstance(SessionManager.get_shop_session('test_user', s), EvictedShopSession) for s in session_ids[1:]) == 1
+
+    for s in session_ids:
+        client.delete(f'/session?session_id={s}')
+
+@pytest.mark.order(55)
+def test_session_busy_seconds_count_shop_calls():
+    from pyshop import ShopSession
+    from restshop import timing
+
+    sess = timing.time_shop_calls(ShopSession(license_path='', silent=False, log_file='', name='timed', id=0))
+    assert isinstance(sess.model._shop_api, timing.TimedShopApi)
+
+    # time spent around the SHOP calls is not counted
+    def slow(sess):
+        time.sleep(0.2)
+        return sess.shop_api.GetObjectTypeNames()
+
+    result, seconds = timing.timed_call(sess, slow)
+    assert 'reservoir' in result
+    assert 0.0 < seconds < 0.1
+
+@pytest.mark.order(56)
+def test_session_ids_are_unique_across_threads():
+    from restshop.sessions import UserSession
+
+    us = UserSession('ids', None)
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        ids = list(executor.map(lambda _: us._next_session_id(), range(800)))
+    assert sorted(ids) == list(range(1, 801))
+    assert us.session_counter == 800
+
+@pytest.mark.order(57)
+def test_relation_index_is_kept_per_version():
+    from pyshop import ShopSession
+    from restshop import operations
 
-    # raise Exception("dummy")
+    sess = ShopSession(license_path='', silent=False, log_file='', name='relations', id=0)
+    sess.model.reservoir.add_object('r1')
+    sess.model.plant.add_object('p1')
 
-    # assert response.json() == [
-    #     {
-    #         'from_object': {'object_name': 'r1', 'object_type': 'reservoir'},
-    #         'relation_direction': 'both',
-    #         'relation_type': 'de...: 'both', 'relation_type': 'connection_standard', 'to_object': {'object_name': 'r1', 'object_type': 'reservoir'}
+    index = operations.get_relation_index(sess, 'v1')
+    assert operations.get_relation_index(sess, 'v1') is index
+    assert not index.edges
 
+    sess.model.reservoir.r1.connect().plant.p1.add()
+    assert operations.get_relation_index(sess, 'v1') is index
+    assert len(operations.get_relation_index(sess, 'v2').edges) == 1
+    assert operations.get_relation_index(sess) is not operations.get_relation_index(sess)